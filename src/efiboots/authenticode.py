@@ -0,0 +1,195 @@
+"""
+Authenticode digests of PE/COFF images, like EFI loaders and unified kernel images, as firmware computes them to
+look images up in the Secure Boot db and dbx: SHA-256 over the headers and sections, leaving out the checksum,
+the certificate table entry and the certificates themselves.
+
+Images are memory mapped and hashed straight from the mapping, in a pool of threads: hashlib releases the GIL
+while it hashes, so files are hashed in parallel without copying them or forking the GUI. Digests are kept in a
+cache file keyed by (device, inode, size, mtime), so that only new or changed files are hashed again.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+DOS_SIGNATURE = b'MZ'
+PE_SIGNATURE = b'PE\0\0'
+COFF_HEADER = struct.Struct('<HHIIIHH')  # machine, sections, timestamp, symbols, symbol count, optional size, flags
+SECTION_HEADER = struct.Struct('<8sIIIIIIHHI')  # name, virtual size and address, raw size and pointer, ...
+PE32_MAGIC = 0x10b
+PE32_PLUS_MAGIC = 0x20b
+# Offsets in the optional header
+SIZE_OF_HEADERS_OFFSET = 60
+CHECKSUM_OFFSET = 64
+# Number of data directories and where they start, for PE32 and PE32+
+DATA_DIRECTORIES = {PE32_MAGIC: (92, 96), PE32_PLUS_MAGIC: (108, 112)}
+SECURITY_DIRECTORY = 4
+DATA_DIRECTORY = struct.Struct('<II')  # address (a file offset for the security directory), size
+
+CACHE_VERSION = 1
+# Digests of files not seen for this many cache writes are forgotten
+CACHE_ENTRIES = 1024
+
+log = logging.getLogger('authenticode')
+
+
+class PeError(ValueError):
+    """Not a PE/COFF image, or a malformed one"""
+
+
+@dataclass(frozen=True)
+class PeDigest:
+    sha256: bytes
+    # Whether the image carries a certificate table, that is whether it is signed at all
+    signed: bool
+
+
+def authenticode_ranges(image) -> tuple[list[tuple[int, int]], bool]:
+    """The (start, end) byte ranges of image that make its Authenticode digest, in hashing order, and whether it
+    has certificates. Follows the order and rules of edk2, which is what firmware checks against."""
+    size = len(image)
+    try:
+        pe_offset = struct.unpack_from('<I', image, 0x3c)[0] if image[:2] == DOS_SIGNATURE else 0
+        if image[pe_offset:pe_offset + 4] != PE_SIGNATURE:
+            raise PeError("no PE signature")
+        _, sections, _, _, _, optional_size, _ = COFF_HEADER.unpack_from(image, pe_offset + 4)
+        optional = pe_offset + 4 + COFF_HEADER.size
+        magic, = struct.unpack_from('<H', image, optional)
+        if magic not in DATA_DIRECTORIES:
+            raise PeError(f"unknown optional header magic {magic:#x}")
+        count_offset, directories = DATA_DIRECTORIES[magic]
+        headers_size, = struct.unpack_from('<I', image, optional + SIZE_OF_HEADERS_OFFSET)
+        directory_count, = struct.unpack_from('<I', image, optional + count_offset)
+        checksum = optional + CHECKSUM_OFFSET
+        if directory_count > SECURITY_DIRECTORY:
+            security = optional + directories + SECURITY_DIRECTORY * DATA_DIRECTORY.size
+            _, certificates_size = DATA_DIRECTORY.unpack_from(image, security)
+            ranges = [(0, checksum), (checksum + 4, security), (security + DATA_DIRECTORY.size, headers_size)]
+        else:
+            certificates_size = 0
+            ranges = [(0, checksum), (checksum + 4, headers_size)]
+        table = optional + optional_size
+        raw = []
+        for i in range(sections):
+            _, _, _, raw_size, raw_pointer, *_ = SECTION_HEADER.unpack_from(image, table + i * SECTION_HEADER.size)
+            if raw_size:
+                raw.append((raw_pointer, raw_pointer + raw_size))
+    except struct.error as e:
+        raise PeError(f"truncated headers: {e}") from e
+    if not ranges[0][1] < ranges[-1][0] <= ranges[-1][1] <= size:
+        raise PeError("headers out of the image")
+
+    hashed = headers_size
+    for start, end in sorted(raw):
+        if end > size:
+            raise PeError("section out of the image")
+        ranges.append((start, end))
+        hashed += end - start
+    # Whatever follows the sections, except the certificates
+    if size > hashed + certificates_size:
+        ranges.append((hashed, size - certificates_size))
+    return ranges, certificates_size > 0
+
+
+def authenticode_digest(path: str) -> PeDigest:
+    with open(path, 'rb') as f:
+        try:
+            image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            raise PeError("empty file") from e
+    with image, memoryview(image) as view:
+        ranges, signed = authenticode_ranges(view)
+        digest = hashlib.sha256()
+        for start, end in ranges:
+            digest.update(view[start:end])
+    return PeDigest(digest.digest(), signed)
+
+
+def cache_key(st: os.stat_result) -> str:
+    return f'{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}'
+
+
+def default_cache_path() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'efiboots', 'authenticode.json')
+
+
+class AuthenticodeHasher:
+    """Digests of many images at once, cached on disk. Safe to use from several threads."""
+
+    def __init__(self, cache_path: str | None = None, workers: int | None = None):
+        self.cache_path = cache_path if cache_path is not None else default_cache_path()
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._cache: dict[str, tuple[str, bool]] | None = None
+
+    def _load(self) -> dict[str, tuple[str, bool]]:
+        if self._cache is None:
+            try:
+                with open(self.cache_path) as f:
+                    stored = json.load(f)
+                if stored.get('version') != CACHE_VERSION:
+                    raise ValueError(f"cache version {stored.get('version')}")
+                self._cache = {key: (sha256, signed) for key, (sha256, signed) in stored['digests'].items()}
+            except FileNotFoundError:
+                self._cache = {}
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                log.warning("Ignoring the digest cache %s: %s", self.cache_path, e)
+                self._cache = {}
+        return self._cache
+
+    def _save(self):
+        cache = self._cache
+        # The most recently used are last
+        digests = dict(list(cache.items())[-CACHE_ENTRIES:])
+        directory = os.path.dirname(self.cache_path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix='.tmp') as f:
+                json.dump({'version': CACHE_VERSION, 'digests': digests}, f)
+            os.replace(f.name, self.cache_path)
+        except OSError as e:
+            log.warning("Could not write the digest cache %s: %s", self.cache_path, e)
+
+    def digests(self, paths: list[str]) -> dict[str, PeDigest | Exception]:
+        """Digest of each image, or why it could not be hashed: an OSError or a PeError"""
+        results = {}
+        missing = {}
+        with self._lock:
+            cache = self._load()
+            for path in paths:
+                try:
+                    key = cache_key(os.stat(path))
+                except OSError as e:
+                    results[path] = e
+                    continue
+                cached = cache.pop(key, None)
+                if cached is not None:
+                    cache[key] = cached
+                    results[path] = PeDigest(bytes.fromhex(cached[0]), cached[1])
+                else:
+                    missing[path] = key
+        if not missing:
+            return results
+
+        def digest(path: str) -> PeDigest | Exception:
+            try:
+                return authenticode_digest(path)
+            except (OSError, PeError) as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as executor:
+            hashed = dict(zip(missing, executor.map(digest, missing)))
+        log.debug("Hashed %d of %d images", len(missing), len(paths))
+        with self._lock:
+            for path, result in hashed.items():
+                if isinstance(result, PeDigest):
+                    self._cache[missing[path]] = result.sha256.hex(), result.signed
+            self._save()
+        return results | hashed
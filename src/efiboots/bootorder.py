@@ -0,0 +1,86 @@
+class BootOrder:
+    """Boot numbers in boot order, with a num -> rank index kept up to date on every edit"""
+
+    def __init__(self, nums=()):
+        self._nums: list[str] = list(nums)
+        self._rank: dict[str, int] = {}
+        self._reindex(0)
+
+    def _reindex(self, start: int, end: int | None = None):
+        for i in range(start, len(self._nums) if end is None else end):
+            self._rank[self._nums[i]] = i
+
+    def __iter__(self):
+        return iter(self._nums)
+
+    def __len__(self):
+        return len(self._nums)
+
+    def __getitem__(self, index):
+        return self._nums[index]
+
+    def __contains__(self, num) -> bool:
+        return num in self._rank
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, BootOrder):
+            return self._nums == other._nums
+        if isinstance(other, list):
+            return self._nums == other
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self._nums)
+
+    def rank(self, num: str, default: int | None = None) -> int | None:
+        return self._rank.get(num, default)
+
+    def index(self, num: str) -> int:
+        try:
+            return self._rank[num]
+        except KeyError:
+            raise ValueError(f"{num} is not in boot order") from None
+
+    def append(self, num: str):
+        self._nums.append(num)
+        self._rank[num] = len(self._nums) - 1
+
+    def insert(self, index: int, num: str):
+        index = max(0, min(index, len(self._nums)))
+        self._nums.insert(index, num)
+        self._reindex(index)
+
+    def remove(self, num: str):
+        index = self.index(num)
+        del self._nums[index]
+        del self._rank[num]
+        self._reindex(index)
+
+    def discard(self, num: str):
+        if num in self._rank:
+            self.remove(num)
+
+    def swap(self, a: int, b: int):
+        self._nums[a], self._nums[b] = self._nums[b], self._nums[a]
+        self._rank[self._nums[a]] = a
+        self._rank[self._nums[b]] = b
+
+    def move(self, num: str, index: int):
+        """Moves num to index, shifting the entries in between: only their ranks are updated"""
+        old = self.index(num)
+        index = max(0, min(index, len(self._nums) - 1))
+        if old == index:
+            return
+        del self._nums[old]
+        self._nums.insert(index, num)
+        self._reindex(min(old, index), max(old, index) + 1)
+
+    def replace(self, start: int, count: int, nums):
+        """Replaces the count entries from start with nums. Only ranks from start on are updated, and only up to
+        the end of nums when as many come in as go."""
+        nums = list(nums)
+        removed = self._nums[start:start + count]
+        self._nums[start:start + count] = nums
+        for num in set(removed).difference(nums):
+            del self._rank[num]
+        self._reindex(start, start + len(nums) if len(nums) == count else None)
@@ -0,0 +1,242 @@
+"""
+Headless command line interface: reads and changes boot entries without gi, Gtk or a display, printing JSON
+(or NDJSON, one object per line) for scripts and inventory tools.
+
+This module must not import gi: efiboots dispatches to it before the GUI is loaded.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+from dataclasses import asdict
+
+from . import efivars
+from .efibootmgr import Efibootmgr, EfibootmgrEfivars, ParsedEfibootmgr
+from .loadercheck import LoaderChecker
+from .plan import MAX_UINT16, ChangePlan, PlanError, PlanReport, build_plan, execute_plan, execute_plan_as_root
+from .utils import PartitionIndex, auto_detect_esp, get_partition_index
+
+COMMANDS = ('list', 'show', 'set-order', 'set-next', 'add', 'remove', 'timeout')
+# Options that take a value, of both the commands and the GUI, so that a value isn't mistaken for a command
+VALUE_OPTIONS = {'-b', '--backend', '-i', '--nvram-image', '--efivars', '-d', '--disk', '-p', '--part', '-f',
+                 '--format', '-l', '--log-level'}
+
+log = logging.getLogger('cli')
+
+
+class CliError(Exception):
+    pass
+
+
+def boot_num(value: str) -> str:
+    """Normalizes a boot number given as 1, 0001 or Boot0001"""
+    try:
+        return efivars.format_boot_num(int(value.removeprefix('Boot'), 16))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid boot number: {value}") from None
+
+
+def timeout_seconds(value: str) -> int:
+    try:
+        seconds = int(value)
+    except ValueError:
+        seconds = -1
+    if not 0 <= seconds <= MAX_UINT16:
+        raise argparse.ArgumentTypeError(f"invalid timeout: {value}, it must be between 0 and {MAX_UINT16} seconds")
+    return seconds
+
+
+def command_of(argv: list[str]) -> str | None:
+    """The command argv runs, if its first positional argument is one, or None for the GUI"""
+    args = iter(argv)
+    for arg in args:
+        if arg == '--':
+            arg = next(args, None)
+        elif arg.startswith('--'):
+            if arg in VALUE_OPTIONS:
+                next(args, None)
+            continue
+        elif arg.startswith('-') and arg != '-':
+            # Short options may be bundled, like -nd /dev/sda: the first one taking a value takes the rest
+            for i in range(1, len(arg)):
+                if f'-{arg[i]}' in VALUE_OPTIONS:
+                    if i == len(arg) - 1:
+                        next(args, None)
+                    break
+            continue
+        return arg if arg in COMMANDS else None
+    return None
+
+
+def entry_to_dict(parsed: ParsedEfibootmgr, index: int, partitions: PartitionIndex | None = None,
+                  loaders: LoaderChecker | None = None) -> dict:
+    """partitions resolves the partition of the entry to the block device holding it, if it is present, and loaders
+    looks for its loader there"""
+    entry = parsed.entries[index]
+    order = parsed.boot_order.index(entry.num) if entry.num in parsed.boot_order else None
+    device = partitions.resolve(entry.partition) if partitions is not None else None
+    loader = loaders.check(device.mount_point, entry.path) if device is not None and loaders is not None else None
+    return asdict(entry) | {'current': entry.num == parsed.boot_current, 'next': entry.num == parsed.boot_next,
+                            'order': order, 'device': asdict(device) if device is not None else None,
+                            'loader': asdict(loader) if loader is not None else None}
+
+
+def emit(objects: list[dict], summary: dict | None, output_format: str):
+    """json prints the summary, ndjson the objects one per line"""
+    if output_format == 'ndjson':
+        sys.stdout.writelines(json.dumps(o) + '\n' for o in objects)
+    else:
+        sys.stdout.write(json.dumps(summary) + '\n')
+
+
+class Cli:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.backend = Efibootmgr.get_instance(args.backend, args.nvram_image, args.efivars)
+        self._parsed = None
+        self.loaders = LoaderChecker()
+
+    @property
+    def parsed(self) -> ParsedEfibootmgr:
+        if self._parsed is None:
+            self._parsed = self.backend.read()
+        return self._parsed
+
+    @property
+    def partitions(self) -> PartitionIndex | None:
+        # The disks of a virtual machine are not ours
+        return None if self.args.nvram_image else get_partition_index()
+
+    def find(self, num: str) -> int:
+        for i, entry in enumerate(self.parsed.entries):
+            if entry.num == num:
+                return i
+        raise CliError(f"Boot{num} does not exist")
+
+    def esp(self) -> tuple[str, str]:
+        if self.args.disk and self.args.part:
+            return self.args.disk, self.args.part
+        if self.args.nvram_image:
+            # The ESP of a virtual machine is on its own disk: only creating entries needs it
+            if self.args.command == 'add':
+                raise CliError("Adding entries to an NVRAM image needs the --disk and --part of its ESP")
+            return '', ''
+        many_esps = []
+        disk, part = auto_detect_esp(error_callback=many_esps.append)
+        if many_esps:
+            raise CliError(f"Found more than one ESP ({', '.join(many_esps[0])}): pass --disk and --part")
+        if not (disk and part):
+            raise CliError("ESP not found: mount it on /boot/efi or pass --disk and --part")
+        return disk, part
+
+    def plan(self, **changes) -> ChangePlan:
+        """Builds the plan of changes on top of the current state, the same way the main window does"""
+        parsed = self.parsed
+        state = dict(boot_remove=set(), boot_add={}, edits={}, boot_order=parsed.boot_order,
+                     boot_next=parsed.boot_next, boot_active=set(), boot_inactive=set(), timeout=parsed.timeout)
+        state.update(changes)
+        disk, part = self.esp()
+        return build_plan(disk, part, boot_order_initial=parsed.boot_order, boot_next_initial=parsed.boot_next,
+                          timeout_initial=parsed.timeout, native=isinstance(self.backend, EfibootmgrEfivars),
+                          nvram_image=self.args.nvram_image, **state)
+
+    def apply(self, plan: ChangePlan) -> PlanReport | None:
+        if self.args.dry_run:
+            sys.stdout.write(plan.to_json() + '\n')
+            return None
+        # Images belong to whoever runs the virtual machines, not to root
+        if os.geteuid() == 0 or plan.nvram_image is not None:
+            report = execute_plan(plan, self.args.efivars)
+            if not report.ok:
+                raise PlanError(report)
+        else:
+            report = execute_plan_as_root(plan)
+        if report is not None:
+            emit([asdict(step) for step in report.steps], asdict(report), self.args.format)
+        return report
+
+    def run(self):
+        args = self.args
+        match args.command:
+            case 'list':
+                entries = [entry_to_dict(self.parsed, i, self.partitions, self.loaders)
+                           for i in range(len(self.parsed.entries))]
+                emit(entries, asdict(self.parsed) | {'entries': entries}, args.format)
+            case 'show':
+                entry = entry_to_dict(self.parsed, self.find(args.num), self.partitions, self.loaders)
+                emit([entry], entry, args.format)
+            case 'set-order':
+                boot_order = [num for nums in args.nums for num in nums]
+                for num in boot_order:
+                    self.find(num)
+                self.apply(self.plan(boot_order=boot_order))
+            case 'set-next':
+                if args.num is not None:
+                    self.find(args.num)
+                self.apply(self.plan(boot_next=args.num))
+            case 'add':
+                self.apply(self.plan(boot_add={'NEW0': (args.label, args.loader, args.parameters)}))
+            case 'remove':
+                self.find(args.num)
+                self.apply(self.plan(boot_remove={args.num}))
+            case 'timeout':
+                self.apply(self.plan(timeout=args.seconds))
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='efiboots', description="Manage EFI boot entries without a display")
+    parser.add_argument('-b', '--backend', choices=('efivars', 'efibootmgr'),
+                        help="how to read boot entries. Default: efivars when available")
+    parser.add_argument('-i', '--nvram-image', metavar='PATH',
+                        help="read and change the variable store of a firmware image, like OVMF_VARS.fd of a VM")
+    parser.add_argument('--efivars', default=efivars.EFIVARS_PATH, metavar='PATH', help="efivarfs mount point")
+    parser.add_argument('-d', '--disk', help="disk device where ESP is located (for example /dev/sda)")
+    parser.add_argument('-p', '--part', help="partition number of ESP")
+    parser.add_argument('-f', '--format', choices=('json', 'ndjson'), default='json',
+                        help="json prints a single document, ndjson one entry or step per line")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="print the change plan instead of applying it")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log to stderr")
+    commands = parser.add_subparsers(dest='command', required=True, metavar='COMMAND')
+
+    commands.add_parser('list', help="list boot entries")
+    show = commands.add_parser('show', help="show a boot entry")
+    show.add_argument('num', type=boot_num)
+    set_order = commands.add_parser('set-order', help="set the boot order")
+    set_order.add_argument('nums', nargs='+', metavar='NUM[,NUM...]',
+                           type=lambda value: [boot_num(num) for num in value.split(',') if num])
+    set_next = commands.add_parser('set-next', help="boot an entry only at the next boot")
+    next_group = set_next.add_mutually_exclusive_group(required=True)
+    next_group.add_argument('num', type=boot_num, nargs='?')
+    next_group.add_argument('--delete', action='store_true', help="delete BootNext")
+    add = commands.add_parser('add', help="create a boot entry on the ESP")
+    add.add_argument('-L', '--label', required=True)
+    add.add_argument('-l', '--loader', required=True, help=r"loader path on the ESP, like \EFI\arch\grubx64.efi")
+    add.add_argument('-u', '--parameters', default='', help="loader parameters")
+    remove = commands.add_parser('remove', help="delete a boot entry")
+    remove.add_argument('num', type=boot_num)
+    timeout = commands.add_parser('timeout', help="set the boot menu timeout")
+    timeout.add_argument('seconds', type=timeout_seconds)
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    # Failures are reported as a single error message, the logs are only for --verbose
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL + 1, stream=sys.stderr)
+    try:
+        Cli(args).run()
+    except PlanError as e:
+        emit([asdict(step) for step in e.report.steps], asdict(e.report), args.format)
+        return 1
+    except subprocess.CalledProcessError as e:
+        parser.exit(1, f"{parser.prog}: error: {e.stderr or e}\n")
+    except (CliError, NotImplementedError, OSError, ValueError) as e:
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,527 @@
+"""
+Decoder of UEFI device paths (UEFI specification, chapter 10) into typed nodes that print like efibootmgr.
+
+Nodes are read in place from a memoryview with precompiled structs: nothing is copied except the strings and
+GUIDs that end up in the nodes. Nodes of unknown types are kept as RawNode, so nothing is lost.
+"""
+import ipaddress
+import struct
+import uuid
+from dataclasses import dataclass
+
+HARDWARE_DEVICE_PATH = 0x01
+ACPI_DEVICE_PATH = 0x02
+MESSAGING_DEVICE_PATH = 0x03
+MEDIA_DEVICE_PATH = 0x04
+BBS_DEVICE_PATH = 0x05
+END_DEVICE_PATH = 0x7f
+
+END_INSTANCE_SUBTYPE = 0x01
+END_ENTIRE_SUBTYPE = 0xff
+
+HEADER = struct.Struct('<BBH')
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+PCI = struct.Struct('<BB')  # function, device
+ACPI = struct.Struct('<II')  # HID, UID
+ACPI_EX = struct.Struct('<III')  # HID, UID, CID
+ATAPI = struct.Struct('<BBH')  # primary/secondary, master/slave, LUN
+SCSI = struct.Struct('<HH')  # target, LUN
+USB = struct.Struct('<BB')  # parent port, interface
+USB_CLASS = struct.Struct('<HHBBB')  # vendor, product, class, subclass, protocol
+MAC = struct.Struct('<32sB')  # address, interface type
+IPV4 = struct.Struct('<4s4sHHHB')  # local, remote, local port, remote port, protocol, static
+IPV4_ADDRESSES = struct.Struct('<4s4s')  # gateway, subnet mask, since UEFI 2.0
+IPV6 = struct.Struct('<16s16sHHHB')  # local, remote, local port, remote port, protocol, origin
+IPV6_PREFIX = struct.Struct('<B16s')  # prefix length, gateway, since UEFI 2.3
+SATA = struct.Struct('<HHH')  # HBA port, port multiplier port, LUN
+NVME = struct.Struct('<I8s')  # namespace, EUI-64
+HARD_DRIVE = struct.Struct('<IQQ16sBB')  # partition, start, size, signature, format, signature type
+CDROM = struct.Struct('<IQQ')  # boot entry, start, size
+OFFSET = struct.Struct('<IQQ')  # reserved, start, end
+BBS = struct.Struct('<HH')  # device type, status flag
+GUID = struct.Struct('<16s')
+
+EISA_PNP_ID = 0x41d0
+IP_PROTOCOLS = {6: 'TCP', 17: 'UDP'}
+BBS_DEVICE_TYPES = {1: 'Floppy', 2: 'HD', 3: 'CDROM', 4: 'PCMCIA', 5: 'USB', 6: 'Network'}
+
+
+class DevicePathNode:
+    """Base of all nodes: str() gives the efibootmgr notation"""
+    __slots__ = ()
+
+
+@dataclass(frozen=True, slots=True)
+class RawNode(DevicePathNode):
+    type: int
+    subtype: int
+    data: bytes
+
+    def __str__(self):
+        return f'Path({self.type},{self.subtype},{self.data.hex()})'
+
+
+@dataclass(frozen=True, slots=True)
+class EndInstanceNode(DevicePathNode):
+    """Separates the instances of a multi-instance device path"""
+
+    def __str__(self):
+        return ','
+
+
+@dataclass(frozen=True, slots=True)
+class PciNode(DevicePathNode):
+    device: int
+    function: int
+
+    def __str__(self):
+        return f'Pci({self.device:#x},{self.function:#x})'
+
+
+@dataclass(frozen=True, slots=True)
+class ControllerNode(DevicePathNode):
+    controller: int
+
+    def __str__(self):
+        return f'Ctrl({self.controller:#x})'
+
+
+@dataclass(frozen=True, slots=True)
+class VendorNode(DevicePathNode):
+    kind: str  # Hw, Msg or Media
+    guid: uuid.UUID
+    data: bytes
+
+    def __str__(self):
+        data = f',{self.data.hex()}' if self.data else ''
+        return f'Ven{self.kind}({self.guid}{data})'
+
+
+@dataclass(frozen=True, slots=True)
+class AcpiNode(DevicePathNode):
+    hid: int
+    uid: int
+
+    def __str__(self):
+        if self.hid & 0xffff == EISA_PNP_ID:
+            product = self.hid >> 16
+            if product == 0x0a03:
+                return f'PciRoot({self.uid:#x})'
+            if product == 0x0a08:
+                return f'PcieRoot({self.uid:#x})'
+            return f'Acpi(PNP{product:04X},{self.uid:#x})'
+        return f'Acpi({self.hid:#x},{self.uid:#x})'
+
+
+@dataclass(frozen=True, slots=True)
+class AcpiExNode(DevicePathNode):
+    hid: int
+    uid: int
+    cid: int
+    hid_str: str
+    uid_str: str
+    cid_str: str
+
+    def __str__(self):
+        return f'AcpiEx({self.hid_str or hex(self.hid)},{self.cid_str or hex(self.cid)},' \
+               f'{self.uid_str or hex(self.uid)})'
+
+
+@dataclass(frozen=True, slots=True)
+class AcpiAdrNode(DevicePathNode):
+    addresses: tuple[int, ...]
+
+    def __str__(self):
+        return f"AcpiAdr({','.join(hex(address) for address in self.addresses)})"
+
+
+@dataclass(frozen=True, slots=True)
+class AtapiNode(DevicePathNode):
+    secondary: bool
+    slave: bool
+    lun: int
+
+    def __str__(self):
+        return f"Ata({'Secondary' if self.secondary else 'Primary'},{'Slave' if self.slave else 'Master'}," \
+               f"{self.lun:#x})"
+
+
+@dataclass(frozen=True, slots=True)
+class ScsiNode(DevicePathNode):
+    target: int
+    lun: int
+
+    def __str__(self):
+        return f'Scsi({self.target},{self.lun})'
+
+
+@dataclass(frozen=True, slots=True)
+class UsbNode(DevicePathNode):
+    parent_port: int
+    interface: int
+
+    def __str__(self):
+        return f'USB({self.parent_port},{self.interface})'
+
+
+@dataclass(frozen=True, slots=True)
+class UsbClassNode(DevicePathNode):
+    vendor: int
+    product: int
+    device_class: int
+    subclass: int
+    protocol: int
+
+    def __str__(self):
+        return f'UsbClass({self.vendor:#x},{self.product:#x},{self.device_class:#x},{self.subclass:#x},' \
+               f'{self.protocol:#x})'
+
+
+@dataclass(frozen=True, slots=True)
+class MacNode(DevicePathNode):
+    address: bytes
+    interface_type: int
+
+    def __str__(self):
+        # Ethernet and IEEE 802.3 addresses are 6 bytes, the rest of the field is padding
+        address = self.address[:6] if self.interface_type in (0, 1) else self.address
+        return f'MAC({address.hex()},{self.interface_type})'
+
+
+@dataclass(frozen=True, slots=True)
+class IPv4Node(DevicePathNode):
+    local: ipaddress.IPv4Address
+    remote: ipaddress.IPv4Address
+    local_port: int
+    remote_port: int
+    protocol: int
+    static: bool
+    gateway: ipaddress.IPv4Address | None
+    subnet_mask: ipaddress.IPv4Address | None
+
+    def __str__(self):
+        protocol = IP_PROTOCOLS.get(self.protocol, self.protocol)
+        text = f"IPv4({self.remote},{protocol},{'Static' if self.static else 'DHCP'},{self.local}"
+        if self.gateway is not None:
+            text += f',{self.gateway},{self.subnet_mask}'
+        return text + ')'
+
+
+@dataclass(frozen=True, slots=True)
+class IPv6Node(DevicePathNode):
+    local: ipaddress.IPv6Address
+    remote: ipaddress.IPv6Address
+    local_port: int
+    remote_port: int
+    protocol: int
+    origin: int  # 0 static, 1 stateless auto-configuration, 2 stateful auto-configuration
+    prefix_length: int | None
+    gateway: ipaddress.IPv6Address | None
+
+    def __str__(self):
+        protocol = IP_PROTOCOLS.get(self.protocol, self.protocol)
+        origin = ('Static', 'StatelessAutoConfigure', 'StatefulAutoConfigure')[self.origin] \
+            if self.origin < 3 else self.origin
+        text = f'IPv6({self.remote},{protocol},{origin},{self.local}'
+        if self.gateway is not None:
+            text += f',{self.gateway},{self.prefix_length}'
+        return text + ')'
+
+
+@dataclass(frozen=True, slots=True)
+class VlanNode(DevicePathNode):
+    vlan_id: int
+
+    def __str__(self):
+        return f'Vlan({self.vlan_id})'
+
+
+@dataclass(frozen=True, slots=True)
+class SataNode(DevicePathNode):
+    hba_port: int
+    port_multiplier_port: int
+    lun: int
+
+    def __str__(self):
+        return f'Sata({self.hba_port},{self.port_multiplier_port},{self.lun})'
+
+
+@dataclass(frozen=True, slots=True)
+class NvmeNode(DevicePathNode):
+    namespace_id: int
+    eui64: bytes
+
+    def __str__(self):
+        return f"NVMe({self.namespace_id:#x},{'-'.join(f'{b:02X}' for b in self.eui64)})"
+
+
+@dataclass(frozen=True, slots=True)
+class UriNode(DevicePathNode):
+    uri: str
+
+    def __str__(self):
+        return f'Uri({self.uri})'
+
+
+@dataclass(frozen=True, slots=True)
+class SlotNode(DevicePathNode):
+    kind: str  # SD or eMMC
+    slot: int
+
+    def __str__(self):
+        return f'{self.kind}({self.slot})'
+
+
+@dataclass(frozen=True, slots=True)
+class HardDriveNode(DevicePathNode):
+    partition: int
+    start: int
+    size: int
+    signature: uuid.UUID | int | bytes
+    partition_format: int  # 1 MBR, 2 GPT
+    signature_type: int  # 0 none, 1 MBR, 2 GUID
+
+    def __str__(self):
+        if self.signature_type == 2:
+            signature, scheme = self.signature, 'GPT'
+        elif self.signature_type == 1:
+            signature, scheme = f'{self.signature:08x}', 'MBR'
+        else:
+            signature, scheme = self.signature.hex(), 'MBR' if self.partition_format == 1 else 'GPT'
+        return f'HD({self.partition},{scheme},{signature},{self.start:#x},{self.size:#x})'
+
+
+@dataclass(frozen=True, slots=True)
+class CdromNode(DevicePathNode):
+    boot_entry: int
+    start: int
+    size: int
+
+    def __str__(self):
+        return f'CDROM({self.boot_entry:#x},{self.start:#x},{self.size:#x})'
+
+
+@dataclass(frozen=True, slots=True)
+class FilePathNode(DevicePathNode):
+    path: str
+
+    def __str__(self):
+        return f'File({self.path})'
+
+
+@dataclass(frozen=True, slots=True)
+class GuidNode(DevicePathNode):
+    kind: str  # Media, FvFile or FvVol
+    guid: uuid.UUID
+
+    def __str__(self):
+        return f'{self.kind}({self.guid})'
+
+
+@dataclass(frozen=True, slots=True)
+class OffsetNode(DevicePathNode):
+    start: int
+    end: int
+
+    def __str__(self):
+        return f'Offset({self.start:#x},{self.end:#x})'
+
+
+@dataclass(frozen=True, slots=True)
+class BbsNode(DevicePathNode):
+    device_type: int
+    status: int
+    description: str
+
+    def __str__(self):
+        return f'BBS({BBS_DEVICE_TYPES.get(self.device_type, self.device_type)},{self.description},{self.status:#x})'
+
+
+def _guid(view: memoryview, offset: int) -> uuid.UUID:
+    return uuid.UUID(bytes_le=bytes(view[offset:offset + 16]))
+
+
+def _ascii(view: memoryview, start: int, end: int) -> str:
+    return str(view[start:end], 'ascii', 'replace').split('\0', 1)[0]
+
+
+def _decode_pci(view, offset, length):
+    function, device = PCI.unpack_from(view, offset)
+    return PciNode(device, function)
+
+
+def _decode_vendor(kind):
+    def decode(view, offset, length):
+        return VendorNode(kind, _guid(view, offset), bytes(view[offset + 16:offset + length]))
+    return decode
+
+
+def _decode_acpi_ex(view, offset, length):
+    hid, uid, cid = ACPI_EX.unpack_from(view, offset)
+    # Three NUL terminated strings follow: HID, UID and CID
+    strings = str(view[offset + ACPI_EX.size:offset + length], 'ascii', 'replace').split('\0')
+    strings += [''] * (3 - len(strings))
+    return AcpiExNode(hid, uid, cid, *strings[:3])
+
+
+def _decode_acpi_adr(view, offset, length):
+    return AcpiAdrNode(tuple(address for address, in U32.iter_unpack(view[offset:offset + length - length % 4])))
+
+
+def _decode_atapi(view, offset, length):
+    secondary, slave, lun = ATAPI.unpack_from(view, offset)
+    return AtapiNode(bool(secondary), bool(slave), lun)
+
+
+def _decode_mac(view, offset, length):
+    address, interface_type = MAC.unpack_from(view, offset)
+    return MacNode(address, interface_type)
+
+
+def _decode_ipv4(view, offset, length):
+    local, remote, local_port, remote_port, protocol, static = IPV4.unpack_from(view, offset)
+    gateway = subnet_mask = None
+    if length >= IPV4.size + IPV4_ADDRESSES.size:
+        gateway, subnet_mask = map(ipaddress.IPv4Address, IPV4_ADDRESSES.unpack_from(view, offset + IPV4.size))
+    return IPv4Node(ipaddress.IPv4Address(local), ipaddress.IPv4Address(remote), local_port, remote_port, protocol,
+                    bool(static), gateway, subnet_mask)
+
+
+def _decode_ipv6(view, offset, length):
+    local, remote, local_port, remote_port, protocol, origin = IPV6.unpack_from(view, offset)
+    prefix_length = gateway = None
+    if length >= IPV6.size + IPV6_PREFIX.size:
+        prefix_length, gateway = IPV6_PREFIX.unpack_from(view, offset + IPV6.size)
+        gateway = ipaddress.IPv6Address(gateway)
+    return IPv6Node(ipaddress.IPv6Address(local), ipaddress.IPv6Address(remote), local_port, remote_port, protocol,
+                    origin, prefix_length, gateway)
+
+
+def _decode_hard_drive(view, offset, length):
+    partition, start, size, signature, partition_format, signature_type = HARD_DRIVE.unpack_from(view, offset)
+    if signature_type == 2:
+        signature = uuid.UUID(bytes_le=signature)
+    elif signature_type == 1:
+        signature = int.from_bytes(signature[:4], 'little')
+    return HardDriveNode(partition, start, size, signature, partition_format, signature_type)
+
+
+def _decode_file_path(view, offset, length):
+    return FilePathNode(str(view[offset:offset + length - length % 2], 'utf-16-le').rstrip('\0'))
+
+
+def _decode_offset(view, offset, length):
+    _, start, end = OFFSET.unpack_from(view, offset)
+    return OffsetNode(start, end)
+
+
+def _decode_bbs(view, offset, length):
+    device_type, status = BBS.unpack_from(view, offset)
+    return BbsNode(device_type, status, _ascii(view, offset + BBS.size, offset + length))
+
+
+def _decode_guid(kind):
+    def decode(view, offset, length):
+        return GuidNode(kind, _guid(view, offset))
+    return decode
+
+
+# (type, subtype) -> (decoder, minimum payload length). Decoders get the payload offset and length.
+DECODERS = {
+    (HARDWARE_DEVICE_PATH, 0x01): (_decode_pci, PCI.size),
+    (HARDWARE_DEVICE_PATH, 0x04): (_decode_vendor('Hw'), 16),
+    (HARDWARE_DEVICE_PATH, 0x05): (lambda view, offset, length: ControllerNode(*U32.unpack_from(view, offset)), 4),
+    (ACPI_DEVICE_PATH, 0x01): (lambda view, offset, length: AcpiNode(*ACPI.unpack_from(view, offset)), ACPI.size),
+    (ACPI_DEVICE_PATH, 0x02): (_decode_acpi_ex, ACPI_EX.size),
+    (ACPI_DEVICE_PATH, 0x03): (_decode_acpi_adr, 4),
+    (MESSAGING_DEVICE_PATH, 0x01): (_decode_atapi, ATAPI.size),
+    (MESSAGING_DEVICE_PATH, 0x02): (lambda view, offset, length: ScsiNode(*SCSI.unpack_from(view, offset)), SCSI.size),
+    (MESSAGING_DEVICE_PATH, 0x05): (lambda view, offset, length: UsbNode(*USB.unpack_from(view, offset)), USB.size),
+    (MESSAGING_DEVICE_PATH, 0x0a): (_decode_vendor('Msg'), 16),
+    (MESSAGING_DEVICE_PATH, 0x0b): (_decode_mac, MAC.size),
+    (MESSAGING_DEVICE_PATH, 0x0c): (_decode_ipv4, IPV4.size),
+    (MESSAGING_DEVICE_PATH, 0x0d): (_decode_ipv6, IPV6.size),
+    (MESSAGING_DEVICE_PATH, 0x0f): (lambda view, offset, length: UsbClassNode(*USB_CLASS.unpack_from(view, offset)),
+                                    USB_CLASS.size),
+    (MESSAGING_DEVICE_PATH, 0x12): (lambda view, offset, length: SataNode(*SATA.unpack_from(view, offset)), SATA.size),
+    (MESSAGING_DEVICE_PATH, 0x14): (lambda view, offset, length: VlanNode(*U16.unpack_from(view, offset)), 2),
+    (MESSAGING_DEVICE_PATH, 0x17): (lambda view, offset, length: NvmeNode(*NVME.unpack_from(view, offset)), NVME.size),
+    (MESSAGING_DEVICE_PATH, 0x18): (lambda view, offset, length: UriNode(_ascii(view, offset, offset + length)), 0),
+    (MESSAGING_DEVICE_PATH, 0x1a): (lambda view, offset, length: SlotNode('SD', *U8.unpack_from(view, offset)), 1),
+    (MESSAGING_DEVICE_PATH, 0x1d): (lambda view, offset, length: SlotNode('eMMC', *U8.unpack_from(view, offset)), 1),
+    (MEDIA_DEVICE_PATH, 0x01): (_decode_hard_drive, HARD_DRIVE.size),
+    (MEDIA_DEVICE_PATH, 0x02): (lambda view, offset, length: CdromNode(*CDROM.unpack_from(view, offset)), CDROM.size),
+    (MEDIA_DEVICE_PATH, 0x03): (_decode_vendor('Media'), 16),
+    (MEDIA_DEVICE_PATH, 0x04): (_decode_file_path, 0),
+    (MEDIA_DEVICE_PATH, 0x05): (_decode_guid('Media'), 16),
+    (MEDIA_DEVICE_PATH, 0x06): (_decode_guid('FvFile'), 16),
+    (MEDIA_DEVICE_PATH, 0x07): (_decode_guid('FvVol'), 16),
+    (MEDIA_DEVICE_PATH, 0x08): (_decode_offset, OFFSET.size),
+    (BBS_DEVICE_PATH, 0x01): (_decode_bbs, BBS.size),
+}
+
+
+def decode_device_path(data, start: int = 0, end: int | None = None) -> list[DevicePathNode]:
+    """Decodes the device path nodes in data[start:end], up to the end of entire device path node.
+
+    Instances of a multi-instance device path are separated by EndInstanceNode. Malformed nodes end decoding,
+    nodes that are too short for their type are kept as RawNode.
+    """
+    view = memoryview(data)
+    end = len(view) if end is None else min(end, len(view))
+    nodes = []
+    header_size = HEADER.size
+    unpack_header = HEADER.unpack_from
+    while start + header_size <= end:
+        node_type, subtype, length = unpack_header(view, start)
+        if length < header_size or start + length > end:
+            break
+        if node_type == END_DEVICE_PATH:
+            if subtype != END_INSTANCE_SUBTYPE:
+                break
+            nodes.append(EndInstanceNode())
+        else:
+            decoder = DECODERS.get((node_type, subtype))
+            payload_length = length - header_size
+            if decoder is not None and payload_length >= decoder[1]:
+                nodes.append(decoder[0](view, start + header_size, payload_length))
+            else:
+                nodes.append(RawNode(node_type, subtype, bytes(view[start + header_size:start + length])))
+        start += length
+    return nodes
+
+
+def format_device_path(nodes: list[DevicePathNode]) -> str:
+    """The efibootmgr notation of a device path, like HD(1,GPT,...)/File(\\EFI\\BOOT\\BOOTX64.EFI)"""
+    text = []
+    for node in nodes:
+        if isinstance(node, EndInstanceNode):
+            text.append(',')
+        else:
+            if text and text[-1] != ',':
+                text.append('/')
+            text.append(str(node))
+    return ''.join(text)
+
+
+def split_instances(nodes: list[DevicePathNode]) -> list[list[DevicePathNode]]:
+    instances = [[]]
+    for node in nodes:
+        if isinstance(node, EndInstanceNode):
+            instances.append([])
+        else:
+            instances[-1].append(node)
+    return instances
+
+
+def file_path(nodes: list[DevicePathNode]) -> str:
+    """The loader path: the concatenation of the file path nodes of the first instance"""
+    path = []
+    for node in nodes:
+        if isinstance(node, EndInstanceNode):
+            break
+        if isinstance(node, FilePathNode):
+            path.append(node.path)
+    return ''.join(path)
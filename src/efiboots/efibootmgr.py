@@ -1,9 +1,14 @@
 import abc
+import functools
 import logging
+import os
 import re
+import struct
+from collections.abc import Iterable
 from dataclasses import dataclass
 
-from .utils import subprocess_run_wrapper
+from . import efivars, varstore
+from .utils import PartitionInfo, subprocess_run_wrapper, subprocess_stream_wrapper, is_in_flatpak
 
 @dataclass
 class ParsedEfibootmgrEntry:
@@ -13,6 +18,8 @@ class ParsedEfibootmgrEntry:
     name: str
     path: str
     parameters: str
+    # The HD() node of the device path, when the entry boots from a partition
+    partition: PartitionInfo | None = None
 
 
 @dataclass
@@ -25,9 +32,64 @@ class ParsedEfibootmgr:
     timeout: int
 
 
+DOTS_TO_NUL = bytes.maketrans(b'.', b'\x00')
+HD_REGEX = re.compile(r'HD\(([0-9]+),(GPT|MBR),(?:0x)?([0-9a-fA-F-]+),(0x[0-9a-fA-F]+),(0x[0-9a-fA-F]+)\)')
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_hard_drive_node(node: str) -> PartitionInfo | None:
+    matched = HD_REGEX.fullmatch(node)
+    if matched is None:
+        return None
+    number, scheme, signature, start, size = matched.groups()
+    if scheme == 'GPT':
+        part_uuid, scheme = signature.lower(), 'gpt'
+    else:
+        part_uuid, scheme = efivars.mbr_part_uuid(int(signature, 16), int(number)), 'dos'
+    return PartitionInfo(int(number), int(start, 16), int(size, 16), part_uuid, scheme)
+
+
+def parse_hard_drive(device_path: str) -> PartitionInfo | None:
+    """The partition of the first HD() node in the efibootmgr notation of a device path"""
+    start = device_path.find('HD(')
+    if start < 0:
+        return None
+    # Most entries boot from the same few partitions: parse each HD() node once
+    return _parse_hard_drive_node(device_path[start:device_path.find(')', start) + 1])
+
+
+def classify_dotted_params(code: str) -> tuple[str, str]:
+    """efibootmgr 17 -v prints UCS-2 optional data showing each NUL byte as a dot.
+    Returns what kind of optional data code holds, as one of efivars.OPTIONAL_DATA_*, and its decoded text."""
+    prefix = ''
+    while True:
+        if '.' not in code or (code.endswith('.') and code.count('.') == 1):
+            return efivars.OPTIONAL_DATA_TEXT, prefix + code
+        if not code.startswith('WINDOWS'):
+            break
+        prefix += 'WINDOWS'
+        code = code[len('WINDOWS'):]
+    encoded = code.encode('utf-8')
+    ucs2 = bytearray(encoded)
+    # Only the high byte of each UCS-2 character is a NUL shown as a dot
+    ucs2[1::2] = encoded[1::2].translate(DOTS_TO_NUL)
+    try:
+        return efivars.OPTIONAL_DATA_UCS2, prefix + ucs2.decode('utf-16-le')
+    except UnicodeDecodeError as e:
+        logging.warning("Could not decode '%s': %s", code, e)
+        return efivars.OPTIONAL_DATA_BINARY, prefix + code
+
+
 class Efibootmgr(abc.ABC):
     version_regex = re.compile(r'version ([0-9]+)')
-    parse_line_regex = re.compile(r'^Boot([0-9A-F]+)(\*)? (.+)\t(?:.+/File\((.+)\)|.*\))(.*)$')
+    # Classifies a line of output in a single match: which group is set tells what kind of line it is
+    line_regex = re.compile(
+        r'Boot([0-9A-F]+)(\*)? (.+)\t(.+/File\((.+)\)|.*\))(.*)$'
+        r'|BootOrder:(.*)'
+        r'|BootNext:(.*)'
+        r'|BootCurrent:(.*)'
+        r'|Timeout:\s*([0-9]+)')
+    command: list[str] = []
     log = logging.getLogger('Efibootmgr')
 
     @staticmethod
@@ -39,7 +101,18 @@ class Efibootmgr(abc.ABC):
         return version
 
     @staticmethod
-    def get_instance() -> 'Efibootmgr':
+    def get_instance(backend: str | None = None, nvram_image: str | None = None,
+                     efivars_path: str = efivars.EFIVARS_PATH) -> 'Efibootmgr':
+        """backend is one of 'efivars', 'efibootmgr' or None to pick the fastest one available. With nvram_image,
+        boot entries are read from the variable store of that firmware image instead."""
+        if nvram_image is not None:
+            Efibootmgr.log.info("Reading boot entries from %s", nvram_image)
+            return EfibootmgrNvramImage(nvram_image)
+        if backend == 'efivars' or (backend is None and EfibootmgrEfivars.is_supported(efivars_path)):
+            Efibootmgr.log.info("Reading boot entries from %s", efivars_path)
+            return EfibootmgrEfivars(efivars_path)
+        if backend not in (None, 'efibootmgr'):
+            raise NotImplementedError(f"backend {backend} is not supported")
         version = Efibootmgr.get_version()
         match version:
             case "17":
@@ -49,129 +122,149 @@ class Efibootmgr(abc.ABC):
             case _:
                 raise NotImplementedError(f"efibootmgr version {version} is not supported")
 
-    @abc.abstractmethod
     def run(self) -> list[str]:
-        pass
+        output = subprocess_run_wrapper(self.command).strip().split('\n')
+        logging.debug(repr(output))
+        return output
+
+    def read(self) -> ParsedEfibootmgr:
+        """Runs efibootmgr and parses its output while it is still being written"""
+        with subprocess_stream_wrapper(self.command) as lines:
+            return self.parse(lines)
 
     @staticmethod
-    @abc.abstractmethod
-    def parse_line(line: str) -> tuple[str, object]:
-        pass
+    def decode_params(code: str) -> str:
+        return code
+
+    @classmethod
+    def parse_line(cls, line: str) -> tuple[str, object]:
+        matched = cls.line_regex.match(line)
+        if matched is None:
+            raise ValueError("line didn't match", repr(line))
+        num, active, name, device_path, path, params, order, next_, current, seconds = matched.groups()
+        if num is not None:
+            return 'entry', ParsedEfibootmgrEntry(num, active is not None, name, path or '', cls.decode_params(params),
+                                                  parse_hard_drive(device_path))
+        if order is not None:
+            return 'boot_order', order.strip().split(',') if order.strip() else []
+        if next_ is not None:
+            return 'boot_next', next_.strip()
+        if current is not None:
+            return 'boot_current', current.strip()
+        return 'timeout', int(seconds)
 
     @classmethod
-    def parse(cls, boot: list[str]) -> ParsedEfibootmgr:
-        parser_logger = logging.getLogger("parser")
-        parsed_efi = {
-            'entries': [],
-            'boot_order': [],
-            'boot_next': None,
-            'boot_current': None,
-            'timeout': None
-        }
+    def parse(cls, boot: Iterable[str]) -> ParsedEfibootmgr:
+        """Parses efibootmgr output in a single pass. boot can be a list of lines or a text stream, like a pipe."""
+        match_line = cls.line_regex.match
+        decode_params = cls.decode_params
+        entries = []
+        boot_order = []
+        boot_next = boot_current = timeout = None
 
         for line in boot:
-            try:
-                key, value = cls.parse_line(line)
-                if key == 'entry':
-                    parsed_efi['entries'].append(value)
-                else:
-                    parsed_efi[key] = value
-            except ValueError as e:
-                parser_logger.warning("line didn't match: %s", e.args[1])
+            matched = match_line(line)
+            if matched is None:
+                if line.strip():
+                    logging.getLogger("parser").warning("line didn't match: %r", line)
+                continue
+            num, active, name, device_path, path, params, order, next_, current, seconds = matched.groups()
+            if num is not None:
+                entries.append(ParsedEfibootmgrEntry(num, active is not None, name, path or '',
+                                                     decode_params(params), parse_hard_drive(device_path)))
+            elif order is not None:
+                order = order.strip()
+                boot_order = order.split(',') if order else []
+            elif next_ is not None:
+                boot_next = next_.strip()
+            elif current is not None:
+                boot_current = current.strip()
+            else:
+                timeout = int(seconds)
 
-        return ParsedEfibootmgr(**parsed_efi)
+        logging.getLogger("parser").debug("Parsed %d entries", len(entries))
+        return ParsedEfibootmgr(entries=entries, boot_order=boot_order, boot_next=boot_next,
+                                boot_current=boot_current, timeout=timeout)
 
 
 class EfibootmgrV17(Efibootmgr):
-    def run(self) -> list[str]:
-        output = subprocess_run_wrapper(["efibootmgr", "-v"]).strip().split('\n')
-        logging.debug(repr(output))
-        return output
+    command = ["efibootmgr", "-v"]
 
     @staticmethod
     def decode_params(code: str) -> str:
-        if '.' not in code:
-            return code
-        if code.endswith('.') and code.count('.') == 1:
-            return code
-        if code.startswith('WINDOWS'):
-            return 'WINDOWS' + EfibootmgrV17.decode_params(code[len('WINDOWS'):])
-        try:
-            # Decode as UTF-16 (why efibootmgr displays it like that?)
-            code_bytes = bytearray(code, 'utf-8')
-            for i, byte in enumerate(code_bytes):
-                if i % 2 == 1 and byte == ord('.'):
-                    code_bytes[i] = 0
-            decoded = code_bytes.decode('utf-16')
-            return decoded
-        except UnicodeDecodeError as e:
-            logging.warning("Could not decode '%s': %s", code, e)
-            return code
+        return classify_dotted_params(code)[1]
+
+
+class EfibootmgrV18(Efibootmgr):
+    command = ["efibootmgr", "--unicode"]
+
+
+class EfibootmgrEfivars(Efibootmgr):
+    """Reads boot variables straight from efivarfs instead of parsing efibootmgr output"""
+
+    def __init__(self, efivars_path: str = efivars.EFIVARS_PATH):
+        self.efivars_path = efivars_path
 
     @staticmethod
-    def parse_line(line: str) -> tuple[str, object]:
-        parser_logger = logging.getLogger("parser")
-        match = Efibootmgr.parse_line_regex.match(line)
-
-        if match and match.group(1) and match.group(3):
-            num, active, name, path, params = match.groups()
-            params = EfibootmgrV17.decode_params(params)
-            parsed_entry = ParsedEfibootmgrEntry(num=num, active=active is not None, name=name,
-                                                 path=path if path else '', parameters=params)
-            parser_logger.debug("Entry: %s", parsed_entry)
-            return 'entry', parsed_entry
-        if line.startswith("BootOrder"):
-            parsed = line.split(':')[1].strip().split(',')
-            parser_logger.debug("BootOrder: %s", parsed)
-            return 'boot_order', parsed
-        if line.startswith("BootNext"):
-            parsed = line.split(':')[1].strip()
-            parser_logger.debug("BootNext: %s", parsed)
-            return 'boot_next', parsed
-        if line.startswith("BootCurrent"):
-            parsed = line.split(':')[1].strip()
-            parser_logger.debug("BootCurrent: %s", parsed)
-            return 'boot_current', parsed
-        if line.startswith("Timeout"):
-            parsed = int(line.split(':')[1].split()[0].strip())
-            parser_logger.debug("Timeout: %s", parsed)
-            return 'timeout', parsed
-
-        raise ValueError("line didn't match", repr(line))
+    def is_supported(efivars_path: str = efivars.EFIVARS_PATH) -> bool:
+        # efivarfs of the host is not reachable from inside the Flatpak sandbox
+        return not is_in_flatpak() and os.path.isdir(efivars_path) and os.access(efivars_path, os.R_OK | os.X_OK)
 
+    def run(self) -> dict[str, bytes]:
+        variables = {}
+        for name in efivars.list_variables(efivars_path=self.efivars_path):
+            if efivars.is_boot_variable(name):
+                data, _ = efivars.get_variable_data(name, efivars_path=self.efivars_path)
+                if data is not None:
+                    variables[name] = data
+        return variables
 
-class EfibootmgrV18(Efibootmgr):
-    def run(self):
-        output = subprocess_run_wrapper(["efibootmgr", "--unicode"]).strip().split('\n')
-        logging.debug(repr(output))
-        return output
+    def read(self) -> ParsedEfibootmgr:
+        return self.parse(self.run())
 
     @staticmethod
-    def parse_line(line: str) -> tuple[str, object]:
-        parser_logger = logging.getLogger("parser")
-        match = Efibootmgr.parse_line_regex.match(line)
-
-        if match and match.group(1) and match.group(3):
-            num, active, name, path, params = match.groups()
-            parsed_entry = ParsedEfibootmgrEntry(num=num, active=active is not None, name=name,
-                                                 path=path if path else '', parameters=params)
-            parser_logger.debug("%s", parsed_entry)
-            return 'entry', parsed_entry
-        if line.startswith("BootOrder"):
-            parsed = line.split(':')[1].strip().split(',')
-            parser_logger.debug("BootOrder: %s", parsed)
-            return 'boot_order', parsed
-        if line.startswith("BootNext"):
-            parsed = line.split(':')[1].strip()
-            parser_logger.debug("BootNext: %s", parsed)
-            return 'boot_next', parsed
-        if line.startswith("BootCurrent"):
-            parsed = line.split(':')[1].strip()
-            parser_logger.debug("BootCurrent: %s", parsed)
-            return 'boot_current', parsed
-        if line.startswith("Timeout"):
-            parsed = int(line.split(':')[1].split()[0].strip())
-            parser_logger.debug("Timeout: %s", parsed)
-            return 'timeout', parsed
-
-        raise ValueError("line didn't match", repr(line))
+    def parse_entry(num: str, data: bytes) -> ParsedEfibootmgrEntry:
+        attributes = int.from_bytes(data[0:4], 'little')
+        name, next_field = efivars.get_load_option_description(data)
+        device_paths, next_field = efivars.get_load_option_device_path(data, next_field)
+        optional_data = efivars.get_load_option_optional_data(data, next_field)
+        return ParsedEfibootmgrEntry(num=num, active=bool(attributes & efivars.LOAD_OPTION_ACTIVE), name=name,
+                                     path=efivars.get_load_option_path(device_paths),
+                                     parameters=efivars.decode_optional_data(optional_data),
+                                     partition=efivars.get_load_option_partition(device_paths))
+
+    @classmethod
+    def parse(cls, boot: dict[str, bytes]) -> ParsedEfibootmgr:
+        def boot_num(name: str) -> str | None:
+            data = boot.get(name)
+            return efivars.format_boot_num(int.from_bytes(data[:2], 'little')) if data and len(data) >= 2 else None
+
+        entries = []
+        for name in sorted(boot):
+            if efivars.is_boot_entry_variable(name):
+                try:
+                    entries.append(cls.parse_entry(name[4:], boot[name]))
+                except (ValueError, IndexError, struct.error) as e:
+                    cls.log.warning("Could not parse %s: %s", name, e)
+
+        order = boot.get('BootOrder', b'')
+        timeout = boot.get('Timeout')
+        return ParsedEfibootmgr(
+            entries=entries,
+            boot_order=[efivars.format_boot_num(int.from_bytes(order[i:i + 2], 'little'))
+                        for i in range(0, len(order) - 1, 2)],
+            boot_next=boot_num('BootNext'),
+            boot_current=boot_num('BootCurrent'),
+            timeout=int.from_bytes(timeout[:2], 'little') if timeout else None
+        )
+
+
+class EfibootmgrNvramImage(EfibootmgrEfivars):
+    """Reads boot variables from the variable store of a firmware image, like OVMF_VARS.fd of a virtual machine"""
+
+    def __init__(self, nvram_image: str):
+        super().__init__()
+        self.nvram_image = nvram_image
+
+    def run(self) -> dict[str, bytes]:
+        return varstore.read_boot_variables(self.nvram_image)
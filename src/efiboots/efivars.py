@@ -0,0 +1,370 @@
+"""
+Read EFI variables directly from efivarfs, avoiding efibootmgr parsing pitfalls
+and the cost of spawning a process for every refresh.
+
+Nothing in here touches the file system at import time.
+"""
+import errno
+import fcntl
+import logging
+import os
+import struct
+import uuid
+
+from .devicepath import (DevicePathNode, EndInstanceNode, HardDriveNode, decode_device_path, file_path,
+                         format_device_path)
+from .utils import PartitionInfo
+
+EFIVARS_PATH = '/sys/firmware/efi/efivars'
+EFI_GLOBAL_GUID = '8be4df61-93ca-11d2-aa0d-00e098032b8c'
+
+LOAD_OPTION_ACTIVE = 0x00000001
+LOAD_OPTION_FORCE_RECONNECT = 0x00000002
+LOAD_OPTION_HIDDEN = 0x00000008
+LOAD_OPTION_CATEGORY = 0x00001F00
+
+EFI_VARIABLE_NON_VOLATILE = 0x00000001
+EFI_VARIABLE_BOOTSERVICE_ACCESS = 0x00000002
+EFI_VARIABLE_RUNTIME_ACCESS = 0x00000004
+DEFAULT_ATTRIBUTES = EFI_VARIABLE_NON_VOLATILE | EFI_VARIABLE_BOOTSERVICE_ACCESS | EFI_VARIABLE_RUNTIME_ACCESS
+
+MEDIA_DEVICE_PATH_TYPE = 0x04
+MEDIA_HARD_DRIVE_SUBTYPE = 0x01
+MEDIA_FILE_PATH_SUBTYPE = 0x04
+END_DEVICE_PATH_TYPE = 0x7f
+END_ENTIRE_DEVICE_PATH_SUBTYPE = 0xff
+
+SIGNATURE_TYPE_MBR = 0x01
+SIGNATURE_TYPE_GUID = 0x02
+PARTITION_FORMAT_MBR = 0x01
+PARTITION_FORMAT_GPT = 0x02
+
+# What optional data of a load option holds
+OPTIONAL_DATA_TEXT = 'text'
+OPTIONAL_DATA_UCS2 = 'ucs-2'
+OPTIONAL_DATA_BINARY = 'binary'
+
+# _IOR('f', 1, long) and _IOW('f', 2, long): efivarfs reads and writes an int regardless of the declared size
+FS_IOC_GETFLAGS = 0x80006601 | struct.calcsize('l') << 16
+FS_IOC_SETFLAGS = 0x40006602 | struct.calcsize('l') << 16
+FS_IMMUTABLE_FL = 0x00000010
+
+log = logging.getLogger('efivars')
+
+
+def variable_path(var_name: str, guid_str: str = EFI_GLOBAL_GUID, efivars_path: str = EFIVARS_PATH) -> str:
+    return os.path.join(efivars_path, f'{var_name}-{guid_str}')
+
+
+def get_variable_data(var_name: str, guid_str: str = EFI_GLOBAL_GUID,
+                      efivars_path: str = EFIVARS_PATH) -> tuple[bytes, int] | tuple[None, None]:
+    try:
+        with open(variable_path(var_name, guid_str, efivars_path), 'rb') as f:
+            var_data = f.read()
+    except FileNotFoundError:
+        return None, None
+    var_attributes = int.from_bytes(var_data[0:4], 'little')
+    return var_data[4:], var_attributes
+
+
+def list_variables(guid_str: str = EFI_GLOBAL_GUID, efivars_path: str = EFIVARS_PATH) -> list[str]:
+    suffix = '-' + guid_str
+    return [name[:-len(suffix)] for name in os.listdir(efivars_path) if name.endswith(suffix)]
+
+
+def get_load_option_attributes(data_bytes: bytes) -> list[str]:
+    attrs = []
+    attr = int.from_bytes(data_bytes[0:4], 'little')
+    if attr & LOAD_OPTION_ACTIVE:
+        attrs.append('active')
+    if attr & LOAD_OPTION_FORCE_RECONNECT:
+        attrs.append('force reconnect')
+    if attr & LOAD_OPTION_HIDDEN:
+        attrs.append('hidden')
+    if attr & LOAD_OPTION_CATEGORY:
+        attrs.append('category')
+    return attrs
+
+
+def get_load_option_description(data_bytes: bytes) -> tuple[str, int]:
+    # The description is a NUL terminated UCS-2 string: look for the terminator on 2 bytes boundaries only
+    desc_end = 6
+    while desc_end + 1 < len(data_bytes) and data_bytes[desc_end:desc_end + 2] != b'\x00\x00':
+        desc_end += 2
+    desc = data_bytes[6:desc_end].decode('utf-16-le', errors='replace')
+    return desc, desc_end + 2
+
+
+def get_load_option_device_path(data_bytes: bytes, start_byte: int) -> tuple[list[DevicePathNode], int]:
+    file_path_list_length = int.from_bytes(data_bytes[4:6], 'little')
+    end = min(start_byte + file_path_list_length, len(data_bytes))
+    return decode_device_path(data_bytes, start_byte, end), end
+
+
+def get_load_option_optional_data(data_bytes: bytes, start_byte: int) -> bytes:
+    return data_bytes[start_byte:]
+
+
+def classify_optional_data(optional_bytes: bytes) -> tuple[str, str]:
+    """Tells whether optional data is UCS-2 text, plain ASCII text or opaque binary.
+    Returns the kind and the text, which is empty for binary data."""
+    optional_bytes = bytes(optional_bytes)
+    if not optional_bytes:
+        return OPTIONAL_DATA_TEXT, ''
+    if len(optional_bytes) % 2 == 0:
+        if not optional_bytes[1::2].strip(b'\x00'):
+            # Every high byte is zero: the common Latin-1 command line, no need for the UTF-16 codec
+            text = optional_bytes[0::2].decode('latin-1').rstrip('\x00')
+            if text.isprintable():
+                return OPTIONAL_DATA_UCS2, text
+        else:
+            try:
+                text = optional_bytes.decode('utf-16-le').rstrip('\x00')
+                if text.isprintable():
+                    return OPTIONAL_DATA_UCS2, text
+            except UnicodeDecodeError:
+                pass
+    text = optional_bytes.decode('latin-1').rstrip('\x00')
+    if text.isascii() and text.isprintable():
+        return OPTIONAL_DATA_TEXT, text
+    return OPTIONAL_DATA_BINARY, ''
+
+
+def decode_optional_data(optional_bytes: bytes) -> str:
+    """Decodes optional data the way efibootmgr --unicode shows it: as UCS-2 text, if it looks like text."""
+    kind, text = classify_optional_data(optional_bytes)
+    if kind == OPTIONAL_DATA_BINARY:
+        log.debug("Ignoring binary optional data %r", optional_bytes)
+    return text
+
+
+def get_load_option_path(device_paths: list[DevicePathNode]) -> str:
+    return file_path(device_paths)
+
+
+def get_load_option_partition(device_paths: list[DevicePathNode]) -> PartitionInfo | None:
+    """The partition the first HD() node points to, the inverse of make_esp_device_path"""
+    for node in device_paths:
+        if isinstance(node, EndInstanceNode):
+            break
+        if isinstance(node, HardDriveNode):
+            if node.signature_type == SIGNATURE_TYPE_GUID:
+                return PartitionInfo(node.partition, node.start, node.size, str(node.signature), 'gpt')
+            if node.signature_type == SIGNATURE_TYPE_MBR:
+                return PartitionInfo(node.partition, node.start, node.size,
+                                     mbr_part_uuid(node.signature, node.partition), 'dos')
+            return None
+    return None
+
+
+def format_boot_num(num: int) -> str:
+    return f'{num:04X}'
+
+
+def get_boot_current(efivars_path: str = EFIVARS_PATH) -> str | None:
+    data, _ = get_variable_data('BootCurrent', efivars_path=efivars_path)
+    if data:
+        return format_boot_num(int.from_bytes(data[:2], 'little'))
+    return None
+
+
+def get_boot_next(efivars_path: str = EFIVARS_PATH) -> str | None:
+    data, _ = get_variable_data('BootNext', efivars_path=efivars_path)
+    if data:
+        return format_boot_num(int.from_bytes(data[:2], 'little'))
+    return None
+
+
+def decode_boot_order(data: bytes | None) -> list[str]:
+    if not data:
+        return []
+    values = len(data) // 2
+    return [format_boot_num(o) for o in struct.unpack(f'<{values}H', data[:values * 2])]
+
+
+def get_boot_order(efivars_path: str = EFIVARS_PATH) -> list[str]:
+    data, _ = get_variable_data('BootOrder', efivars_path=efivars_path)
+    return decode_boot_order(data)
+
+
+def get_timeout(efivars_path: str = EFIVARS_PATH) -> int | None:
+    data, _ = get_variable_data('Timeout', efivars_path=efivars_path)
+    if data:
+        return int.from_bytes(data[:2], 'little')
+    return None
+
+
+def is_boot_entry_variable(var_name: str) -> bool:
+    if len(var_name) != 8 or not var_name.startswith('Boot'):
+        return False
+    return all(c in '0123456789ABCDEF' for c in var_name[4:])
+
+
+def is_boot_variable(var_name: str) -> bool:
+    """Whether the variable is one of those making up the boot configuration"""
+    return var_name in ('BootCurrent', 'BootNext', 'BootOrder', 'Timeout') or is_boot_entry_variable(var_name)
+
+
+def make_device_path_node(device_type: int, device_sub: int, payload: bytes) -> bytes:
+    return struct.pack('<BBH', device_type, device_sub, len(payload) + 4) + payload
+
+
+def make_hard_drive_node(part_num: int, start: int, size: int, signature: uuid.UUID | int,
+                         partition_format: int = PARTITION_FORMAT_GPT) -> bytes:
+    """start and size are in logical blocks, signature is the partition GUID (GPT) or the disk signature (MBR)"""
+    if partition_format == PARTITION_FORMAT_GPT:
+        sig_bytes, sig_type = signature.bytes_le, SIGNATURE_TYPE_GUID
+    else:
+        sig_bytes, sig_type = struct.pack('<I12x', signature), SIGNATURE_TYPE_MBR
+    return make_device_path_node(MEDIA_DEVICE_PATH_TYPE, MEDIA_HARD_DRIVE_SUBTYPE,
+                                 struct.pack('<IQQ16sBB', part_num, start, size, sig_bytes, partition_format, sig_type))
+
+
+def make_file_path_node(path: str) -> bytes:
+    return make_device_path_node(MEDIA_DEVICE_PATH_TYPE, MEDIA_FILE_PATH_SUBTYPE, (path + '\0').encode('utf-16-le'))
+
+
+def make_end_node() -> bytes:
+    return make_device_path_node(END_DEVICE_PATH_TYPE, END_ENTIRE_DEVICE_PATH_SUBTYPE, b'')
+
+
+def make_device_path(*nodes: bytes) -> bytes:
+    return b''.join(nodes) + make_end_node()
+
+
+def encode_optional_data(parameters: str) -> bytes:
+    """Encodes loader parameters as UCS-2, like efibootmgr --unicode does"""
+    return parameters.encode('utf-16-le')
+
+
+def mbr_part_uuid(signature: int, part_num: int) -> str:
+    """The PARTUUID Linux gives to partition part_num of an MBR disk"""
+    return f'{signature:08x}-{part_num:02x}'
+
+
+def make_esp_device_path(partition: PartitionInfo, loader: str) -> bytes:
+    """HD(...)/File(loader) device path, as efibootmgr --create builds it"""
+    if partition.scheme == 'gpt':
+        hd = make_hard_drive_node(partition.number, partition.start, partition.size, uuid.UUID(partition.part_uuid))
+    else:
+        # MBR PARTUUIDs are made of the disk signature followed by the partition number
+        signature = int(partition.part_uuid.split('-')[0], 16)
+        hd = make_hard_drive_node(partition.number, partition.start, partition.size, signature, PARTITION_FORMAT_MBR)
+    return make_device_path(hd, make_file_path_node(loader))
+
+
+def make_load_option(attributes: int, description: str, device_path: bytes, optional_data: bytes = b'') -> bytes:
+    """Builds an EFI_LOAD_OPTION, the inverse of the get_load_option_* decoders"""
+    return struct.pack('<IH', attributes, len(device_path)) + (description + '\0').encode('utf-16-le') + \
+        device_path + optional_data
+
+
+def set_load_option_active(data_bytes: bytes, active: bool) -> bytes:
+    attributes = int.from_bytes(data_bytes[0:4], 'little')
+    if active:
+        attributes |= LOAD_OPTION_ACTIVE
+    else:
+        attributes &= ~LOAD_OPTION_ACTIVE
+    return struct.pack('<I', attributes) + data_bytes[4:]
+
+
+class EfivarsWriter:
+    """Writes boot variables straight to efivarfs. Needs root privileges on a real system."""
+
+    def __init__(self, efivars_path: str = EFIVARS_PATH):
+        self.efivars_path = efivars_path
+
+    def path(self, var_name: str) -> str:
+        return variable_path(var_name, efivars_path=self.efivars_path)
+
+    def read_variable(self, var_name: str) -> tuple[bytes, int] | tuple[None, None]:
+        return get_variable_data(var_name, efivars_path=self.efivars_path)
+
+    def list_variables(self) -> list[str]:
+        return list_variables(efivars_path=self.efivars_path)
+
+    def get_boot_order(self) -> list[str]:
+        return decode_boot_order(self.read_variable('BootOrder')[0])
+
+    @staticmethod
+    def _clear_immutable(path: str):
+        # efivarfs marks most variables immutable to protect them from careless rm; lift it before touching them
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            flags = bytearray(4)
+            fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags)
+            value = int.from_bytes(flags, 'little')
+            if value & FS_IMMUTABLE_FL:
+                fcntl.ioctl(fd, FS_IOC_SETFLAGS, (value & ~FS_IMMUTABLE_FL).to_bytes(4, 'little'))
+        except OSError as e:
+            # Plain file systems (as used by tests) may not support inode flags at all
+            if e.errno not in (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+        finally:
+            os.close(fd)
+
+    def write_variable(self, var_name: str, data: bytes, attributes: int = DEFAULT_ATTRIBUTES) -> bool:
+        """Writes the variable unless it already holds data with the same attributes. Returns whether it wrote.
+
+        Reading is cheap, while every SetVariable wears flash and can take 100 ms on some firmware.
+        """
+        if self.read_variable(var_name) == (data, attributes):
+            log.debug("%s unchanged, not writing it", var_name)
+            return False
+        path = self.path(var_name)
+        self._clear_immutable(path)
+        # efivarfs requires attributes and data to be written with a single write() call
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            written = os.write(fd, struct.pack('<I', attributes) + data)
+            # A write replaces the whole variable on efivarfs, not in a plain directory standing in for it
+            if os.fstat(fd).st_size > written:
+                os.ftruncate(fd, written)
+        finally:
+            os.close(fd)
+        log.debug("Wrote %s (%d bytes)", var_name, len(data))
+        return True
+
+    def delete_variable(self, var_name: str):
+        path = self.path(var_name)
+        self._clear_immutable(path)
+        try:
+            os.unlink(path)
+            log.debug("Deleted %s", var_name)
+        except FileNotFoundError:
+            pass
+
+    def set_boot_order(self, boot_order: list[str]):
+        self.write_variable('BootOrder', struct.pack(f'<{len(boot_order)}H', *(int(n, 16) for n in boot_order)))
+
+    def set_boot_next(self, boot_next: str | None):
+        if boot_next is None:
+            self.delete_variable('BootNext')
+        else:
+            self.write_variable('BootNext', struct.pack('<H', int(boot_next, 16)))
+
+    def set_timeout(self, timeout: int):
+        self.write_variable('Timeout', struct.pack('<H', timeout))
+
+    def write_load_option(self, num: str, data: bytes):
+        self.write_variable(f'Boot{num}', data)
+
+    def delete_load_option(self, num: str):
+        self.delete_variable(f'Boot{num}')
+
+    def set_active(self, num: str, active: bool):
+        data, attributes = self.read_variable(f'Boot{num}')
+        if data is None:
+            raise FileNotFoundError(errno.ENOENT, "No such boot entry", f'Boot{num}')
+        self.write_variable(f'Boot{num}', set_load_option_active(data, active), attributes)
+
+    def free_boot_num(self, taken: set[str] = frozenset()) -> str:
+        """Lowest unused boot number, like efibootmgr --create picks it"""
+        used = {v[4:] for v in self.list_variables() if is_boot_entry_variable(v)} | set(taken)
+        for num in range(0x10000):
+            if format_boot_num(num) not in used:
+                return format_boot_num(num)
+        raise OSError(errno.ENOSPC, "No free boot entry number")
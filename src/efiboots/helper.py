@@ -0,0 +1,247 @@
+"""
+Privileged helper exposing typed NVRAM operations on the system bus.
+
+It is D-Bus activated on demand, authorizes each client once through polkit, keeps that authorization until
+the client disconnects and exits after a period of inactivity. Use --session to run a stand-in on the session
+bus (without polkit) for testing.
+"""
+import argparse
+import logging
+import sys
+
+from gi.repository import Gio, GLib
+
+from . import efivars
+from .plan import ChangePlan, PlanError, PlanStep, PlanReport, execute_plan, privileged_plan_from_json, \
+    report_from_json
+
+BUS_NAME = 'ovh.elinvention.Efiboots.Helper'
+OBJECT_PATH = '/ovh/elinvention/Efiboots/Helper'
+INTERFACE_NAME = 'ovh.elinvention.Efiboots.Helper1'
+POLKIT_ACTION_ID = 'ovh.elinvention.Efiboots.modify'
+ERROR_NOT_AUTHORIZED = INTERFACE_NAME + '.Error.NotAuthorized'
+ERROR_FAILED = INTERFACE_NAME + '.Error.Failed'
+IDLE_TIMEOUT = 60
+
+INTROSPECTION_XML = f'''
+<node>
+  <interface name="{INTERFACE_NAME}">
+    <method name="ApplyPlan">
+      <arg type="s" name="plan" direction="in"/>
+      <arg type="s" name="report" direction="out"/>
+    </method>
+    <method name="SetBootOrder">
+      <arg type="as" name="boot_order" direction="in"/>
+    </method>
+    <method name="SetBootNext">
+      <arg type="s" name="num" direction="in"/>
+    </method>
+    <method name="SetTimeout">
+      <arg type="q" name="timeout" direction="in"/>
+    </method>
+    <method name="SetActive">
+      <arg type="s" name="num" direction="in"/>
+      <arg type="b" name="active" direction="in"/>
+    </method>
+    <method name="CreateEntry">
+      <arg type="s" name="disk" direction="in"/>
+      <arg type="s" name="part" direction="in"/>
+      <arg type="s" name="label" direction="in"/>
+      <arg type="s" name="loader" direction="in"/>
+      <arg type="s" name="parameters" direction="in"/>
+      <arg type="s" name="num" direction="out"/>
+    </method>
+    <method name="DeleteEntry">
+      <arg type="s" name="num" direction="in"/>
+    </method>
+  </interface>
+</node>
+'''
+
+log = logging.getLogger('helper')
+
+
+class EfibootsHelper:
+    def __init__(self, loop: GLib.MainLoop, use_polkit: bool = True, efivars_path: str = efivars.EFIVARS_PATH,
+                 idle_timeout: int = IDLE_TIMEOUT):
+        self.loop = loop
+        self.use_polkit = use_polkit
+        self.efivars_path = efivars_path
+        self.idle_timeout = idle_timeout
+        self.authorized_clients: set[str] = set()
+        self.pending_calls = 0
+        self._idle_source = None
+        self.reset_idle_timer()
+
+    def reset_idle_timer(self):
+        if self._idle_source is not None:
+            GLib.source_remove(self._idle_source)
+        self._idle_source = GLib.timeout_add_seconds(self.idle_timeout, self.on_idle_timeout)
+
+    def on_idle_timeout(self):
+        self._idle_source = None
+        if self.pending_calls:
+            self.reset_idle_timer()
+        else:
+            log.info("No requests in %d seconds, exiting", self.idle_timeout)
+            self.loop.quit()
+        return GLib.SOURCE_REMOVE
+
+    def on_bus_acquired(self, connection: Gio.DBusConnection, name: str):
+        node_info = Gio.DBusNodeInfo.new_for_xml(INTROSPECTION_XML)
+        connection.register_object(OBJECT_PATH, node_info.interfaces[0], self.on_method_call, None, None)
+        # Unique names are never reused: forget a client's authorization as soon as it disconnects
+        connection.signal_subscribe('org.freedesktop.DBus', 'org.freedesktop.DBus', 'NameOwnerChanged',
+                                    '/org/freedesktop/DBus', None, Gio.DBusSignalFlags.NONE,
+                                    self.on_name_owner_changed)
+
+    def on_name_owner_changed(self, connection, sender, path, interface, signal, parameters):
+        name, old_owner, new_owner = parameters.unpack()
+        if not new_owner:
+            self.authorized_clients.discard(name)
+
+    def on_method_call(self, connection: Gio.DBusConnection, sender: str, object_path: str, interface_name: str,
+                       method_name: str, parameters: GLib.Variant, invocation: Gio.DBusMethodInvocation):
+        self.reset_idle_timer()
+        if not self.use_polkit or sender in self.authorized_clients:
+            self.dispatch(method_name, parameters.unpack(), invocation)
+            return
+
+        def on_authorization(conn: Gio.DBusConnection, result: Gio.AsyncResult):
+            self.pending_calls -= 1
+            try:
+                (is_authorized, _, _), = conn.call_finish(result).unpack()
+            except GLib.Error as e:
+                log.warning("polkit authorization failed: %s", e.message)
+                is_authorized = False
+            if is_authorized:
+                self.authorized_clients.add(sender)
+                self.dispatch(method_name, parameters.unpack(), invocation)
+            else:
+                invocation.return_dbus_error(ERROR_NOT_AUTHORIZED, f"{sender} is not authorized to modify EFI variables")
+
+        self.pending_calls += 1
+        subject = ('system-bus-name', {'name': GLib.Variant('s', sender)})
+        connection.call('org.freedesktop.PolicyKit1', '/org/freedesktop/PolicyKit1/Authority',
+                        'org.freedesktop.PolicyKit1.Authority', 'CheckAuthorization',
+                        GLib.Variant('((sa{sv})sa{ss}us)', (subject, POLKIT_ACTION_ID, {}, 1, '')),
+                        GLib.VariantType('((bba{ss}))'), Gio.DBusCallFlags.NONE, GLib.MAXINT, None,
+                        on_authorization)
+
+    def run_plan(self, plan: ChangePlan) -> PlanReport:
+        report = execute_plan(plan, self.efivars_path)
+        log.info("%s:\n%s", 'Applied' if report.ok else 'Failed', report)
+        return report
+
+    def run_steps(self, *steps: PlanStep, disk: str = '', part: str = ''):
+        plan = ChangePlan(disk, part, list(steps), native=True)
+        plan.validate()
+        report = self.run_plan(plan)
+        if not report.ok:
+            raise PlanError(report)
+
+    def boot_entries(self) -> set[str]:
+        return {v for v in efivars.list_variables(efivars_path=self.efivars_path) if efivars.is_boot_entry_variable(v)}
+
+    def dispatch(self, method_name: str, args: tuple, invocation: Gio.DBusMethodInvocation):
+        try:
+            match method_name:
+                case 'ApplyPlan':
+                    report = self.run_plan(privileged_plan_from_json(args[0]))
+                    invocation.return_value(GLib.Variant('(s)', (report.to_json(),)))
+                    return
+                case 'SetBootOrder':
+                    self.run_steps(PlanStep('boot_order', boot_order=list(args[0])))
+                case 'SetBootNext':
+                    self.run_steps(PlanStep('boot_next', num=args[0]) if args[0] else PlanStep('delete_boot_next'))
+                case 'SetTimeout':
+                    self.run_steps(PlanStep('timeout', timeout=args[0]))
+                case 'SetActive':
+                    self.run_steps(PlanStep('active' if args[1] else 'inactive', num=args[0]))
+                case 'CreateEntry':
+                    disk, part, label, loader, parameters = args
+                    before = self.boot_entries()
+                    self.run_steps(PlanStep('create', label=label, loader=loader, parameters=parameters),
+                                   disk=disk, part=part)
+                    created = sorted(self.boot_entries() - before)
+                    invocation.return_value(GLib.Variant('(s)', (created[0][4:] if created else '',)))
+                    return
+                case 'DeleteEntry':
+                    self.run_steps(PlanStep('delete', num=args[0]))
+            invocation.return_value(None)
+        except PlanError as e:
+            invocation.return_dbus_error(ERROR_FAILED, str(e.report))
+        except (ValueError, KeyError, TypeError) as e:
+            invocation.return_dbus_error(ERROR_FAILED, str(e))
+
+
+class HelperClient:
+    """Talks to the helper, D-Bus activating it if needed"""
+
+    def __init__(self, bus_type: Gio.BusType = Gio.BusType.SYSTEM):
+        self.proxy = Gio.DBusProxy.new_for_bus_sync(
+            bus_type, Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES | Gio.DBusProxyFlags.DO_NOT_CONNECT_SIGNALS,
+            None, BUS_NAME, OBJECT_PATH, INTERFACE_NAME, None)
+
+    @staticmethod
+    def is_unavailable(e: GLib.Error) -> bool:
+        """Whether the helper is not installed, in which case callers should fall back to pkexec"""
+        return Gio.DBusError.get_remote_error(e) in ('org.freedesktop.DBus.Error.ServiceUnknown',
+                                                     'org.freedesktop.DBus.Error.AccessDenied')
+
+    def call(self, method_name: str, signature: str | None = None, *args):
+        parameters = GLib.Variant(f'({signature})', args) if signature else None
+        # Authorization may wait for the user to type a password: don't time out
+        return self.proxy.call_sync(method_name, parameters, Gio.DBusCallFlags.ALLOW_INTERACTIVE_AUTHORIZATION,
+                                    GLib.MAXINT, None).unpack()
+
+    def apply_plan(self, plan: ChangePlan) -> PlanReport:
+        report = report_from_json(self.call('ApplyPlan', 's', plan.to_json())[0])
+        if not report.ok:
+            raise PlanError(report)
+        return report
+
+    def set_boot_order(self, boot_order: list[str]):
+        self.call('SetBootOrder', 'as', boot_order)
+
+    def set_boot_next(self, num: str | None):
+        self.call('SetBootNext', 's', num or '')
+
+    def set_timeout(self, timeout: int):
+        self.call('SetTimeout', 'q', timeout)
+
+    def set_active(self, num: str, active: bool):
+        self.call('SetActive', 'sb', num, active)
+
+    def create_entry(self, disk: str, part: str, label: str, loader: str, parameters: str) -> str:
+        return self.call('CreateEntry', 'sssss', disk, part, label, loader, parameters)[0]
+
+    def delete_entry(self, num: str):
+        self.call('DeleteEntry', 's', num)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Efiboots privileged helper")
+    parser.add_argument('--session', action='store_true', help="own the name on the session bus, without polkit")
+    parser.add_argument('--efivars', default=efivars.EFIVARS_PATH, help="efivarfs mount point")
+    parser.add_argument('--idle-timeout', type=int, default=IDLE_TIMEOUT, help="exit after this many idle seconds")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    loop = GLib.MainLoop()
+    helper = EfibootsHelper(loop, use_polkit=not args.session, efivars_path=args.efivars,
+                            idle_timeout=args.idle_timeout)
+
+    def on_name_lost(connection, name):
+        log.error("Could not own %s", name)
+        loop.quit()
+
+    owner_id = Gio.bus_own_name(Gio.BusType.SESSION if args.session else Gio.BusType.SYSTEM, BUS_NAME,
+                                Gio.BusNameOwnerFlags.NONE, helper.on_bus_acquired, None, on_name_lost)
+    loop.run()
+    Gio.bus_unown_name(owner_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Long-lived shell on the host for Flatpak: it is spawned once with flatpak-spawn --host, instead of once per command,
+then runs the commands it is sent over a pipe one after another, sending back their exit status and output.
+
+The host has neither our interpreter nor our package, so the helper is a POSIX shell script passed on the command
+line. Outside Flatpak, HostHelper(prefix=()) runs it as a plain subprocess, which is how tests exercise it.
+"""
+import atexit
+import logging
+import shlex
+import subprocess
+import threading
+
+FLATPAK_SPAWN = ('flatpak-spawn', '--host')
+# Requests are written ahead of reading the responses up to this many bytes, well within a pipe buffer: the helper
+# blocks on writing a response nobody reads yet, so it would stop reading requests
+BATCH_BYTES = 32 * 1024
+
+# Request: "<stdin length> <shell quoted command>\n" followed by stdin.
+# Response: "<exit status> <stdout length> <stderr length>\n" followed by stdout and stderr.
+HELPER_SCRIPT = r'''
+in=$(mktemp) && out=$(mktemp) && err=$(mktemp) || exit 1
+trap 'rm -f "$in" "$out" "$err"' EXIT
+while IFS= read -r request; do
+    length=${request%% *}
+    command=${request#* }
+    # Take all of stdin first, whether the command reads it or not
+    if [ "$length" -gt 0 ]; then
+        head -c "$length" >"$in"
+    else
+        : >"$in"
+    fi
+    # In a subshell, so that no command can change or end the helper itself
+    (eval "$command") <"$in" >"$out" 2>"$err"
+    status=$?
+    set -- $(wc -c "$out" "$err")
+    printf '%d %d %d\n' "$status" "$1" "$3"
+    cat "$out" "$err"
+done
+'''
+
+log = logging.getLogger('host')
+
+
+class HostHelperError(OSError):
+    """The helper could not be started or went away. sent tells whether a request reached it, in which case its
+    command may have run."""
+
+    def __init__(self, message: str, sent: bool = True):
+        super().__init__(message)
+        self.sent = sent
+
+
+class HostHelper:
+    def __init__(self, prefix=FLATPAK_SPAWN):
+        self.prefix = list(prefix)
+        self._process: subprocess.Popen | None = None
+        self._lock = threading.Lock()
+        self.broken = False
+
+    def _start(self) -> subprocess.Popen:
+        if self._process is None or self._process.poll() is not None:
+            log.debug("Starting host helper: %s", shlex.join(self.prefix + ['sh', '-c', '...']))
+            try:
+                self._process = subprocess.Popen(self.prefix + ['sh', '-c', HELPER_SCRIPT],
+                                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            except OSError as e:
+                raise HostHelperError(f"Could not start the host helper: {e}", sent=False) from e
+        return self._process
+
+    def _read(self, size: int) -> bytes:
+        data = self._process.stdout.read(size)
+        if len(data) != size:
+            raise HostHelperError("The host helper exited")
+        return data
+
+    def run_batch(self, requests: list[tuple[list[str], str | None]]) -> list[subprocess.CompletedProcess]:
+        """Runs the commands, each with its stdin text, in order. Their output is decoded as UTF-8."""
+        results = []
+        with self._lock:
+            process = self._start()
+            pending = []
+            written = 0
+            sent = False
+            try:
+                for i, (cmd, input) in enumerate(requests):
+                    data = (input or '').encode()
+                    request = f'{len(data)} {shlex.join(cmd)}\n'.encode() + data
+                    try:
+                        process.stdin.write(request)
+                        pending.append(cmd)
+                        written += len(request)
+                        if written < BATCH_BYTES and i + 1 < len(requests):
+                            continue
+                        process.stdin.flush()
+                    except OSError as e:
+                        # The helper is gone before it could read the whole request
+                        raise HostHelperError(f"Lost the host helper: {e}", sent=sent) from e
+                    sent = True
+                    for pending_cmd in pending:
+                        header = process.stdout.readline().split()
+                        if len(header) != 3:
+                            raise HostHelperError("The host helper exited")
+                        status, stdout_length, stderr_length = map(int, header)
+                        stdout = self._read(stdout_length).decode(errors='replace')
+                        stderr = self._read(stderr_length).decode(errors='replace')
+                        results.append(subprocess.CompletedProcess(pending_cmd, status, stdout, stderr))
+                    pending = []
+                    written = 0
+            except (OSError, ValueError) as e:
+                self._kill()
+                if isinstance(e, HostHelperError):
+                    raise
+                raise HostHelperError(f"Lost the host helper: {e}") from e
+        return results
+
+    def run(self, cmd: list[str], input: str | None = None) -> subprocess.CompletedProcess:
+        """Runs cmd through the helper, or with a one-off spawn if the helper can't take it. Raises HostHelperError
+        if the helper went away after it was sent cmd: running it again could apply a change twice."""
+        if not self.broken and not any('\n' in arg for arg in cmd):
+            try:
+                return self.run_batch([(cmd, input)])[0]
+            except HostHelperError as e:
+                if e.sent:
+                    raise
+                # Don't keep paying for a helper that doesn't work
+                log.warning("%s: spawning commands one by one from now on", e)
+                self.broken = True
+        return subprocess.run(self.prefix + cmd, capture_output=True, text=True, input=input)
+
+    def _kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def close(self):
+        """Lets the helper finish and exit"""
+        with self._lock:
+            if self._process is not None:
+                try:
+                    self._process.stdin.close()
+                    self._process.wait(timeout=5)
+                except (OSError, subprocess.TimeoutExpired):
+                    self._process.kill()
+                self._process = None
+
+
+_host_helper: HostHelper | None = None
+_host_helper_lock = threading.Lock()
+
+
+def get_host_helper() -> HostHelper:
+    """The helper of this process, started on first use and closed at exit"""
+    global _host_helper
+    with _host_helper_lock:
+        if _host_helper is None:
+            _host_helper = HostHelper()
+            atexit.register(_host_helper.close)
+        return _host_helper
@@ -0,0 +1,107 @@
+"""
+Checks that the loader of each boot entry is still on its ESP, which is what breaks booting after an OS is
+reinstalled or removed. Paths are looked up ignoring case, like FAT and the firmware do.
+
+Results are cached along with the file, or the deepest directory that exists when the file is missing: as long as
+its modification time and inode stay the same a check costs a single stat, so that a refresh only walks the ESP for
+entries whose files changed.
+"""
+import logging
+import os
+import stat
+import threading
+from dataclasses import dataclass
+
+LOADER_FOUND = 'found'
+LOADER_EMPTY = 'empty'
+LOADER_MISSING = 'missing'
+# The partition of the entry is not mounted, so there is nothing to look at
+LOADER_UNMOUNTED = 'unmounted'
+
+log = logging.getLogger('loadercheck')
+
+
+@dataclass(frozen=True)
+class LoaderCheck:
+    status: str  # one of LOADER_*
+    path: str | None = None  # where the loader is, with the case it has on the ESP
+    size: int | None = None
+
+
+def split_loader_path(loader: str) -> list[str]:
+    r"""Components of a loader path like \EFI\BOOT\BOOTX64.EFI, without the empty ones of doubled backslashes"""
+    return [name for name in loader.replace('/', '\\').split('\\') if name]
+
+
+def stamp(path: str) -> tuple[str, int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return path, st.st_mtime_ns, st.st_ino
+
+
+class LoaderChecker:
+    """Safe to use from several threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # directory -> ((mtime, inode), casefolded name -> name)
+        self._listings: dict[str, tuple[tuple[int, int], dict[str, str]]] = {}
+        # (mount point, loader) -> ((path, mtime, inode) it depends on, result)
+        self._results: dict[tuple[str, str], tuple[tuple[str, int, int], LoaderCheck]] = {}
+
+    def _find(self, directory: str, name: str) -> str | None:
+        """The name in directory that matches name ignoring case"""
+        try:
+            st = os.stat(directory)
+        except OSError:
+            return None
+        directory_stamp = st.st_mtime_ns, st.st_ino
+        listing = self._listings.get(directory)
+        if listing is None or listing[0] != directory_stamp:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                return None
+            listing = directory_stamp, {entry.casefold(): entry for entry in names}
+            self._listings[directory] = listing
+        return listing[1].get(name.casefold())
+
+    def _walk(self, mount_point: str, components: list[str]) -> tuple[LoaderCheck, tuple[str, int, int] | None]:
+        path = mount_point
+        for name in components:
+            found = self._find(path, name)
+            if found is None:
+                # Creating what is missing changes the deepest directory that exists
+                return LoaderCheck(LOADER_MISSING), stamp(path)
+            path = os.path.join(path, found)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return LoaderCheck(LOADER_MISSING), None
+        if not stat.S_ISREG(st.st_mode):
+            return LoaderCheck(LOADER_MISSING), (path, st.st_mtime_ns, st.st_ino)
+        status = LOADER_FOUND if st.st_size else LOADER_EMPTY
+        return LoaderCheck(status, path, st.st_size), (path, st.st_mtime_ns, st.st_ino)
+
+    def check(self, mount_point: str | None, loader: str) -> LoaderCheck | None:
+        """Looks loader up on the ESP mounted at mount_point. None for entries without a loader file, like network
+        or BBS ones."""
+        components = split_loader_path(loader)
+        if not components:
+            return None
+        if mount_point is None:
+            return LoaderCheck(LOADER_UNMOUNTED)
+        key = mount_point, loader
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and stamp(cached[0][0]) == cached[0]:
+                return cached[1]
+            result, depends_on = self._walk(mount_point, components)
+            if depends_on is not None:
+                self._results[key] = depends_on, result
+            else:
+                self._results.pop(key, None)
+            log.debug("%s on %s: %s", loader, mount_point, result.status)
+            return result
@@ -19,12 +19,17 @@
 
 
 import logging
+import os
 import gi
 import sys
 
 gi.require_version('Gtk', '4.0')
 from gi.repository import Gtk, Gio, GLib
 
+from .profile import startup_profile
+
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
 
 class EfibootsApplication(Gtk.Application):
     def __init__(self, version: str, *args, **kwargs):
@@ -54,14 +59,59 @@ class EfibootsApplication(Gtk.Application):
             "Partition number of ESP (for example if ESP is on /dev/sda1 you should set this to 1)",
             None,
         )
+        self.add_main_option(
+            "backend",
+            ord("b"),
+            GLib.OptionFlags.NONE,
+            GLib.OptionArg.STRING,
+            "How to read boot entries: efivars (read efivarfs directly) or efibootmgr. Default: efivars when available",
+            None,
+        )
+        self.add_main_option(
+            "nvram-image",
+            ord("i"),
+            GLib.OptionFlags.NONE,
+            GLib.OptionArg.FILENAME,
+            "Read and change the variable store of a firmware image, like OVMF_VARS.fd of a virtual machine",
+            "PATH",
+        )
+        self.add_main_option(
+            "log-level",
+            ord("l"),
+            GLib.OptionFlags.NONE,
+            GLib.OptionArg.STRING,
+            "Log messages of this level or above: debug, info, warning or error. Default: warning",
+            None,
+        )
+        self.add_main_option(
+            "profile-startup",
+            0,
+            GLib.OptionFlags.NONE,
+            GLib.OptionArg.NONE,
+            "Print how long each startup phase took, up to the first frame showing the boot entries",
+            None,
+        )
 
         self.disk = ""
         self.part = ""
+        self.backend = None
+        self.nvram_image = None
 
     def resource_path(self, relpath):
         base_path = self.get_resource_base_path()
         return base_path + '/' + relpath
 
+    def do_handle_local_options(self, options: GLib.VariantDict) -> int:
+        # Runs before startup, so that logging is configured before anything logs
+        level = options.lookup_value("log-level", GLib.VariantType("s"))
+        level = level.unpack().lower() if level else 'warning'
+        if level not in LOG_LEVELS:
+            print(f"Unknown log level {level}: use one of {', '.join(LOG_LEVELS)}", file=sys.stderr)
+            return 1
+        logging.basicConfig(level=getattr(logging, level.upper()))
+        startup_profile.enabled = options.contains("profile-startup")
+        return -1
+
     def do_startup(self):
         logging.info("Welcome to Efiboots %s", self.APP_VERSION)
         Gtk.Application.do_startup(self)
@@ -69,12 +119,17 @@ class EfibootsApplication(Gtk.Application):
         action = Gio.SimpleAction.new("quit", None)
         action.connect("activate", self.on_quit)
         self.add_action(action)
+        self.set_accels_for_action("win.undo", ["<Control>z"])
+        self.set_accels_for_action("win.redo", ["<Control><Shift>z", "<Control>y"])
+        self.set_accels_for_action("win.move-top", ["<Alt>Home"])
+        self.set_accels_for_action("win.move-bottom", ["<Alt>End"])
 
         logging.debug("resource base path: %s", self.get_resource_base_path())
         menus_builder = Gtk.Builder.new_from_resource(self.resource_path("gtk/menus.ui"))
 
         logging.debug("app-menu: %s", self.get_menu_by_id("app-menu"))
         self.set_menubar(menus_builder.get_object("app-menu"))
+        startup_profile.mark('application startup')
 
     def do_activate(self):
         # We only allow a single window and raise any existing ones
@@ -82,7 +137,9 @@ class EfibootsApplication(Gtk.Application):
             # Windows are associated with the application
             # when the last one is closed the application shuts down
             from .window import EfibootsMainWindow
+            startup_profile.mark('import window')
             self.window = EfibootsMainWindow(application=self)
+            startup_profile.mark('window template init')
 
         self.window.query_system(self.disk, self.part)
         self.window.present()
@@ -98,6 +155,13 @@ class EfibootsApplication(Gtk.Application):
         if "part" in options:
             self.part = options["part"]
             logging.debug("Found part from command line: %s", self.part)
+        if "backend" in options:
+            self.backend = options["backend"]
+            logging.debug("Found backend from command line: %s", self.backend)
+        if "nvram-image" in options:
+            # FILENAME options come as NUL terminated bytes
+            self.nvram_image = os.fsdecode(bytes(options["nvram-image"]).rstrip(b'\0'))
+            logging.debug("Found NVRAM image from command line: %s", self.nvram_image)
 
         self.activate()
         return 0
@@ -107,8 +171,6 @@ class EfibootsApplication(Gtk.Application):
 
 
 def main(version):
-    logging.basicConfig(level=logging.DEBUG)
-
     app = EfibootsApplication(version)
     app.run(sys.argv)
 
@@ -0,0 +1,416 @@
+"""
+Structured change plans: what Save is going to write to NVRAM, as a list of steps that a single privileged
+process executes without a shell, snapshotting the affected variables first and rolling back on failure.
+
+This module must not import gi: it runs as root through pkexec.
+"""
+import json
+import logging
+import os
+import re
+import shlex
+import struct
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field, asdict
+
+from . import efivars
+from .utils import get_partition_info, is_in_flatpak, subprocess_run_wrapper
+from .varstore import VariableStore, VarstoreWriter
+
+log = logging.getLogger('plan')
+
+EDIT_FIELDS = ('label', 'loader', 'parameters')
+# Boot numbers, BootOrder entries and Timeout are UINT16 in NVRAM
+MAX_UINT16 = 0xffff
+BOOT_NUM = re.compile('[0-9A-F]{4}')
+# Actions on a single entry, given by num
+NUM_ACTIONS = frozenset(('delete', 'edit', 'boot_next', 'active', 'inactive'))
+ACTIONS = NUM_ACTIONS | {'create', 'boot_order', 'delete_boot_next', 'timeout', 'reboot'}
+
+
+@dataclass
+class PlanStep:
+    """A single change to NVRAM"""
+    action: str
+    num: str | None = None
+    label: str | None = None
+    loader: str | None = None
+    parameters: str | None = None
+    boot_order: list[str] | None = None
+    timeout: int | None = None
+    # Fields an edit changes, out of EDIT_FIELDS, None for all of them. Native writes keep the bytes of the others,
+    # while efibootmgr rebuilds the whole entry anyway
+    fields: list[str] | None = None
+
+    def argv(self, disk: str, part: str) -> list[str]:
+        esp = ['efibootmgr', '--disk', disk, '--part', part]
+        match self.action:
+            case 'delete':
+                return esp + ['--delete-bootnum', '--bootnum', self.num]
+            case 'create':
+                return esp + ['--create', '--label', self.label, '--loader', self.loader, '--unicode', self.parameters]
+            case 'edit':
+                return esp + ['--bootnum', self.num, '--label', self.label, '--loader', self.loader,
+                              '--unicode', self.parameters]
+            case 'boot_order':
+                return esp + ['--bootorder', ','.join(self.boot_order)]
+            case 'boot_next':
+                return esp + ['--bootnext', self.num]
+            case 'delete_boot_next':
+                return esp + ['--delete-bootnext']
+            case 'active':
+                return esp + ['--bootnum', self.num, '--active']
+            case 'inactive':
+                return esp + ['--bootnum', self.num, '--inactive']
+            case 'timeout':
+                return esp + ['--timeout', str(self.timeout)]
+            case 'reboot':
+                return ['reboot']
+        raise ValueError(f"Unknown plan step {self.action}")
+
+    def validate(self):
+        """Raises ValueError for values NVRAM can't hold, so that a plan fails before it writes anything"""
+        if self.action not in ACTIONS:
+            raise ValueError(f"Unknown plan step {self.action}")
+        if self.action in ('create', 'edit'):
+            for name in EDIT_FIELDS:
+                if not isinstance(getattr(self, name), str):
+                    raise ValueError(f"Missing {name} in {self.action} step")
+        if self.action in NUM_ACTIONS and not BOOT_NUM.fullmatch(str(self.num)):
+            raise ValueError(f"Invalid boot number {self.num!r} in {self.action} step")
+        for num in self.boot_order or ():
+            if not BOOT_NUM.fullmatch(str(num)):
+                raise ValueError(f"Invalid boot number {num!r} in {self.action} step")
+        if self.action == 'timeout' and not (isinstance(self.timeout, int) and 0 <= self.timeout <= MAX_UINT16):
+            raise ValueError(f"Timeout must be between 0 and {MAX_UINT16} seconds, not {self.timeout}")
+
+    def variables(self) -> set[str]:
+        """EFI variables this step may modify. New entries created by the step are tracked separately."""
+        match self.action:
+            case 'delete':
+                return {f'Boot{self.num}', 'BootOrder'}
+            case 'create' | 'boot_order':
+                return {'BootOrder'}
+            case 'edit' | 'active' | 'inactive':
+                return {f'Boot{self.num}'}
+            case 'boot_next' | 'delete_boot_next':
+                return {'BootNext'}
+            case 'timeout':
+                return {'Timeout'}
+        return set()
+
+
+@dataclass
+class StepResult:
+    argv: list[str]
+    seconds: float
+    ok: bool
+    error: str = ''
+
+
+@dataclass
+class PlanReport:
+    ok: bool = True
+    rolled_back: bool = False
+    steps: list[StepResult] = field(default_factory=list)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    def __str__(self):
+        lines = [f"{'ok' if s.ok else 'FAILED'} {s.seconds * 1000:8.1f} ms  {shlex.join(s.argv)}" for s in self.steps]
+        if self.rolled_back:
+            lines.append("changes rolled back")
+        return '\n'.join(lines)
+
+
+class PlanError(Exception):
+    """A plan failed to apply. The report tells which step failed and whether the changes were rolled back."""
+
+    def __init__(self, report: PlanReport):
+        super().__init__(str(report))
+        self.report = report
+
+
+@dataclass
+class ChangePlan:
+    disk: str
+    part: str
+    steps: list[PlanStep] = field(default_factory=list)
+    native: bool = False  # write efivarfs directly instead of running efibootmgr
+    # Firmware image whose variable store to change instead of NVRAM, like OVMF_VARS.fd of a virtual machine
+    nvram_image: str | None = None
+
+    def __bool__(self):
+        return bool(self.steps)
+
+    def to_script(self) -> str:
+        return ''.join(shlex.join(step.argv(self.disk, self.part)) + '\n' for step in self.steps)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, text: str) -> 'ChangePlan':
+        data = json.loads(text)
+        data['steps'] = [PlanStep(**step) for step in data['steps']]
+        return cls(**data)
+
+    def validate(self):
+        for step in self.steps:
+            step.validate()
+
+    def variables(self) -> set[str]:
+        return set().union(*(step.variables() for step in self.steps))
+
+
+def diff_fields(edited: tuple[str, str, str], initial: tuple[str, str, str] | None) -> list[str]:
+    """Names of the EDIT_FIELDS that differ between two (label, loader, parameters)"""
+    if initial is None:
+        return list(EDIT_FIELDS)
+    return [name for name, new, old in zip(EDIT_FIELDS, edited, initial) if new != old]
+
+
+def build_plan(disk: str, part: str, *, boot_remove, boot_add, edits: dict[str, tuple[str, str, str]],
+               boot_order: list[str], boot_order_initial: list[str], boot_next: str | None,
+               boot_next_initial: str | None, boot_active, boot_inactive, timeout: int | None,
+               timeout_initial: int | None, reboot: bool = False, native: bool = False,
+               entries_initial: dict[str, tuple[str, str, str]] | None = None,
+               nvram_image: str | None = None) -> ChangePlan:
+    """Builds the plan from the change sets tracked by EfibootsListStore. edits maps num to (label, loader, parameters).
+
+    With entries_initial, the (label, loader, parameters) read from NVRAM, edits are diffed field by field against
+    them: edits that changed nothing are dropped and the others only rewrite the fields that changed.
+
+    Plans for an nvram_image are always native, efibootmgr only knows NVRAM, and never reboot. Raises ValueError
+    for values NVRAM can't hold, like a timeout above 65535 seconds.
+    """
+    steps = [PlanStep('delete', num=num) for num in boot_remove]
+    steps += [PlanStep('create', label=label, loader=loader, parameters=params)
+              for label, loader, params in boot_add.values()]
+    for num, edited in edits.items():
+        if num.startswith('NEW') or num in boot_remove:
+            continue
+        fields = None
+        if entries_initial is not None:
+            fields = diff_fields(edited, entries_initial.get(num))
+            if not fields:
+                continue
+        label, loader, params = edited
+        steps.append(PlanStep('edit', num=num, label=label, loader=loader, parameters=params, fields=fields))
+    if boot_order != boot_order_initial:
+        steps.append(PlanStep('boot_order', boot_order=list(boot_order)))
+    if boot_next_initial != boot_next:
+        steps.append(PlanStep('delete_boot_next') if boot_next is None else PlanStep('boot_next', num=boot_next))
+    steps += [PlanStep('active', num=num) for num in boot_active]
+    steps += [PlanStep('inactive', num=num) for num in boot_inactive]
+    if timeout != timeout_initial:
+        steps.append(PlanStep('timeout', timeout=timeout))
+    if reboot and nvram_image is None:
+        steps.append(PlanStep('reboot'))
+    plan = ChangePlan(disk, part, steps, native or nvram_image is not None, nvram_image)
+    plan.validate()
+    return plan
+
+
+class Snapshot:
+    """Copy of the variables a plan is about to modify, used to roll back a failed plan"""
+
+    def __init__(self, names: set[str], efivars_path: str = efivars.EFIVARS_PATH,
+                 writer: efivars.EfivarsWriter | None = None):
+        self.writer = writer or efivars.EfivarsWriter(efivars_path)
+        self.variables = {name: self.writer.read_variable(name) for name in names}
+        self.entries = self.boot_entries()
+
+    def boot_entries(self) -> set[str]:
+        return {v for v in self.writer.list_variables() if efivars.is_boot_entry_variable(v)}
+
+    def restore(self):
+        writer = self.writer
+        for name in self.boot_entries() - self.entries:
+            writer.delete_variable(name)
+        for name, (data, attributes) in self.variables.items():
+            if data is None:
+                writer.delete_variable(name)
+            else:
+                writer.write_variable(name, data, attributes)
+
+
+class NativeExecutor:
+    """Applies plan steps with efivarfs writes, without spawning efibootmgr"""
+
+    def __init__(self, plan: ChangePlan, efivars_path: str = efivars.EFIVARS_PATH,
+                 writer: efivars.EfivarsWriter | None = None):
+        self.plan = plan
+        self.writer = writer or efivars.EfivarsWriter(efivars_path)
+        self._partition = None
+
+    @property
+    def partition(self):
+        if self._partition is None:
+            if not (self.plan.disk and self.plan.part):
+                raise ValueError("Don't know where the ESP is to point the entry to: pass --disk and --part")
+            self._partition = get_partition_info(self.plan.disk, self.plan.part)
+        return self._partition
+
+    def load_option(self, step: PlanStep, current: bytes | None = None) -> bytes:
+        attributes = efivars.LOAD_OPTION_ACTIVE
+        label = step.label
+        device_path = None
+        optional_data = efivars.encode_optional_data(step.parameters)
+        if current is not None:
+            fields = EDIT_FIELDS if step.fields is None else step.fields
+            attributes = int.from_bytes(current[0:4], 'little')
+            description, next_field = efivars.get_load_option_description(current)
+            if 'label' not in fields:
+                label = description
+            nodes, end = efivars.get_load_option_device_path(current, next_field)
+            # Keep device paths we can't rebuild (BBS, network...) when the loader didn't change
+            if 'loader' not in fields or efivars.get_load_option_path(nodes) == step.loader:
+                device_path = current[next_field:end]
+            # Keep optional data byte for byte when the parameters didn't change. Binary optional data is shown as
+            # empty parameters: keep it unless the user typed some
+            current_optional_data = efivars.get_load_option_optional_data(current, end)
+            if 'parameters' not in fields or not step.parameters and \
+                    efivars.classify_optional_data(current_optional_data)[0] == efivars.OPTIONAL_DATA_BINARY:
+                optional_data = current_optional_data
+        if device_path is None:
+            device_path = efivars.make_esp_device_path(self.partition, step.loader)
+        return efivars.make_load_option(attributes, label, device_path, optional_data)
+
+    def execute(self, step: PlanStep):
+        match step.action:
+            case 'delete':
+                self.writer.delete_load_option(step.num)
+                order = self.writer.get_boot_order()
+                if step.num in order:
+                    order.remove(step.num)
+                    self.writer.set_boot_order(order)
+            case 'create':
+                num = self.writer.free_boot_num()
+                self.writer.write_load_option(num, self.load_option(step))
+                self.writer.set_boot_order([num] + self.writer.get_boot_order())
+            case 'edit':
+                current, _ = self.writer.read_variable(f'Boot{step.num}')
+                if current is None:
+                    raise FileNotFoundError(f"Boot{step.num} does not exist")
+                self.writer.write_load_option(step.num, self.load_option(step, current))
+            case 'boot_order':
+                self.writer.set_boot_order(step.boot_order)
+            case 'boot_next':
+                self.writer.set_boot_next(step.num)
+            case 'delete_boot_next':
+                self.writer.set_boot_next(None)
+            case 'active' | 'inactive':
+                self.writer.set_active(step.num, step.action == 'active')
+            case 'timeout':
+                self.writer.set_timeout(step.timeout)
+            case _ if self.plan.nvram_image is not None:
+                raise ValueError(f"{step.action} can't be applied to an NVRAM image")
+            case _:
+                subprocess.run(step.argv(self.plan.disk, self.plan.part), check=True, capture_output=True, text=True)
+
+
+def execute_plan(plan: ChangePlan, efivars_path: str = efivars.EFIVARS_PATH) -> PlanReport:
+    """Runs every step of the plan in this process. On failure, restores the snapshot taken beforehand."""
+    if plan.nvram_image is not None:
+        with VariableStore(plan.nvram_image, writable=True) as store:
+            writer = VarstoreWriter(store)
+            return run_steps(plan, Snapshot(plan.variables(), writer=writer), NativeExecutor(plan, writer=writer))
+    snapshot = None
+    if os.path.isdir(efivars_path):
+        snapshot = Snapshot(plan.variables(), efivars_path)
+    else:
+        log.warning("%s not available: changes can't be rolled back on failure", efivars_path)
+    return run_steps(plan, snapshot, NativeExecutor(plan, efivars_path) if plan.native else None)
+
+
+def run_steps(plan: ChangePlan, snapshot: Snapshot | None, native: NativeExecutor | None) -> PlanReport:
+    """Runs the steps with native, or efibootmgr if None, stopping at the first failure"""
+    report = PlanReport()
+    for step in plan.steps:
+        argv = [step.action]
+        start = time.perf_counter()
+        try:
+            argv = step.argv(plan.disk, plan.part)
+            if native is not None:
+                native.execute(step)
+            else:
+                subprocess.run(argv, check=True, capture_output=True, text=True)
+        except (OSError, ValueError, struct.error, subprocess.CalledProcessError) as e:
+            error = e.stderr if isinstance(e, subprocess.CalledProcessError) and e.stderr else str(e)
+            report.steps.append(StepResult(argv, time.perf_counter() - start, False, error))
+            report.ok = False
+            log.error("%s failed: %s", shlex.join(argv), error)
+            if snapshot is not None:
+                snapshot.restore()
+                report.rolled_back = True
+            break
+        report.steps.append(StepResult(argv, time.perf_counter() - start, True))
+    return report
+
+
+def privileged_plan_from_json(text: str) -> ChangePlan:
+    """A plan sent to a privileged process. Those only ever write NVRAM: the path of an image would let the caller
+    overwrite any file as root."""
+    plan = ChangePlan.from_json(text)
+    if plan.nvram_image is not None:
+        raise ValueError("NVRAM images are not written with elevated privileges")
+    plan.validate()
+    return plan
+
+
+def main(efivars_path: str = efivars.EFIVARS_PATH) -> int:
+    """Entry point of the privileged process: reads a JSON plan on stdin and prints a JSON report on stdout"""
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    try:
+        plan = privileged_plan_from_json(sys.stdin.read())
+    except (ValueError, TypeError, KeyError) as e:
+        log.error("Invalid plan: %s", e)
+        report = PlanReport(False, steps=[StepResult([], 0.0, False, f"Invalid plan: {e}")])
+    else:
+        report = execute_plan(plan, efivars_path)
+    sys.stdout.write(report.to_json())
+    return 0 if report.ok else 1
+
+
+def report_from_json(text: str) -> PlanReport:
+    data = json.loads(text)
+    data['steps'] = [StepResult(**step) for step in data['steps']]
+    return PlanReport(**data)
+
+
+def root_command() -> list[str]:
+    """Command that runs main() as root: pkexec resets the environment, so pass the package location explicitly"""
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    bootstrap = "import sys; sys.path.insert(0, sys.argv[1]); from efiboots.plan import main; sys.exit(main())"
+    return ['pkexec', sys.executable, '-c', bootstrap, package_parent]
+
+
+def execute_script_as_root(script: str):
+    log.info("Running command `pkexec sh -c %s`", script)
+    subprocess_run_wrapper(["pkexec", "sh", "-c", script])
+
+
+def execute_plan_as_root(plan: ChangePlan) -> PlanReport | None:
+    if is_in_flatpak():
+        # The host has neither our interpreter nor our package: fall back to a plain script
+        execute_script_as_root(plan.to_script())
+        return None
+    log.info("Applying as root:\n%s", plan.to_script())
+    try:
+        report = report_from_json(subprocess_run_wrapper(root_command(), input=plan.to_json()))
+    except subprocess.CalledProcessError as e:
+        try:
+            report = report_from_json(e.stdout)
+        except (ValueError, TypeError, KeyError):
+            raise e
+        raise PlanError(report) from e
+    log.info("Applied in a single process:\n%s", report)
+    return report
+
+
+if __name__ == '__main__':
+    sys.exit(main())
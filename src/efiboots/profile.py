@@ -0,0 +1,59 @@
+"""
+Startup phase timings, reported on stderr with --profile-startup.
+
+Marks are always recorded, as they cost a clock read: the options that enable the report are only parsed
+once gi and Gtk are already imported.
+"""
+import sys
+import time
+from contextlib import contextmanager
+
+
+class StartupProfile:
+    def __init__(self):
+        self.enabled = False
+        self.finished = False
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases: list[tuple[str, float, float]] = []  # (phase, seconds, seconds since start when it ended)
+
+    def start(self, started: float):
+        """Counts from started, the earliest time the program could measure"""
+        self.started = started
+        self.last = started
+
+    def mark(self, phase: str):
+        """Records a phase of the main thread, lasting since the previous mark"""
+        now = time.perf_counter()
+        if not self.finished:
+            self.phases.append((phase, now - self.last, now - self.started))
+        self.last = now
+
+    def record(self, phase: str, seconds: float):
+        """Records a phase that ran concurrently with the main thread and just ended"""
+        if not self.finished:
+            self.phases.append((phase, seconds, time.perf_counter() - self.started))
+
+    @contextmanager
+    def timed(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def finish(self):
+        """Stops recording and prints the report, if enabled"""
+        if self.finished:
+            return
+        self.finished = True
+        if self.enabled:
+            print(self.report(), file=sys.stderr)
+
+    def report(self) -> str:
+        lines = [f"{'startup phase':<32} {'duration':>10} {'at':>10}"]
+        lines += [f"{phase:<32} {seconds * 1000:7.1f} ms {at * 1000:7.1f} ms" for phase, seconds, at in self.phases]
+        return '\n'.join(lines)
+
+
+startup_profile = StartupProfile()
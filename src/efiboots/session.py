@@ -0,0 +1,402 @@
+"""
+Edit session of the main window: every change is a typed operation recorded in a log, which gives undo and redo.
+
+The state the operations lead to is kept up to date alongside the log, together with the set of things that differ
+from NVRAM, so that neither an edit nor asking whether there is something to save walks all the entries. Save builds
+its plan from the net changes.
+"""
+import operator
+from dataclasses import dataclass
+
+from .bootorder import BootOrder
+
+Entry = tuple[str, str, str]  # label, loader, parameters
+
+
+@dataclass(frozen=True, slots=True)
+class Move:
+    """Moves the rows at positions to new_positions, the other rows keeping their order in the places left.
+
+    In the boot order, the entries from start, old, become new: however many rows move and however far, that is a
+    single edit. new differs from old in length when rows that weren't part of the boot order join it.
+    """
+    positions: tuple[int, ...]
+    new_positions: tuple[int, ...]
+    start: int
+    old: tuple[str, ...]
+    new: tuple[str, ...]
+
+    def inverse(self) -> 'Move':
+        return Move(self.new_positions, self.positions, self.start, self.new, self.old)
+
+
+@dataclass(frozen=True, slots=True)
+class SetOrder:
+    """Replaces the whole boot order: what moves compact to"""
+    old: tuple[str, ...]
+    new: tuple[str, ...]
+
+    def inverse(self) -> 'SetOrder':
+        return SetOrder(self.new, self.old)
+
+
+@dataclass(frozen=True, slots=True)
+class Toggle:
+    num: str
+    active: bool
+
+    def inverse(self) -> 'Toggle':
+        return Toggle(self.num, not self.active)
+
+
+@dataclass(frozen=True, slots=True)
+class Add:
+    """Adds a new entry, or brings back a removed one. index is its place in the boot order, if it has one."""
+    num: str
+    entry: Entry
+    active: bool
+    position: int
+    index: int | None = None
+
+    def inverse(self) -> 'Remove':
+        return Remove(self.num, self.entry, self.active, self.position, self.index)
+
+
+@dataclass(frozen=True, slots=True)
+class Remove:
+    num: str
+    entry: Entry
+    active: bool
+    position: int
+    index: int | None = None
+
+    def inverse(self) -> Add:
+        return Add(self.num, self.entry, self.active, self.position, self.index)
+
+
+@dataclass(frozen=True, slots=True)
+class Edit:
+    num: str
+    old: Entry
+    new: Entry
+
+    def inverse(self) -> 'Edit':
+        return Edit(self.num, self.new, self.old)
+
+
+@dataclass(frozen=True, slots=True)
+class SetNext:
+    old: str | None
+    new: str | None
+
+    def inverse(self) -> 'SetNext':
+        return SetNext(self.new, self.old)
+
+
+@dataclass(frozen=True, slots=True)
+class SetTimeout:
+    old: int | None
+    new: int | None
+
+    def inverse(self) -> 'SetTimeout':
+        return SetTimeout(self.new, self.old)
+
+
+Operation = Move | SetOrder | Toggle | Add | Remove | Edit | SetNext | SetTimeout
+
+
+def place(items: list, positions, new_positions) -> list:
+    """items, with those at positions moved to new_positions and the others keeping their order in the places left"""
+    moving = dict(zip(new_positions, (items[position] for position in positions)))
+    left = set(positions)
+    rest = iter([item for i, item in enumerate(items) if i not in left])
+    return [moving[i] if i in moving else next(rest) for i in range(len(items))]
+
+
+class EditSession:
+    def __init__(self):
+        self.reset()
+
+    def reset(self, boot_order=(), boot_next: str | None = None, timeout: int | None = None,
+              entries: dict[str, tuple[Entry, bool]] | None = None):
+        """Starts over from the state read from NVRAM. entries maps num to (label, loader, parameters) and active."""
+        self.boot_order_initial = list(boot_order)
+        self.boot_next_initial = boot_next
+        self.timeout_initial = timeout
+        self.entries_initial: dict[str, tuple[Entry, bool]] = dict(entries or {})
+        self.boot_order = BootOrder(boot_order)
+        self.boot_next = boot_next
+        self.timeout = timeout
+        self.added: dict[str, Entry] = {}
+        self.removed: set[str] = set()
+        self.edits: dict[str, Entry] = {}
+        self.active: dict[str, bool] = {}
+        # num -> (row position, boot order index) of the entries added or removed, for compact()
+        self.places: dict[str, tuple[int, int | None]] = {}
+        self.undo_stack: list[Operation] = []
+        self.redo_stack: list[Operation] = []
+        self._dirty = set()
+        self._order_mismatches = 0
+        self._new_count = 0
+
+    def __str__(self):
+        return f"next: {self.boot_next} order: {self.boot_order} add: {self.added} rem: {self.removed} " \
+               f"edits: {self.edits} active: {self.active} timeout: {self.timeout}"
+
+    @property
+    def dirty(self) -> bool:
+        """Whether there is something to save"""
+        return bool(self._dirty)
+
+    def new_num(self) -> str:
+        """Placeholder number of an entry to be created"""
+        num = f'NEW{self._new_count}'
+        self._new_count += 1
+        return num
+
+    def entry(self, num: str) -> tuple[Entry, bool]:
+        """Current (label, loader, parameters) and active state of an entry"""
+        if num in self.added:
+            return self.added[num], self.active.get(num, True)
+        initial, active = self.entries_initial[num]
+        return self.edits.get(num, initial), self.active.get(num, active)
+
+    def do(self, op: Operation):
+        self._apply(op)
+        self.undo_stack.append(op)
+        self.redo_stack.clear()
+
+    def undo(self) -> Operation | None:
+        """Reverts the last operation. Returns the operation that reverted it, for the caller to mirror."""
+        if not self.undo_stack:
+            return None
+        op = self.undo_stack.pop()
+        inverse = op.inverse()
+        self._apply(inverse)
+        self.redo_stack.append(op)
+        return inverse
+
+    def redo(self) -> Operation | None:
+        if not self.redo_stack:
+            return None
+        op = self.redo_stack.pop()
+        self._apply(op)
+        self.undo_stack.append(op)
+        return op
+
+    def _set_dirty(self, key, dirty: bool):
+        if dirty:
+            self._dirty.add(key)
+        else:
+            self._dirty.discard(key)
+
+    def _mismatches(self, start: int, end: int) -> int:
+        order, initial = self.boot_order, self.boot_order_initial
+        end = min(end, max(len(order), len(initial)))
+        common = max(start, min(end, len(order), len(initial)))
+        # Past the end of either, every place differs
+        return sum(map(operator.ne, order[start:common], initial[start:common])) + max(0, end - common)
+
+    def _change_order(self, start: int, end: int | None, change):
+        """Runs change, which only touches the boot order between start and end, keeping count of the places
+        that differ from the initial boot order. end None means up to the end."""
+        if end is None:
+            end = max(len(self.boot_order), len(self.boot_order_initial)) + 1
+        self._order_mismatches -= self._mismatches(start, end)
+        change()
+        self._order_mismatches += self._mismatches(start, end)
+        self._set_dirty('order', self._order_mismatches > 0)
+
+    def _insert(self, index: int, num: str):
+        index = max(0, min(index, len(self.boot_order)))
+        self._change_order(index, None, lambda: self.boot_order.insert(index, num))
+
+    def _discard(self, num: str):
+        index = self.boot_order.rank(num)
+        if index is not None:
+            self._change_order(index, None, lambda: self.boot_order.remove(num))
+
+    def _move(self, start: int, old: tuple[str, ...], new: tuple[str, ...]):
+        order = self.boot_order
+        end = start + len(old) if len(old) == len(new) else None
+        self._change_order(start, end, lambda: order.replace(start, len(old), new))
+
+    def plan_move(self, nums: list[str], positions: list[int], new_positions: list[int], start: int = 0) -> Move:
+        """The Move of the rows at positions to new_positions. nums are the numbers of the rows from start on, at
+        least up to the last of the positions.
+
+        The entries of the boot order among those rows keep the places they hold in it, in their new row order,
+        with the entries that moved and weren't part of it joining them, so rows and boot order stay in step.
+        """
+        shown = place(nums, [p - start for p in positions], [p - start for p in new_positions])
+        moved = {nums[p - start] for p in positions}
+        order = self.boot_order
+        ranks = [order.rank(num) for num in shown if num in order]
+        new = tuple(num for num in shown if num in order or (num in moved and num not in self.added))
+        if ranks:
+            first = min(ranks)
+            old = tuple(order[first:max(ranks) + 1])
+            # Entries of the boot order that aren't shown among the rows stay where they are
+            missing = set(old).difference(new)
+            new += tuple(num for num in old if num in missing)
+        else:
+            first, old = len(order), ()
+        return Move(tuple(positions), tuple(new_positions), first, old, new)
+
+    def _apply(self, op: Operation):
+        match op:
+            case Move(start=start, old=old, new=new):
+                self._move(start, old, new)
+            case SetOrder(new=new):
+                self.boot_order = BootOrder(new)
+                self._order_mismatches = self._mismatches(0, max(len(new), len(self.boot_order_initial)))
+                self._set_dirty('order', self._order_mismatches > 0)
+            case Toggle(num=num, active=active):
+                self.active[num] = active
+                if num in self.entries_initial:
+                    self._set_dirty(('active', num), active != self.entries_initial[num][1])
+            case Add(num=num, entry=entry, position=position, index=index):
+                self.places[num] = position, index
+                if num in self.entries_initial:
+                    self.removed.discard(num)
+                    if index is not None:
+                        self._insert(index, num)
+                    self._set_dirty(('remove', num), False)
+                else:
+                    self.added[num] = entry
+                    self._set_dirty(('add', num), True)
+            case Remove(num=num, position=position, index=index):
+                self.places[num] = position, index
+                if num in self.added:
+                    del self.added[num]
+                    self._set_dirty(('add', num), False)
+                else:
+                    self.removed.add(num)
+                    self._discard(num)
+                    self._set_dirty(('remove', num), True)
+            case Edit(num=num, new=new):
+                if num in self.added:
+                    self.added[num] = new
+                else:
+                    self.edits[num] = new
+                    self._set_dirty(('edit', num), new != self.entries_initial[num][0])
+            case SetNext(new=new):
+                self.boot_next = new
+                self._set_dirty('next', new != self.boot_next_initial)
+            case SetTimeout(new=new):
+                self.timeout = new
+                self._set_dirty('timeout', new != self.timeout_initial)
+
+    def compact(self) -> list[Operation]:
+        """The fewest operations with the same effect as the log: one per thing that changed, none for the changes
+        that were reverted. Moves collapse into the final boot order, edits of new entries into their Add.
+
+        They are derived from what the session holds now against the initial state, not from the log, so that they
+        also account for rebase() merging changes made elsewhere.
+        """
+        compacted = []
+        if self.boot_order != self.boot_order_initial:
+            compacted.append(SetOrder(tuple(self.boot_order_initial), tuple(self.boot_order)))
+        for num, entry in self.added.items():
+            position, index = self.places.get(num, (0, None))
+            compacted.append(Add(num, entry, self.active.get(num, True), position, index))
+        for num in sorted(self.removed):
+            entry, active = self.entries_initial[num]
+            position, index = self.places.get(num, (0, None))
+            compacted.append(Remove(num, entry, active, position, index))
+        for num, entry in self.edits.items():
+            if num not in self.removed and entry != self.entries_initial[num][0]:
+                compacted.append(Edit(num, self.entries_initial[num][0], entry))
+        for num, active in self.active.items():
+            if num in self.entries_initial and num not in self.removed and active != self.entries_initial[num][1]:
+                compacted.append(Toggle(num, active))
+        if self.boot_next != self.boot_next_initial:
+            compacted.append(SetNext(self.boot_next_initial, self.boot_next))
+        if self.timeout != self.timeout_initial:
+            compacted.append(SetTimeout(self.timeout_initial, self.timeout))
+        return compacted
+
+    def plan_arguments(self) -> dict:
+        """Arguments of build_plan for the compacted changes"""
+        arguments = dict(boot_remove=set(), boot_add={}, edits={}, boot_order=self.boot_order_initial,
+                         boot_order_initial=self.boot_order_initial, boot_next=self.boot_next_initial,
+                         boot_next_initial=self.boot_next_initial, boot_active=set(), boot_inactive=set(),
+                         timeout=self.timeout_initial, timeout_initial=self.timeout_initial,
+                         entries_initial={num: entry for num, (entry, _) in self.entries_initial.items()})
+        for op in self.compact():
+            match op:
+                case SetOrder(new=new):
+                    arguments['boot_order'] = list(new)
+                case Add(num=num, entry=entry):
+                    arguments['boot_add'][num] = entry
+                case Remove(num=num):
+                    arguments['boot_remove'].add(num)
+                case Edit(num=num, new=new):
+                    arguments['edits'][num] = new
+                case Toggle(num=num, active=active):
+                    arguments['boot_active' if active else 'boot_inactive'].add(num)
+                case SetNext(new=new):
+                    arguments['boot_next'] = new
+                case SetTimeout(new=new):
+                    arguments['timeout'] = new
+        return arguments
+
+    def rebase(self, boot_order, boot_next: str | None, timeout: int | None,
+               entries: dict[str, tuple[Entry, bool]]):
+        """Takes a newer state read from NVRAM as the initial one, keeping the local changes on top of it.
+
+        Changes to entries that were deleted in the meantime are dropped, as are the changes someone else already
+        made. Undo and redo history is lost: its operations hold values and row positions from before, and undoing
+        them would revert the changes made elsewhere.
+        """
+        gone = self.entries_initial.keys() - entries.keys()
+        self.removed &= entries.keys()
+        for num in gone:
+            self.edits.pop(num, None)
+            self.active.pop(num, None)
+            self.places.pop(num, None)
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+
+        for num, edited in list(self.edits.items()):
+            if num not in entries:
+                continue
+            # Fields edited here win, the others follow NVRAM
+            old = self.entries_initial[num][0]
+            new = entries[num][0]
+            merged = tuple(e if e != o else n for e, o, n in zip(edited, old, new))
+            if merged == new:
+                del self.edits[num]
+            else:
+                self.edits[num] = merged
+        for num, active in list(self.active.items()):
+            if num in entries and entries[num][1] == active:
+                del self.active[num]
+
+        old_order = [num for num in self.boot_order_initial if num not in self.removed]
+        if self.boot_order != old_order:
+            order = [num for num in self.boot_order if num in entries]
+            order += [num for num in boot_order if num not in order and num not in self.removed]
+        else:
+            order = [num for num in boot_order if num not in self.removed]
+        if self.boot_next == self.boot_next_initial:
+            self.boot_next = boot_next
+        if self.timeout == self.timeout_initial:
+            self.timeout = timeout
+
+        self.boot_order_initial = list(boot_order)
+        self.boot_next_initial = boot_next
+        self.timeout_initial = timeout
+        self.entries_initial = dict(entries)
+        self.boot_order = BootOrder(order)
+        self._recompute_dirty()
+
+    def _recompute_dirty(self):
+        self._order_mismatches = self._mismatches(0, max(len(self.boot_order), len(self.boot_order_initial)))
+        self._dirty = {('add', num) for num in self.added} | {('remove', num) for num in self.removed}
+        self._dirty |= {('edit', num) for num, entry in self.edits.items() if entry != self.entries_initial[num][0]}
+        self._dirty |= {('active', num) for num, active in self.active.items()
+                        if num in self.entries_initial and active != self.entries_initial[num][1]}
+        self._set_dirty('order', self._order_mismatches > 0)
+        self._set_dirty('next', self.boot_next != self.boot_next_initial)
+        self._set_dirty('timeout', self.timeout != self.timeout_initial)
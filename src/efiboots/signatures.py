@@ -0,0 +1,138 @@
+"""
+Secure Boot signature databases: PK, KEK, db and dbx, each a sequence of EFI_SIGNATURE_LISTs (UEFI specification,
+32.4.1). Lists are walked in place over a memoryview: certificates stay views of the variable data, only the
+SHA-256 hashes are copied, into the set that makes looking a loader up a single hash probe even in a dbx with
+thousands of entries.
+
+Loaders are judged by their Authenticode digest only. Telling whether a signed loader chains up to a certificate
+in db would take verifying its PKCS#7 signature, so such loaders are reported as unknown.
+"""
+import logging
+import os
+import struct
+import threading
+import uuid
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+
+from . import efivars
+
+EFI_IMAGE_SECURITY_DATABASE_GUID = 'd719b2cb-3d3a-4596-a3bc-dad00e67656f'
+# Where each database lives
+DATABASES = {'PK': efivars.EFI_GLOBAL_GUID, 'KEK': efivars.EFI_GLOBAL_GUID,
+             'db': EFI_IMAGE_SECURITY_DATABASE_GUID, 'dbx': EFI_IMAGE_SECURITY_DATABASE_GUID}
+
+EFI_CERT_SHA256_GUID = uuid.UUID('c1c41626-504c-4092-aca9-41f936934328')
+EFI_CERT_X509_GUID = uuid.UUID('a5c059a1-94e4-4aa7-87b5-ab155c2bf072')
+EFI_CERT_SHA1_GUID = uuid.UUID('826ca512-cf10-4ac9-b187-be01496631bd')
+EFI_CERT_RSA2048_GUID = uuid.UUID('3c5766e8-269c-4e34-aa14-ed776e85b3b6')
+EFI_CERT_X509_SHA256_GUID = uuid.UUID('3bd2a492-96c0-4079-b420-fcf98ef103ed')
+# The same, as stored, to compare list types without building a UUID for each list
+SHA256_TYPE = EFI_CERT_SHA256_GUID.bytes_le
+X509_TYPE = EFI_CERT_X509_GUID.bytes_le
+
+SIGNATURE_LIST = struct.Struct('<16sIII')  # type, list size, header size, signature size
+OWNER_SIZE = 16
+SHA256_SIZE = 32
+
+VERDICT_REVOKED = 'revoked'
+VERDICT_ALLOWED = 'allowed'
+VERDICT_UNKNOWN = 'unknown'
+
+log = logging.getLogger('signatures')
+
+
+class SignatureListError(ValueError):
+    pass
+
+
+def iter_signature_lists(data) -> Iterator[tuple[bytes, memoryview, int]]:
+    """Yields the type GUID (as stored), the signatures, each starting with its owner GUID, and the size of each
+    signature of every list in data, without copying them"""
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        try:
+            signature_type, list_size, header_size, signature_size = SIGNATURE_LIST.unpack_from(view, offset)
+        except struct.error as e:
+            raise SignatureListError(f"truncated signature list at {offset:#x}") from e
+        start = offset + SIGNATURE_LIST.size + header_size
+        end = offset + list_size
+        if end > len(view) or start > end or signature_size <= OWNER_SIZE or (end - start) % signature_size:
+            raise SignatureListError(f"malformed signature list at {offset:#x}")
+        yield signature_type, view[start:end], signature_size
+        offset = end
+
+
+@dataclass
+class SignatureDatabase:
+    """Contents of one of PK, KEK, db or dbx"""
+    sha256: frozenset[bytes] = frozenset()
+    # DER encoded X.509 certificates, as views of the variable data
+    certificates: list[memoryview] = field(default_factory=list)
+    # How many signatures of other types, like SHA-1 hashes or certificate TBS hashes, by type
+    others: dict[uuid.UUID, int] = field(default_factory=dict)
+
+    @classmethod
+    def parse(cls, data) -> 'SignatureDatabase':
+        hashes = set()
+        database = cls()
+        for signature_type, signatures, signature_size in iter_signature_lists(data):
+            if signature_type == SHA256_TYPE and signature_size == OWNER_SIZE + SHA256_SIZE:
+                hashes.update(signatures[i + OWNER_SIZE:i + signature_size].tobytes()
+                              for i in range(0, len(signatures), signature_size))
+            elif signature_type == X509_TYPE:
+                database.certificates.extend(signatures[i + OWNER_SIZE:i + signature_size]
+                                             for i in range(0, len(signatures), signature_size))
+            else:
+                guid = uuid.UUID(bytes_le=signature_type)
+                database.others[guid] = database.others.get(guid, 0) + len(signatures) // signature_size
+        database.sha256 = frozenset(hashes)
+        return database
+
+    def __len__(self):
+        return len(self.sha256) + len(self.certificates) + sum(self.others.values())
+
+
+def verdict(digest: bytes, db: SignatureDatabase, dbx: SignatureDatabase) -> str:
+    """Whether firmware enforcing Secure Boot would run the image with that Authenticode SHA-256 digest, as far as
+    hashes tell. dbx wins over db, as it does in firmware."""
+    if digest in dbx.sha256:
+        return VERDICT_REVOKED
+    if digest in db.sha256:
+        return VERDICT_ALLOWED
+    return VERDICT_UNKNOWN
+
+
+class SignatureDatabases:
+    """PK, KEK, db and dbx read from efivarfs, each parsed again only when its variable changes, which is told by the
+    inode, size and modification time of its file. Safe to use from several threads."""
+
+    def __init__(self, efivars_path: str = efivars.EFIVARS_PATH):
+        self.efivars_path = efivars_path
+        self._lock = threading.Lock()
+        self._databases: dict[str, tuple[tuple[int, int, int] | None, SignatureDatabase]] = {}
+
+    def get(self, name: str) -> SignatureDatabase:
+        guid = DATABASES[name]
+        try:
+            st = os.stat(efivars.variable_path(name, guid, self.efivars_path))
+            key = st.st_ino, st.st_size, st.st_mtime_ns
+        except FileNotFoundError:
+            key = None
+        with self._lock:
+            cached = self._databases.get(name)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            data, _ = efivars.get_variable_data(name, guid, self.efivars_path) if key is not None else (None, None)
+            try:
+                database = SignatureDatabase.parse(data or b'')
+            except SignatureListError as e:
+                log.warning("Could not parse %s: %s", name, e)
+                database = SignatureDatabase()
+            log.debug("Read %d signatures from %s", len(database), name)
+            self._databases[name] = key, database
+            return database
+
+    def verdict(self, digest: bytes) -> str:
+        return verdict(digest, self.get('db'), self.get('dbx'))
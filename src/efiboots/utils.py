@@ -1,22 +1,71 @@
+import contextlib
+import io
 import logging
 import re
 import subprocess
 import os
+import threading
+from dataclasses import dataclass
+
+from .host import get_host_helper
 
 device_regex = re.compile(r'^([a-z/]+[0-9a-z]*?)p?([0-9]+)$')
 
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+SYSFS_BLOCK_PATH = '/sys/class/block'
+SYSFS_DEV_BLOCK_PATH = '/sys/dev/block'
+UDEV_DATA_PATH = '/run/udev/data'
+DEV_DISK_BY_PARTUUID_PATH = '/dev/disk/by-partuuid'
+
+
+@dataclass(frozen=True)
+class PartitionInfo:
+    """Where a partition lives on its disk, as needed to build an EFI HD() device path node"""
+    number: int
+    start: int  # in logical blocks
+    size: int  # in logical blocks
+    part_uuid: str
+    scheme: str  # 'gpt' or 'dos'
+
+
+@dataclass(frozen=True)
+class BlockDevice:
+    """A partition present on this system"""
+    device: str  # like /dev/nvme0n1p1
+    disk: str  # like /dev/nvme0n1
+    number: int
+    mount_point: str | None
+
 
 def is_in_flatpak():
     return "FLATPAK_ID" in os.environ
 
 
-def subprocess_run_wrapper(cmd):
+def subprocess_run_wrapper(cmd, input: str | None = None):
     if is_in_flatpak():
-        cmd = ["flatpak-spawn", "--host"] + cmd
-        logging.debug("Flatpak sandbox detected. Running: %s", ' '.join(cmd))
-    else:
-        logging.debug("Running: %s", ' '.join(cmd))
-    return subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        # One long-lived host process runs all the commands, instead of a flatpak-spawn for each of them
+        logging.debug("Flatpak sandbox detected. Running on the host: %s", ' '.join(cmd))
+        result = get_host_helper().run(cmd, input)
+        result.check_returncode()
+        return result.stdout
+    logging.debug("Running: %s", ' '.join(cmd))
+    return subprocess.run(cmd, check=True, capture_output=True, text=True, input=input).stdout
+
+
+@contextlib.contextmanager
+def subprocess_stream_wrapper(cmd):
+    """Like subprocess_run_wrapper, but yields stdout as a stream of lines while the command is running"""
+    if is_in_flatpak():
+        # The host helper sends back whole outputs
+        yield io.StringIO(subprocess_run_wrapper(cmd))
+        return
+    logging.debug("Streaming: %s", ' '.join(cmd))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
+        yield process.stdout
+        process.stdout.read()
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
 
 
 def device_to_disk_part(device: str) -> tuple[str, str] | None:
@@ -65,16 +114,267 @@ def auto_detect_esp_with_lsblk(error_callback=None) -> tuple[str, str] | None:
     return None
 
 
+ESP_MOUNT_POINTS = ('/efi', '/boot/efi', '/boot')
+ESP_PART_TYPES = ('c12a7328-f81f-11d2-ba4b-00a0c93ec93b', '0xef')
+
+
+def unescape_mountinfo(field: str) -> str:
+    # Spaces, tabs, newlines and backslashes are escaped as octal sequences
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(mountinfo_path: str = MOUNTINFO_PATH) -> dict[str, tuple[str, str, str]]:
+    """Maps each mount point to (major:minor, source, fstype). Later mounts hide earlier ones, like the kernel does."""
+    mounts = {}
+    with open(mountinfo_path) as f:
+        for line in f:
+            fields = line.split()
+            try:
+                separator = fields.index('-', 6)
+            except ValueError:
+                continue
+            mounts[unescape_mountinfo(fields[4])] = (fields[2], unescape_mountinfo(fields[separator + 2]),
+                                                     fields[separator + 1])
+    return mounts
+
+
+def dev_to_disk_part(dev: str, source: str, sys_dev_block_path: str = SYSFS_DEV_BLOCK_PATH) -> tuple[str, str] | None:
+    """Resolves a major:minor pair to (disk, part) through sysfs, falling back to the device name"""
+    part_dir = os.path.realpath(os.path.join(sys_dev_block_path, dev))
+    try:
+        part = read_sysfs_attribute(os.path.join(part_dir, 'partition'))
+    except (FileNotFoundError, NotADirectoryError):
+        return device_to_disk_part(source)
+    return '/dev/' + os.path.basename(os.path.dirname(part_dir)), part
+
+
+def auto_detect_esp_with_sysfs(error_callback=None, mountinfo_path: str = MOUNTINFO_PATH,
+                               sys_dev_block_path: str = SYSFS_DEV_BLOCK_PATH,
+                               udev_data_path: str = UDEV_DATA_PATH) -> tuple[str, str] | None:
+    """Same as the findmnt and lsblk methods together, but reading /proc, /sys and the udev database instead of
+    spawning processes"""
+    if is_in_flatpak():
+        # The sandbox has its own mount table and no udev database
+        return None
+    try:
+        mounts = parse_mountinfo(mountinfo_path)
+    except OSError as e:
+        logging.warning("Could not read %s: %s", mountinfo_path, e)
+        mounts = {}
+    for mount_point in ESP_MOUNT_POINTS:
+        if mount_point in mounts:
+            dev, source, fstype = mounts[mount_point]
+            if fstype == 'vfat':
+                return dev_to_disk_part(dev, source, sys_dev_block_path)
+
+    # The udev database has one file per block device: only the vfat ones are worth parsing
+    esps = []
+    try:
+        udev_entries = os.scandir(udev_data_path)
+    except OSError as e:
+        logging.warning("Could not scan %s: %s", udev_data_path, e)
+        return None
+    with udev_entries:
+        for entry in udev_entries:
+            if not entry.name.startswith('b'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    content = f.read()
+            except OSError as e:
+                # Like a database only root may read: skip the device rather than give up on the others
+                logging.debug("Could not read %s: %s", entry.path, e)
+                continue
+            if 'E:ID_FS_TYPE=vfat\n' not in content:
+                continue
+            properties = dict(line[2:].partition('=')[::2] for line in content.splitlines() if line.startswith('E:'))
+            if properties.get('ID_PART_ENTRY_TYPE', '').lower() in ESP_PART_TYPES:
+                dev = entry.name[1:]
+                disk_part = dev_to_disk_part(dev, '', sys_dev_block_path)
+                if disk_part:
+                    name = os.path.basename(os.path.realpath(os.path.join(sys_dev_block_path, dev)))
+                    esps.append(('/dev/' + name, disk_part))
+    if len(esps) == 1:
+        return esps[0][1]
+    if len(esps) > 1 and error_callback:
+        error_callback(sorted(name for name, _ in esps))
+    return None
+
+
 def auto_detect_esp(error_callback=None) -> tuple[str, str] | tuple[None, None]:
-    methods = (make_auto_detect_esp_with_findmnt('/efi'),
+    many_esps = []
+    methods = (lambda: auto_detect_esp_with_sysfs(many_esps.append),
+               make_auto_detect_esp_with_findmnt('/efi'),
                make_auto_detect_esp_with_findmnt('/boot/efi'),
                make_auto_detect_esp_with_findmnt('/boot'),
-               lambda: auto_detect_esp_with_lsblk(error_callback))
+               lambda: auto_detect_esp_with_lsblk(many_esps.append))
     for find_esp_method in methods:
         result = find_esp_method()
         if result:
             disk, part = result
             logging.info("Detected ESP on disk %s part %s", disk, part)
             return disk, part
+        if many_esps:
+            break
+    if many_esps and error_callback:
+        error_callback(many_esps[0])
     logging.fatal("Can't auto-detect ESP! All methods failed.")
     return None, None
+
+
+def read_sysfs_attribute(path: str) -> str:
+    with open(path) as f:
+        return f.read().strip()
+
+
+def read_udev_properties(dev: str, udev_data_path: str = UDEV_DATA_PATH) -> dict[str, str]:
+    """dev is the major:minor pair found in /sys/class/block/*/dev"""
+    properties = {}
+    try:
+        with open(os.path.join(udev_data_path, 'b' + dev)) as f:
+            for line in f:
+                if line.startswith('E:'):
+                    key, _, value = line[2:].rstrip('\n').partition('=')
+                    properties[key] = value
+    except OSError as e:
+        if not isinstance(e, FileNotFoundError):
+            logging.debug("Could not read the udev properties of %s: %s", dev, e)
+    return properties
+
+
+def find_part_uuid_by_symlink(part_name: str, by_partuuid_path: str = DEV_DISK_BY_PARTUUID_PATH) -> str | None:
+    try:
+        links = os.listdir(by_partuuid_path)
+    except FileNotFoundError:
+        return None
+    for link in links:
+        if os.path.basename(os.path.realpath(os.path.join(by_partuuid_path, link))) == part_name:
+            return link
+    return None
+
+
+def get_partition_info(disk: str, part: str, sysfs_path: str = SYSFS_BLOCK_PATH,
+                       udev_data_path: str = UDEV_DATA_PATH,
+                       by_partuuid_path: str = DEV_DISK_BY_PARTUUID_PATH) -> PartitionInfo:
+    """Reads the position and identity of partition number part of disk from sysfs, without any subprocess"""
+    disk_dir = os.path.join(sysfs_path, os.path.basename(disk))
+    for part_name in os.listdir(disk_dir):
+        part_dir = os.path.join(disk_dir, part_name)
+        partition_file = os.path.join(part_dir, 'partition')
+        if os.path.isfile(partition_file) and read_sysfs_attribute(partition_file) == str(int(part)):
+            break
+    else:
+        raise FileNotFoundError(f"Partition {part} not found on {disk}")
+
+    # sysfs always counts 512 bytes sectors, EFI wants logical blocks
+    try:
+        block_size = int(read_sysfs_attribute(os.path.join(disk_dir, 'queue', 'logical_block_size')))
+    except FileNotFoundError:
+        block_size = 512
+    start = int(read_sysfs_attribute(os.path.join(part_dir, 'start'))) * 512 // block_size
+    size = int(read_sysfs_attribute(os.path.join(part_dir, 'size'))) * 512 // block_size
+
+    properties = read_udev_properties(read_sysfs_attribute(os.path.join(part_dir, 'dev')), udev_data_path)
+    part_uuid = properties.get('ID_PART_ENTRY_UUID') or find_part_uuid_by_symlink(part_name, by_partuuid_path)
+    if part_uuid is None:
+        raise FileNotFoundError(f"Could not find the PARTUUID of {part_name}")
+    scheme = properties.get('ID_PART_ENTRY_SCHEME') or ('gpt' if len(part_uuid) == 36 else 'dos')
+    return PartitionInfo(number=int(part), start=start, size=size, part_uuid=part_uuid.lower(), scheme=scheme)
+
+
+class PartitionIndex:
+    """Maps PARTUUIDs to the partitions present on this system.
+
+    It is built in one pass over /dev/disk/by-partuuid and /sys/class/block, falling back to the udev database where
+    there are no by-partuuid links, then kept until invalidate() is called, so that resolving any number of boot
+    entries never scans sysfs again. Safe to use from several threads.
+    """
+
+    def __init__(self, by_partuuid_path: str = DEV_DISK_BY_PARTUUID_PATH, sysfs_path: str = SYSFS_BLOCK_PATH,
+                 udev_data_path: str = UDEV_DATA_PATH, mountinfo_path: str = MOUNTINFO_PATH):
+        self.by_partuuid_path = by_partuuid_path
+        self.sysfs_path = sysfs_path
+        self.udev_data_path = udev_data_path
+        self.mountinfo_path = mountinfo_path
+        self._devices: dict[str, BlockDevice] | None = None
+        self._lock = threading.Lock()
+
+    def _part_uuids(self) -> dict[str, str]:
+        """PARTUUID -> partition name, like nvme0n1p1"""
+        try:
+            with os.scandir(self.by_partuuid_path) as links:
+                return {link.name.lower(): os.path.basename(os.readlink(link.path)) for link in links}
+        except OSError as e:
+            logging.debug("Could not scan %s: %s", self.by_partuuid_path, e)
+        part_uuids = {}
+        try:
+            names = os.listdir(self.sysfs_path)
+        except OSError as e:
+            logging.warning("Could not scan %s: %s", self.sysfs_path, e)
+            return part_uuids
+        for name in names:
+            try:
+                dev = read_sysfs_attribute(os.path.join(self.sysfs_path, name, 'dev'))
+            except OSError:
+                continue
+            part_uuid = read_udev_properties(dev, self.udev_data_path).get('ID_PART_ENTRY_UUID')
+            if part_uuid:
+                part_uuids[part_uuid.lower()] = name
+        return part_uuids
+
+    def _build(self) -> dict[str, BlockDevice]:
+        try:
+            mount_points = {}
+            # A partition mounted more than once, like through bind mounts, shows its shortest mount point
+            for mount_point, (dev, _, _) in sorted(parse_mountinfo(self.mountinfo_path).items(), reverse=True,
+                                                  key=lambda item: len(item[0])):
+                mount_points[dev] = mount_point
+        except OSError as e:
+            logging.warning("Could not read %s: %s", self.mountinfo_path, e)
+            mount_points = {}
+        devices = {}
+        for part_uuid, name in self._part_uuids().items():
+            part_dir = os.path.join(self.sysfs_path, name)
+            try:
+                # Links to the partition under its disk: reading the link is cheaper than resolving it
+                disk = os.path.basename(os.path.dirname(os.readlink(part_dir)))
+                # One read for the partition number and major:minor, rather than a file each
+                with open(os.path.join(part_dir, 'uevent')) as f:
+                    uevent = dict(line.split('=', 1) for line in f.read().splitlines())
+                number = int(uevent['PARTN'])
+                dev = f"{uevent['MAJOR']}:{uevent['MINOR']}"
+            except (OSError, ValueError, KeyError):
+                continue
+            devices[part_uuid] = BlockDevice('/dev/' + name, '/dev/' + disk, number, mount_points.get(dev))
+        logging.debug("Indexed %d partitions", len(devices))
+        return devices
+
+    def devices(self) -> dict[str, BlockDevice]:
+        """Builds the index on first use"""
+        with self._lock:
+            if self._devices is None:
+                self._devices = self._build()
+            return self._devices
+
+    def resolve(self, partition: PartitionInfo | None) -> BlockDevice | None:
+        if partition is None:
+            return None
+        return self.devices().get(partition.part_uuid)
+
+    def invalidate(self):
+        """Forgets the index, for the next lookup to rebuild it, when partitions or mounts change"""
+        with self._lock:
+            self._devices = None
+
+
+_partition_index: PartitionIndex | None = None
+_partition_index_lock = threading.Lock()
+
+
+def get_partition_index() -> PartitionIndex:
+    """The index of this process, built on first lookup"""
+    global _partition_index
+    with _partition_index_lock:
+        if _partition_index is None:
+            _partition_index = PartitionIndex()
+        return _partition_index
@@ -0,0 +1,292 @@
+"""
+Offline access to the variable store of an edk2 firmware volume, like the OVMF_VARS.fd NVRAM file of a QEMU or
+libvirt virtual machine, so that boot entries of a stopped VM can be read and changed without booting it.
+
+The image is memory mapped and its variable headers are indexed in a single pass. Changes follow the firmware's own
+rules: data of the same size is rewritten in place, anything else is appended at the end of the store while the old
+copy is marked deleted, and deleted copies are reclaimed when the store runs out of room.
+
+An image is only written while nothing else holds a lock on it: QEMU locks the images of a running virtual machine
+and keeps its own copy of their contents, so it would overwrite our changes or see them half written. Holding a
+write lock in turn keeps the virtual machine from starting while the image is being changed.
+"""
+import errno
+import fcntl
+import logging
+import os
+import mmap
+import struct
+import uuid
+
+from . import efivars
+
+# EFI_FIRMWARE_VOLUME_HEADER, up to its block map
+FV_HEADER = struct.Struct('<16s16sQ4sIHHHBB')
+FV_SIGNATURE = b'_FVH'
+NV_DATA_FV_GUID = uuid.UUID('fff12b8d-7696-4c8b-a985-2747075b4f50')
+
+# VARIABLE_STORE_HEADER
+STORE_HEADER = struct.Struct('<16sIBBHI')
+AUTHENTICATED_VARIABLE_GUID = uuid.UUID('aaf32c78-947b-439a-a180-2e144ec37792')
+VARIABLE_GUID = uuid.UUID('ddcf3616-3275-4164-98b6-fe85707ffe7d')
+STORE_FORMATTED = 0x5a
+STORE_HEALTHY = 0xfe
+
+# struct flock: type, whence, start, length (0 for up to the end of the file), pid
+FLOCK = struct.Struct('@hhqqi4x')
+
+# AUTHENTICATED_VARIABLE_HEADER and VARIABLE_HEADER: start id, state, reserved, attributes, [monotonic count,
+# timestamp, public key index,] name size, data size, vendor GUID
+AUTHENTICATED_HEADER = struct.Struct('<HBxIQ16sIII16s')
+HEADER = struct.Struct('<HBxIII16s')
+START_ID = 0x55aa
+# States only ever clear bits, as flash writes do
+VAR_IN_DELETED_TRANSITION = 0xfe
+VAR_DELETED = 0xfd
+VAR_HEADER_VALID_ONLY = 0x7f
+VAR_ADDED = 0x3f
+
+log = logging.getLogger('varstore')
+
+
+class VariableStoreError(ValueError):
+    """The file is not a firmware volume with a variable store we understand"""
+
+
+def align(offset: int) -> int:
+    return (offset + 3) & ~3
+
+
+def lock_image(f, path: str):
+    """Takes a write lock on the whole image, like QEMU does on the images of a running virtual machine. The lock
+    belongs to the open file, so it lasts until f is closed."""
+    try:
+        fcntl.fcntl(f.fileno(), fcntl.F_OFD_SETLK, FLOCK.pack(fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0))
+    except OSError as e:
+        if e.errno not in (errno.EACCES, errno.EAGAIN):
+            raise
+        raise OSError(errno.EBUSY, "The image is in use, is its virtual machine running?", path) from e
+
+
+class Variable:
+    """Where a variable lives in the store"""
+    __slots__ = ('offset', 'header_size', 'name_size', 'data_size', 'attributes', 'auth')
+
+    def __init__(self, offset: int, header_size: int, name_size: int, data_size: int, attributes: int,
+                 auth: tuple = ()):
+        self.offset = offset
+        self.header_size = header_size
+        self.name_size = name_size
+        self.data_size = data_size
+        self.attributes = attributes
+        # Monotonic count, timestamp and public key index of authenticated stores, kept across rewrites
+        self.auth = auth
+
+    @property
+    def data_offset(self) -> int:
+        return self.offset + self.header_size + self.name_size
+
+    @property
+    def end(self) -> int:
+        return align(self.data_offset + self.data_size)
+
+
+class VariableStore:
+    """Variable store of a firmware volume image, memory mapped. Use it as a context manager: changes are flushed to
+    the file when it is closed."""
+
+    def __init__(self, path: str, writable: bool = False):
+        self.path = path
+        self.writable = writable
+        # Kept open while writable, for the lock
+        self._file = open(path, 'r+b' if writable else 'rb')
+        try:
+            if writable:
+                lock_image(self._file, path)
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        except ValueError as e:
+            self._file.close()
+            raise VariableStoreError(f"{path} is empty") from e
+        except OSError:
+            self._file.close()
+            raise
+        if not writable:
+            self._file.close()
+        try:
+            self._open()
+        except (VariableStoreError, struct.error) as e:
+            self._map.close()
+            self._file.close()
+            raise VariableStoreError(f"{path}: {e}") from e
+        # (vendor GUID as stored, name) -> valid variable
+        self._index: dict[tuple[bytes, str], Variable] = {}
+        self._free = self.start
+        self._scan()
+
+    def _open(self):
+        _, guid, length, signature, _, header_length, _, _, _, _ = FV_HEADER.unpack_from(self._map)
+        if signature != FV_SIGNATURE or uuid.UUID(bytes_le=guid) != NV_DATA_FV_GUID:
+            raise VariableStoreError("not a firmware volume holding variables")
+        guid, size, store_format, state, _, _ = STORE_HEADER.unpack_from(self._map, header_length)
+        guid = uuid.UUID(bytes_le=guid)
+        if guid not in (AUTHENTICATED_VARIABLE_GUID, VARIABLE_GUID):
+            raise VariableStoreError(f"unknown variable store {guid}")
+        if store_format != STORE_FORMATTED or state != STORE_HEALTHY:
+            raise VariableStoreError("variable store not formatted or not healthy")
+        self.authenticated = guid == AUTHENTICATED_VARIABLE_GUID
+        self._header = AUTHENTICATED_HEADER if self.authenticated else HEADER
+        self.start = align(header_length + STORE_HEADER.size)
+        self.end = min(header_length + size, length, len(self._map))
+
+    def _scan(self):
+        """Indexes the valid variables, up to the first free byte"""
+        unpack_from = self._header.unpack_from
+        header_size = self._header.size
+        mapped = self._map
+        index = self._index
+        offset = self.start
+        while offset + header_size <= self.end:
+            fields = unpack_from(mapped, offset)
+            if fields[0] != START_ID:
+                break
+            start_id, state, attributes, *auth, name_size, data_size, guid = fields
+            name_offset = offset + header_size
+            end = align(name_offset + name_size + data_size)
+            if end > self.end:
+                log.warning("%s: variable at %#x overruns the store", self.path, offset)
+                break
+            if state == VAR_ADDED or state == VAR_ADDED & VAR_IN_DELETED_TRANSITION:
+                key = guid, mapped[name_offset:name_offset + name_size].decode('utf-16-le').rstrip('\0')
+                # A copy caught in the middle of an update loses to the one that replaced it
+                if state == VAR_ADDED or key not in index:
+                    index[key] = Variable(offset, header_size, name_size, data_size, attributes, tuple(auth))
+            offset = end
+        self._free = offset
+
+    def close(self):
+        if self._map.closed:
+            return
+        if self.writable:
+            self._map.flush()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self) -> 'VariableStore':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def free_space(self) -> int:
+        return self.end - self._free
+
+    def variables(self, guid: str = efivars.EFI_GLOBAL_GUID) -> list[str]:
+        guid = uuid.UUID(guid).bytes_le
+        return [name for vendor, name in self._index if vendor == guid]
+
+    def get(self, name: str, guid: str = efivars.EFI_GLOBAL_GUID) -> tuple[bytes, int] | tuple[None, None]:
+        """Data and attributes of a variable, like efivars.get_variable_data"""
+        variable = self._index.get((uuid.UUID(guid).bytes_le, name))
+        if variable is None:
+            return None, None
+        start = variable.data_offset
+        return self._map[start:start + variable.data_size], variable.attributes
+
+    def _set_state(self, variable: Variable, mask: int):
+        self._map[variable.offset + 2] &= mask
+
+    def _record(self, encoded_name: bytes, guid: bytes, data: bytes, attributes: int, auth: tuple) -> bytes:
+        if self.authenticated:
+            header = AUTHENTICATED_HEADER.pack(START_ID, VAR_ADDED, attributes, *(auth or (0, bytes(16), 0)),
+                                               len(encoded_name), len(data), guid)
+        else:
+            header = HEADER.pack(START_ID, VAR_ADDED, attributes, len(encoded_name), len(data), guid)
+        record = header + encoded_name + data
+        return record + b'\xff' * (align(len(record)) - len(record))
+
+    def set(self, name: str, data: bytes, attributes: int = efivars.DEFAULT_ATTRIBUTES,
+            guid: str = efivars.EFI_GLOBAL_GUID) -> bool:
+        """Sets a variable, unless it already holds data with the same attributes. Returns whether it wrote."""
+        key = uuid.UUID(guid).bytes_le, name
+        variable = self._index.get(key)
+        if variable is not None:
+            if variable.attributes == attributes and variable.data_size == len(data):
+                start = variable.data_offset
+                if self._map[start:start + len(data)] == data:
+                    return False
+                self._map[start:start + len(data)] = data
+                log.debug("Rewrote %s in place", name)
+                return True
+        auth = variable.auth if variable is not None else ()
+        encoded_name = (name + '\0').encode('utf-16-le')
+        record = self._record(encoded_name, key[0], data, attributes, auth)
+        if len(record) > self.free_space:
+            self.reclaim(exclude=variable)
+            variable = self._index.get(key)
+            if len(record) > self.free_space:
+                raise OSError(errno.ENOSPC, f"No room left in the variable store for {name}", self.path)
+        offset = self._free
+        self._map[offset:offset + len(record)] = record
+        if variable is not None:
+            self._set_state(variable, VAR_DELETED)
+        self._index[key] = Variable(offset, self._header.size, len(encoded_name), len(data), attributes, auth)
+        self._free = offset + len(record)
+        log.debug("Appended %s (%d bytes)", name, len(data))
+        return True
+
+    def delete(self, name: str, guid: str = efivars.EFI_GLOBAL_GUID) -> bool:
+        variable = self._index.pop((uuid.UUID(guid).bytes_le, name), None)
+        if variable is None:
+            return False
+        self._set_state(variable, VAR_DELETED)
+        log.debug("Deleted %s", name)
+        return True
+
+    def reclaim(self, exclude: Variable | None = None):
+        """Packs the valid variables at the start of the store, dropping deleted copies and exclude, which the
+        caller is about to replace"""
+        records = []
+        for key, variable in self._index.items():
+            if variable is not exclude:
+                record = bytearray(self._map[variable.offset:variable.end])
+                record[2] = VAR_ADDED
+                records.append((key, variable, bytes(record)))
+        offset = self.start
+        packed = bytearray()
+        index = {}
+        for key, variable, record in records:
+            index[key] = Variable(offset + len(packed), variable.header_size, variable.name_size, variable.data_size,
+                                  variable.attributes, variable.auth)
+            packed += record
+        used = self._free - self.start
+        self._map[self.start:self._free] = bytes(packed) + b'\xff' * (used - len(packed))
+        self._index = index
+        self._free = self.start + len(packed)
+        log.debug("Reclaimed %d bytes", used - len(packed))
+
+
+class VarstoreWriter(efivars.EfivarsWriter):
+    """EfivarsWriter for the variable store of a firmware image instead of efivarfs"""
+
+    def __init__(self, store: VariableStore):
+        super().__init__(store.path)
+        self.store = store
+
+    def read_variable(self, var_name: str) -> tuple[bytes, int] | tuple[None, None]:
+        return self.store.get(var_name)
+
+    def list_variables(self) -> list[str]:
+        return self.store.variables()
+
+    def write_variable(self, var_name: str, data: bytes, attributes: int = efivars.DEFAULT_ATTRIBUTES) -> bool:
+        return self.store.set(var_name, data, attributes)
+
+    def delete_variable(self, var_name: str):
+        self.store.delete(var_name)
+
+
+def read_boot_variables(path: str) -> dict[str, bytes]:
+    """The variables EfibootmgrEfivars.parse reads, from the image at path"""
+    with VariableStore(path) as store:
+        return {name: store.get(name)[0] for name in store.variables() if efivars.is_boot_variable(name)}
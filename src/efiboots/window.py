@@ -4,15 +4,26 @@ import re
 import logging
 import gi
 import os
+import threading
 
 from typing import Callable
 from gettext import gettext as _
 
-from .efibootmgr import Efibootmgr
-from .utils import auto_detect_esp, subprocess_run_wrapper
+from . import efivars, loadercheck, signatures
+from .authenticode import AuthenticodeHasher, PeDigest
+from .signatures import SignatureDatabases
+from .efibootmgr import Efibootmgr, EfibootmgrEfivars, ParsedEfibootmgr
+from .loadercheck import LoaderCheck, LoaderChecker
+from .plan import ChangePlan, PlanError, PlanReport, build_plan, execute_plan, execute_plan_as_root, \
+    execute_script_as_root
+from .profile import startup_profile
+from .session import Add, Edit, EditSession, Move, Operation, Remove, SetNext, SetTimeout, Toggle, place
+from .utils import DEV_DISK_BY_PARTUUID_PATH, PartitionInfo, auto_detect_esp, get_partition_index, is_in_flatpak
 
 gi.require_version('Gtk', '4.0')
-from gi.repository import Gtk, Gio, GObject, GLib
+from gi.repository import Gtk, Gdk, Gio, GObject, GLib
+
+from .helper import HelperClient
 
 
 def btn_with_icon(icon):
@@ -50,9 +61,50 @@ def error_dialog(transient_for: Gtk.Window, message: str, title: str, on_respons
     return dialog
 
 
-def execute_script_as_root(script):
-    logging.info("Running command `pkexec sh -c %s`", script)
-    subprocess_run_wrapper(["pkexec", "sh", "-c", script])
+def run_in_thread(func: Callable, on_done: Callable, on_error: Callable):
+    """Runs func in a worker thread, then on_done(result) or on_error(exception) in the main loop"""
+    def idle(callback, arg):
+        callback(arg)
+        return GLib.SOURCE_REMOVE
+
+    def worker():
+        try:
+            result = func()
+        except Exception as e:
+            GLib.idle_add(idle, on_error, e)
+        else:
+            GLib.idle_add(idle, on_done, result)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+
+def apply_plan(plan: ChangePlan) -> PlanReport | None:
+    """Applies the plan through the privileged helper, falling back to pkexec when it is not installed.
+
+    Blocks until the user answered the authorization prompt: call it from a worker thread.
+    """
+    if plan.nvram_image is not None:
+        # A file of ours, no privileges needed
+        report = execute_plan(plan)
+        if not report.ok:
+            raise PlanError(report)
+        return report
+    if not is_in_flatpak():
+        try:
+            client = HelperClient()
+        except GLib.Error as e:
+            # No system bus to reach the helper on, as in some containers
+            logging.info("System bus not available (%s), falling back to pkexec", e.message)
+        else:
+            try:
+                report = client.apply_plan(plan)
+                logging.info("Applied by the helper:\n%s", report)
+                return report
+            except GLib.Error as e:
+                if not HelperClient.is_unavailable(e):
+                    raise
+                logging.info("Privileged helper not available (%s), falling back to pkexec", e.message)
+    return execute_plan_as_root(plan)
 
 
 class EfibootRowModel(GObject.Object):
@@ -65,222 +117,520 @@ class EfibootRowModel(GObject.Object):
     parameters = GObject.Property(type=str)
     active = GObject.Property(type=bool, default=True)
     next = GObject.Property(type=bool, default=False)
-
-    def __init__(self, current: bool, num: str, name: str, path: str, parameters: str, active: bool, next: bool):
-        super().__init__()
-        self.current = current
-        self.num = num
-        self.name = name
-        self.path = path
-        self.parameters = parameters
-        self.active = active
-        self.next = next
-
-        self.radio_buttons_group = Gtk.CheckButton()
+    # The partition the entry boots from, with its mount point
+    device = GObject.Property(type=str)
+    # Whether the loader is on that partition, checked in the background
+    loader_status = GObject.Property(type=str)
+    # Its Authenticode digest, or why it could not be computed
+    loader_details = GObject.Property(type=str)
+    # Whether Secure Boot would let it run, according to db and dbx
+    secure_boot = GObject.Property(type=str)
+
+    def __init__(self, current: bool, num: str, name: str, path: str, parameters: str, active: bool, next: bool,
+                 device: str = ''):
+        # All the properties in a single call, rather than one notifying set each
+        super().__init__(current=current, num=num, name=name, path=path, parameters=parameters, active=active,
+                         next=next, device=device)
+
+    def set_if_changed(self, prop: str, value):
+        # Setting a property always emits notify, which rebinds the widgets showing it
+        if self.get_property(prop) != value:
+            self.set_property(prop, value)
 
     def __str__(self):
         return f"EfibootModelRow {'current' if self.current else ''} num{self.num} {self.name} {self.path}" \
                f" {self.parameters} {'active' if self.active else 'inactive'} {'next' if self.next else ''}"
 
 
+def secure_boot_text(verdict: str | None) -> str:
+    match verdict:
+        case None:
+            return ''
+        case signatures.VERDICT_REVOKED:
+            return _("Revoked")
+        case signatures.VERDICT_ALLOWED:
+            return _("Allowed")
+        case _:
+            return _("Unknown")
+
+
+def loader_status_text(check: LoaderCheck | None) -> str:
+    if check is None:
+        return ''
+    match check.status:
+        case loadercheck.LOADER_FOUND:
+            return GLib.format_size(check.size)
+        case loadercheck.LOADER_EMPTY:
+            return _("Empty")
+        case loadercheck.LOADER_MISSING:
+            return _("Missing")
+        case _:
+            return _("Not mounted")
+
+
 class EfibootsListStore(Gio.ListStore):
     def __init__(self, window: 'EfibootsMainWindow'):
         self.window = window
         super().__init__(item_type=EfibootRowModel)
         self._efibootmgr = None
 
-        self.boot_order = []
-        self.boot_order_initial = []
-        self.boot_next = None
-        self.boot_next_initial = None
-        self.boot_active = set()
-        self.boot_inactive = set()
-        self.boot_add = {}
-        self.boot_remove = set()
+        # Local changes, with their undo history, and what NVRAM holds
+        self.session = EditSession()
         self.boot_current = None
-        self.timeout = None
-        self.timeout_initial = None
-        self.edit_parameters = set()
-        self.edit_loader = set()
-        self.edit_name = set()
+        # Partition each entry boots from, as read from NVRAM
+        self.partitions: dict[str, PartitionInfo] = {}
+        self._generation = 0
+        self._discard_pending = False
+        self._monitor = None
+        self._partitions_monitor = None
+        self._partitions_source = None
+        self.loader_checker = LoaderChecker()
+        self.hasher = AuthenticodeHasher()
+        # db and dbx are only reachable where efivarfs is
+        self.signature_databases = SignatureDatabases() if EfibootmgrEfivars.is_supported() else None
+        # Authenticode digests of the loaders found, by entry
+        self.loader_digests: dict[str, PeDigest] = {}
+        self._check_generation = 0
+        self._reload_source = None
+        # index_num() cache: positions of the rows before _positions_valid are up to date
+        self._positions: dict[str, int] = {}
+        self._positions_valid = 0
+        self.connect("items-changed", self.on_items_changed)
 
     def __str__(self):
-        return f"next: {self.boot_next} order: {self.boot_order} add: {self.boot_add} rem: {self.boot_remove} " \
-               f"active: {self.boot_active} inactive: {self.boot_inactive} timeout: {self.timeout}"
+        return str(self.session)
 
     @property
     def efibootmgr(self):
         if self._efibootmgr is None:
-            self._efibootmgr = Efibootmgr.get_instance()
+            self._efibootmgr = Efibootmgr.get_instance(self.window.backend, self.window.nvram_image)
         return self._efibootmgr
 
-    def swap(self, a, b):
-        self.boot_order[a], self.boot_order[b] = self.boot_order[b], self.boot_order[a]
-
-    def index_num(self, num):
-        for i, row in enumerate(self):
-            if row.num == num:
+    def on_items_changed(self, store: Gio.ListStore, position: int, removed: int, added: int):
+        self._positions_valid = min(self._positions_valid, position)
+
+    def index_num(self, num) -> int | None:
+        position = self._positions.get(num)
+        if position is not None and position < self._positions_valid:
+            return position
+        # Index the rows that moved since the last lookup, up to the one we are looking for
+        for i in range(self._positions_valid, self.get_n_items()):
+            row_num = self.get_item(i).num
+            self._positions[row_num] = i
+            self._positions_valid = i + 1
+            if row_num == num:
                 return i
+        return None
+
+    def do(self, op: Operation):
+        self.session.do(op)
+        logging.debug("%s", op)
+        self.window.update_history_actions()
+
+    def undo(self):
+        op = self.session.undo()
+        if op is not None:
+            logging.debug("undo: %s", op)
+            self.mirror(op)
+        self.window.update_history_actions()
+
+    def redo(self):
+        op = self.session.redo()
+        if op is not None:
+            logging.debug("redo: %s", op)
+            self.mirror(op)
+        self.window.update_history_actions()
+
+    def mirror(self, op: Operation):
+        """Shows an operation that was applied to the session, by undo or redo, in the rows"""
+        match op:
+            case Move(positions=positions, new_positions=new_positions):
+                self.place_rows(positions, new_positions)
+            case Toggle(num=num, active=active):
+                self.get_item(self.index_num(num)).set_if_changed('active', active)
+            case Add(num=num, entry=entry, active=active, position=position):
+                row = EfibootRowModel(num == self.boot_current, num, *entry, active, num == self.session.boot_next,
+                                      self.device_text(num))
+                self.insert(min(position, self.get_n_items()), row)
+                self.check_loaders()
+            case Remove(num=num):
+                super().remove(self.index_num(num))
+            case Edit(num=num, new=(label, path, parameters)):
+                row = self.get_item(self.index_num(num))
+                row.set_if_changed('name', label)
+                row.set_if_changed('path', path)
+                row.set_if_changed('parameters', parameters)
+                self.check_loaders()
+            case SetNext(old=old, new=new):
+                self.window.show_boot_next(new)
+                for num in (old, new):
+                    position = self.index_num(num) if num is not None else None
+                    if position is not None:
+                        self.get_item(position).set_if_changed('next', num == new)
+            case SetTimeout(new=timeout):
+                if timeout is not None:
+                    self.window.timeout_spin.set_value(timeout)
+
+    def place_rows(self, positions, new_positions):
+        """Moves the rows at positions to new_positions, the others keeping their order, with a single splice"""
+        start = min(*positions, *new_positions)
+        end = max(*positions, *new_positions) + 1
+        rows = [self.get_item(i) for i in range(start, end)]
+        self.splice(start, len(rows), place(rows, [p - start for p in positions], [p - start for p in new_positions]))
+
+    def move_rows(self, positions: list[int], position: int) -> list[int]:
+        """Moves the rows at positions next to each other, in their order, the first one to position: a single
+        splice and a single edit to the boot order, however far they go. Returns where they ended up."""
+        n_items = self.get_n_items()
+        positions = sorted({p for p in positions if 0 <= p < n_items})
+        if not positions:
+            return []
+        position = max(0, min(position, n_items - len(positions)))
+        new_positions = list(range(position, position + len(positions)))
+        if positions != new_positions:
+            start = min(positions[0], position)
+            end = max(positions[-1], new_positions[-1]) + 1
+            nums = [self.get_item(i).num for i in range(start, end)]
+            self.do(self.session.plan_move(nums, positions, new_positions, start))
+            self.place_rows(positions, new_positions)
+        return new_positions
 
     def clear(self):
         self.remove_all()
-        self.boot_order = []
-        self.boot_order_initial = []
-        self.boot_next: str | None = None
-        self.boot_next_initial: str | None = None
-        self.boot_active = set()
-        self.boot_inactive = set()
-        self.boot_add = {}
-        self.boot_remove = set()
         self.boot_current = None
-        self.timeout = None
-        self.timeout_initial = None
-        self.edit_parameters = set()
-        self.edit_loader = set()
-        self.edit_name = set()
+        self.session.reset()
+        self.window.update_history_actions()
 
-    def refresh(self):
-        self.clear()
+    def watch(self, efivars_path: str = efivars.EFIVARS_PATH):
+        """Reloads whenever someone, including us, changes boot variables"""
+        if self.window.nvram_image is not None or is_in_flatpak() or not os.path.isdir(efivars_path):
+            return
+        self._monitor = Gio.File.new_for_path(efivars_path).monitor_directory(Gio.FileMonitorFlags.NONE, None)
+        self._monitor.connect("changed", self.on_efivars_changed)
+        self.watch_partitions()
 
-        try:
-            boot = self.efibootmgr.run()
-        except (FileNotFoundError, subprocess.CalledProcessError) as e:
-            logging.exception("Error running efibootmgr. Please check that it is correctly installed.")
+    def watch_partitions(self, by_partuuid_path: str = DEV_DISK_BY_PARTUUID_PATH):
+        """Rebuilds the partition index when udev adds or removes partitions"""
+        if not os.path.isdir(by_partuuid_path):
+            return
+        self._partitions_monitor = Gio.File.new_for_path(by_partuuid_path).monitor_directory(
+            Gio.FileMonitorFlags.NONE, None)
+        self._partitions_monitor.connect("changed", self.on_partitions_changed)
+
+    def on_partitions_changed(self, *args):
+        # Plugging a disk creates a link for each of its partitions
+        if self._partitions_source is None:
+            self._partitions_source = GLib.timeout_add(500, self.on_partitions_timeout)
+
+    def on_partitions_timeout(self):
+        self._partitions_source = None
+        index = get_partition_index()
+        index.invalidate()
+        # Build it again in a worker thread: the rows only look it up
+        run_in_thread(index.devices, lambda _: self.update_devices(),
+                      lambda e: logging.warning("Could not index partitions: %s", e))
+        return GLib.SOURCE_REMOVE
+
+    def device_text(self, num: str) -> str:
+        """Where the partition of entry num is, or whether it is missing from this system"""
+        partition = self.partitions.get(num)
+        if partition is None or self.window.nvram_image is not None:
+            # The disks of a virtual machine are not ours
+            return ''
+        index = get_partition_index()
+        device = index.resolve(partition)
+        if device is None:
+            # Without any partition, like in a sandbox, we just can't tell
+            return _("Missing") if index.devices() else ''
+        return f'{device.device} ({device.mount_point})' if device.mount_point else device.device
+
+    def update_devices(self):
+        for row in self:
+            row.set_if_changed('device', self.device_text(row.num))
+        self.check_loaders()
+
+    def check_loaders(self):
+        """Looks for the loader of each row on its partition in a worker thread, then shows what it found.
+
+        Results are cached as long as the files don't change, so calling this after every change is cheap.
+        """
+        if self.window.nvram_image is not None:
+            return
+        self._check_generation += 1
+        generation = self._check_generation
+        index = get_partition_index()
+        checks = []
+        for row in self:
+            partition = self.partitions.get(row.num)
+            device = index.resolve(partition) if partition is not None else None
+            if device is None:
+                # Not booting from a partition, a partition that is gone or an entry that is not saved yet
+                row.set_if_changed('loader_status', '')
+                self.forget_loader(row)
+            else:
+                checks.append((row.num, device.mount_point, row.path))
+
+        def check():
+            return [(num, self.loader_checker.check(mount_point, path)) for num, mount_point, path in checks]
+
+        def on_done(results: list[tuple[str, LoaderCheck | None]]):
+            # Rows changed in the meantime, a newer check is on its way
+            if generation != self._check_generation:
+                return
+            found = {}
+            for num, result in results:
+                position = self.index_num(num)
+                if position is not None:
+                    self.get_item(position).set_if_changed('loader_status', loader_status_text(result))
+                    if result is not None and result.status == loadercheck.LOADER_FOUND:
+                        found[num] = result.path
+                    else:
+                        self.forget_loader(self.get_item(position))
+            self.hash_loaders(generation, found)
+
+        run_in_thread(check, on_done, lambda e: logging.warning("Could not check loaders: %s", e))
+
+    def forget_loader(self, row: EfibootRowModel):
+        row.set_if_changed('loader_details', '')
+        row.set_if_changed('secure_boot', '')
+        self.loader_digests.pop(row.num, None)
+
+    def hash_loaders(self, generation: int, loaders: dict[str, str]):
+        """Computes the Authenticode digests of the loaders found, by entry, and looks them up in db and dbx in a
+        worker thread. Only new or changed files are hashed, the others come from the digest cache."""
+        def hash_and_judge() -> tuple[dict[str, PeDigest | Exception], dict[str, str]]:
+            digests = self.hasher.digests(list(set(loaders.values())))
+            verdicts = {}
+            if self.signature_databases is not None:
+                # db and dbx are parsed again only if they changed
+                verdicts = {path: self.signature_databases.verdict(digest.sha256)
+                            for path, digest in digests.items() if isinstance(digest, PeDigest)}
+            return digests, verdicts
+
+        def on_done(result: tuple[dict[str, PeDigest | Exception], dict[str, str]]):
+            if generation != self._check_generation:
+                return
+            digests, verdicts = result
+            for num, path in loaders.items():
+                position = self.index_num(num)
+                if position is None:
+                    continue
+                row = self.get_item(position)
+                digest = digests[path]
+                if isinstance(digest, PeDigest):
+                    self.loader_digests[num] = digest
+                    details = _("Authenticode SHA-256: {}").format(digest.sha256.hex())
+                    if not digest.signed:
+                        details += "\n" + _("Not signed")
+                else:
+                    self.loader_digests.pop(num, None)
+                    details = str(digest)
+                row.set_if_changed('loader_details', details)
+                row.set_if_changed('secure_boot', secure_boot_text(verdicts.get(path)))
+
+        if loaders:
+            run_in_thread(hash_and_judge, on_done, lambda e: logging.warning("Could not hash loaders: %s", e))
+
+    def on_efivars_changed(self, monitor: Gio.FileMonitor, file: Gio.File, other_file: Gio.File | None,
+                           event_type: Gio.FileMonitorEvent):
+        name = file.get_basename()
+        suffix = '-' + efivars.EFI_GLOBAL_GUID
+        if not name.endswith(suffix):
+            return
+        var_name = name[:-len(suffix)]
+        if var_name not in ('BootOrder', 'BootNext', 'BootCurrent', 'Timeout') and \
+                not efivars.is_boot_entry_variable(var_name):
+            return
+        # A single efibootmgr run touches several variables: coalesce their events into one reload
+        if self._reload_source is None:
+            self._reload_source = GLib.timeout_add(200, self.on_reload_timeout)
+
+    def on_reload_timeout(self):
+        self._reload_source = None
+        logging.debug("Boot variables changed, reloading")
+        self.refresh(keep_pending=True)
+        return GLib.SOURCE_REMOVE
+
+    def refresh(self, keep_pending: bool = False):
+        """Reloads boot entries in a worker thread, leaving the main loop free while efibootmgr runs.
+
+        With keep_pending, local changes that are not saved yet survive the reload, otherwise they are discarded.
+        """
+        self._generation += 1
+        generation = self._generation
+        if not keep_pending:
+            self._discard_pending = True
+            self.window.set_loading(True)
+            # Mounts change without udev telling us
+            get_partition_index().invalidate()
+
+        def on_done(parsed_efi: ParsedEfibootmgr | None):
+            # A newer refresh was started in the meantime: its result wins
+            if generation == self._generation:
+                self.window.set_loading(False)
+                with startup_profile.timed('model fill'):
+                    self.populate(parsed_efi, keep_pending=not self._discard_pending)
+                self._discard_pending = False
+                self.window.on_entries_shown()
+
+        def on_error(e: Exception):
+            if generation == self._generation:
+                self.window.set_loading(False)
+                self._discard_pending = False
+                self.on_load_error(e)
+
+        run_in_thread(self.load, on_done, on_error)
+
+    def load(self) -> ParsedEfibootmgr | None:
+        """Runs in a worker thread: must not touch the model or any widget"""
+        if startup_profile.enabled and not startup_profile.finished:
+            # Not streamed, to time running efibootmgr (or reading efivarfs) and parsing separately
+            with startup_profile.timed('read boot entries'):
+                boot = self.efibootmgr.run()
+            with startup_profile.timed('parse boot entries'):
+                parsed = self.efibootmgr.parse(boot)
+        else:
+            parsed = self.efibootmgr.read()
+        if self.window.nvram_image is None:
+            # Built here, so that populate only looks partitions up
+            with startup_profile.timed('index partitions'):
+                get_partition_index().devices()
+        return parsed
+
+    def on_load_error(self, e: Exception):
+        if isinstance(e, (FileNotFoundError, subprocess.CalledProcessError)):
+            logging.error("Error running efibootmgr. Please check that it is correctly installed.", exc_info=e)
             error_dialog(transient_for=self.window, title=_("efibootmgr utility not installed!"),
                          message=_("Please check that the efibootmgr utility is correctly installed, as this program requires its output.") + f"\n{str(e)}",
                          on_response=lambda *_: sys.exit(-1))
-            return
-        except UnicodeDecodeError as e:
-            logging.exception("Error decoding efibootmgr -v output.")
+        elif isinstance(e, UnicodeDecodeError):
+            logging.error("Error decoding efibootmgr -v output.", exc_info=e)
             error_dialog(transient_for=self.window, title=_("Error while decoding efibootmgr output."),
                          message=_("Could not decode efiboomgr output.") + f"\n{e}", on_response=lambda *_: sys.exit(-2))
+        else:
+            logging.error("Error reading boot entries.", exc_info=e)
+            error_dialog(transient_for=self.window, title=_("Error while reading boot entries."),
+                         message=str(e), on_response=lambda *_: sys.exit(-2))
+
+    def populate(self, parsed_efi: ParsedEfibootmgr | None, keep_pending: bool = False):
+        """Updates the rows in place from parsed_efi, emitting a single items-changed for the rows that moved"""
+        if parsed_efi is None:
+            self.clear()
             return
 
-        if boot is not None:
-            parsed_efi = self.efibootmgr.parse(boot)
-            for entry in parsed_efi.entries:
-                row = EfibootRowModel(entry.num == parsed_efi.boot_current,
-                                      entry.num,
-                                      entry.name,
-                                      entry.path,
-                                      entry.parameters,
-                                      entry.active,
-                                      entry.num == parsed_efi.boot_next)
-                self.append(row)
-
-            self.boot_order_initial = parsed_efi.boot_order
-            self.boot_order = list(self.boot_order_initial)
-            self.boot_next = self.boot_next_initial = parsed_efi.boot_next
-            self.boot_current = parsed_efi.boot_current
-            self.timeout = self.timeout_initial = parsed_efi.timeout
-            self.window.timeout_spin.set_value(self.timeout)
-
-            self.sort(self.sort_by_boot_order)
+        session = self.session
+        entries = {entry.num: ((entry.name, entry.path, entry.parameters), entry.active)
+                   for entry in parsed_efi.entries}
+        if keep_pending:
+            session.rebase(parsed_efi.boot_order, parsed_efi.boot_next, parsed_efi.timeout, entries)
+        else:
+            session.reset(parsed_efi.boot_order, parsed_efi.boot_next, parsed_efi.timeout, entries)
+        self.boot_current = parsed_efi.boot_current
+        self.partitions = {entry.num: entry.partition for entry in parsed_efi.entries if entry.partition is not None}
+        if session.timeout is not None:
+            self.window.timeout_spin.set_value(session.timeout)
+
+        rows = {row.num: row for row in self}
+        new_rows = []
+        for num in entries:
+            if num in session.removed:
+                continue
+            (name, path, parameters), active = session.entry(num)
+            row = rows.get(num)
+            if row is None:
+                row = EfibootRowModel(False, num, name, path, parameters, active, False, self.device_text(num))
+            else:
+                row.set_if_changed('device', self.device_text(num))
+                row.set_if_changed('name', name)
+                row.set_if_changed('path', path)
+                row.set_if_changed('parameters', parameters)
+                row.set_if_changed('active', active)
+            row.set_if_changed('current', num == self.boot_current)
+            row.set_if_changed('next', num == session.boot_next)
+            new_rows.append(row)
+
+        unordered = len(session.boot_order)
+        new_rows.sort(key=lambda r: session.boot_order.rank(r.num, unordered))
+        # Entries being added are not saved yet: keep them at the bottom
+        new_rows += [row for row in self if row.num in session.added]
+        self.replace_rows(new_rows)
+        self.window.update_history_actions()
+        self.check_loaders()
+
+    def replace_rows(self, new_rows: list['EfibootRowModel']):
+        """Splices only the range that differs between the current rows and new_rows, keeping the selection"""
+        old_rows = list(self)
+        selected = {id(self.get_item(position)) for position in self.window.selected_positions()}
+        start = 0
+        while start < min(len(old_rows), len(new_rows)) and old_rows[start] is new_rows[start]:
+            start += 1
+        end_old, end_new = len(old_rows), len(new_rows)
+        while end_old > start and end_new > start and old_rows[end_old - 1] is new_rows[end_new - 1]:
+            end_old -= 1
+            end_new -= 1
+        if start == end_old and start == end_new:
+            return
+        self.splice(start, end_old - start, new_rows[start:end_new])
+        if selected:
+            self.window.select_positions([position for position, row in enumerate(new_rows) if id(row) in selected])
 
     def sort_by_boot_order(self, row1: EfibootRowModel, row2: EfibootRowModel) -> int:
-        row1_index = self.boot_order.index(row1.num)
-        row2_index = self.boot_order.index(row2.num)
-        return row1_index - row2_index
+        boot_order = self.session.boot_order
+        unordered = len(boot_order)
+        return boot_order.rank(row1.num, unordered) - boot_order.rank(row2.num, unordered)
 
     def change_boot_next(self, action: Gio.SimpleAction, num_variant: GLib.Variant):
         num = num_variant.get_string()
-        if self.boot_next == num:
-            action.set_state(GLib.Variant.new_string(""))
-            self.boot_next = None
-        else:
-            action.set_state(num_variant)
-            self.boot_next = num
+        boot_next = None if self.session.boot_next == num else num
+        action.set_state(GLib.Variant.new_string(boot_next or ""))
+        self.do(SetNext(self.session.boot_next, boot_next))
         logging.debug("%s changed to %s", action.get_name(), action.get_state())
 
     def change_active(self, widget: Gtk.Switch, state: bool, row: EfibootRowModel):
         row.active = state
-        num = row.num
-        if row.active:
-            if num in self.boot_inactive:
-                self.boot_inactive.remove(num)
-            else:
-                self.boot_active.add(num)
-        else:
-            if num in self.boot_active:
-                self.boot_active.remove(num)
-            else:
-                self.boot_inactive.add(num)
+        # Undo and redo flip the switch too: that's not a new change
+        if self.session.entry(row.num)[1] != state:
+            self.do(Toggle(row.num, state))
 
-        logging.debug("%s %s %s", row, self.boot_active, self.boot_inactive)
+    def change_timeout(self, timeout: int):
+        if timeout != self.session.timeout:
+            self.do(SetTimeout(self.session.timeout, timeout))
 
     def add(self, label, path, parameters):
-        new_num = "NEW{:d}".format(len(self.boot_add))
+        new_num = self.session.new_num()
         row = EfibootRowModel(False, new_num, label, path, parameters, True, False)
+        self.do(Add(new_num, (label, path, parameters), True, self.get_n_items()))
         self.append(row)
-        self.boot_add[new_num] = (label, path, parameters)
 
     def modify(self, position: int, label: str, path: str, parameters: str):
         item: EfibootRowModel | None = self.get_item(position)
         if item is not None:
+            old = (item.name, item.path, item.parameters)
+            if old == (label, path, parameters):
+                return
             item.name = label
             item.path = path
             item.parameters = parameters
-            num: str = item.num
-            if num.startswith('NEW'):
-                self.boot_add[num] = (label, path, parameters)
-            else:
-                self.edit_name.add(num)
-                self.edit_loader.add(num)
-                self.edit_parameters.add(num)
+            self.do(Edit(item.num, old, (label, path, parameters)))
+            self.check_loaders()
 
     def remove(self, position: int):
         item: EfibootRowModel | None = self.get_item(position)
         if item is not None:
             num: str = item.num
-            if num.startswith('NEW'):
-                del self.boot_add[num]
-            else:
-                self.boot_remove.add(num)
-                self.boot_order.remove(num)
-                # Also remove from edit sets if present
-                self.edit_name.discard(num)
-                self.edit_loader.discard(num)
-                self.edit_parameters.discard(num)
+            self.do(Remove(num, (item.name, item.path, item.parameters), item.active, position,
+                           self.session.boot_order.rank(num)))
             super().remove(position)
 
-    def pending_changes(self):
-        logging.debug("%s", self)
-        return (self.boot_next_initial != self.boot_next or
-                self.boot_order_initial != self.boot_order or self.boot_add or
-                self.boot_remove or self.boot_active or self.boot_inactive
-                or self.timeout != self.timeout_initial or
-                self.edit_name or self.edit_loader or self.edit_parameters
-                )
+    def pending_changes(self) -> bool:
+        return self.session.dirty
+
+    def to_plan(self, disk, part, reboot) -> ChangePlan:
+        return build_plan(disk, part, **self.session.plan_arguments(), reboot=reboot,
+                          native=isinstance(self.efibootmgr, EfibootmgrEfivars), nvram_image=self.window.nvram_image)
 
     def to_script(self, disk, part, reboot):
-        esp = f"--disk {disk} --part {part}"
-        script = ''
-        for entry in self.boot_remove:
-            script += f'efibootmgr {esp} --delete-bootnum --bootnum {entry}\n'
-        for label, loader, params in self.boot_add.values():
-            script += f'efibootmgr {esp} --create --label \'{label}\' --loader \'{loader}\' --unicode \'{params}\'\n'
-        for entry_num in (self.edit_name | self.edit_loader | self.edit_parameters):
-            if entry_num.startswith('NEW') or entry_num in self.boot_remove:
-                continue
-            row_idx = self.index_num(entry_num)
-            row = self.get_item(row_idx)
-            script += f'efibootmgr {esp} --bootnum {entry_num} --label \'{row.name}\' --loader \'{row.path}\' --unicode \'{row.parameters}\'\n'
-        if self.boot_order != self.boot_order_initial:
-            script += f'efibootmgr {esp} --bootorder {",".join(self.boot_order)}\n'
-        if self.boot_next_initial != self.boot_next:
-            if self.boot_next is None:
-                script += f'efibootmgr {esp} --delete-bootnext\n'
-            else:
-                script += f'efibootmgr {esp} --bootnext {self.boot_next}\n'
-        for entry in self.boot_active:
-            script += f'efibootmgr {esp} --bootnum {entry} --active\n'
-        for entry in self.boot_inactive:
-            script += f'efibootmgr {esp} --bootnum {entry} --inactive\n'
-        if self.timeout != self.timeout_initial:
-            script += f'efibootmgr {esp} --timeout {self.timeout}\n'
-        if reboot:
-            script += "reboot\n"
-        return script
+        return self.to_plan(disk, part, reboot).to_script()
 
 
 @Gtk.Template(resource_path='/ovh/elinvention/Efiboots/gtk/main.ui')
@@ -300,24 +650,44 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
 
     timeout_spin: Gtk.SpinButton = Gtk.Template.Child()
 
+    save_button: Gtk.Button = Gtk.Template.Child()
+    reboot_button: Gtk.Button = Gtk.Template.Child()
+    refresh_button: Gtk.Button = Gtk.Template.Child()
+    loading_spinner: Gtk.Spinner = Gtk.Template.Child()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.APP_VERSION: str = kwargs['application'].APP_VERSION
+        self.backend: str | None = kwargs['application'].backend
+        self.nvram_image: str | None = kwargs['application'].nvram_image
         self.part: str | None = None
         self.disk: str | None = None
+        self.loading = False
+        self.about_dialog: Gtk.AboutDialog | None = None
+        self._first_paint_done = False
+        self._entries_shown = False
+        if startup_profile.enabled:
+            self.connect('realize', self.on_realize_profile)
         self.model = EfibootsListStore(self)
-        self.selection_model = Gtk.SingleSelection(model=self.model)
+        self.selection_model = Gtk.MultiSelection(model=self.model)
         self.column_view.set_model(self.selection_model)
+        # Switches of the rows on screen, to find the row under the pointer when dragging
+        self._row_widgets: dict[Gtk.Widget, Gtk.ListItem] = {}
+        self.model.watch()
+        if self.nvram_image is not None:
+            self.set_title(f"Efiboots — {os.path.basename(self.nvram_image)}")
         self.timeout_spin.set_adjustment(Gtk.Adjustment(lower=0, step_increment=1, upper=999))
 
         def on_setup_active(_: Gtk.ListItemFactory, item: Gtk.ListItem):
             switch = Gtk.Switch()
             item.set_child(switch)
+            self._row_widgets[switch] = item
 
         def on_bind_active(_: Gtk.ListItemFactory, item: Gtk.ListItem):
             row: EfibootRowModel = item.get_item()
             switch: Gtk.Switch = item.get_child()
-            switch.set_active(row.active)
+            # Follows the row when undo or redo flip it
+            switch._active_binding = row.bind_property("active", switch, "active", GObject.BindingFlags.SYNC_CREATE)
             switch._binding = switch.connect("state-set", self.model.change_active, row)
 
         def on_unbind_active(_: Gtk.ListItemFactory, item: Gtk.ListItem):
@@ -325,9 +695,11 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
             if switch._binding:
                 switch.disconnect(switch._binding)
                 switch._binding = None
+                switch._active_binding.unbind()
 
         def on_teardown_active(_: Gtk.ListItemFactory, item: Gtk.ListItem):
             switch: Gtk.Switch = item.get_child()
+            self._row_widgets.pop(switch, None)
             if switch and switch._binding:
                 switch._binding = None
 
@@ -343,6 +715,14 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
         action_next.connect("change-state", self.model.change_boot_next)
         self.add_action(action_next)
 
+        for name, callback in (("undo", self.model.undo), ("redo", self.model.redo),
+                               ("move-top", self.move_to_top), ("move-bottom", self.move_to_bottom),
+                               ("move-to", self.on_activate_move_to)):
+            action = Gio.SimpleAction.new(name, None)
+            action.connect("activate", lambda _action, _param, callback=callback: callback())
+            action.set_enabled(False)
+            self.add_action(action)
+
         about_action = Gio.SimpleAction.new("about", None)
         about_action.connect("activate", self.on_activate_about)
         self.add_action(about_action)
@@ -376,72 +756,254 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
         factory.connect("teardown", on_teardown_next_boot)
         self.column_next.set_factory(factory)
 
+        self.drag_source = Gtk.DragSource(actions=Gdk.DragAction.MOVE)
+        self.drag_source.connect("prepare", self.on_drag_prepare)
+        self.column_view.add_controller(self.drag_source)
+        drop_target = Gtk.DropTarget.new(GObject.TYPE_STRING, Gdk.DragAction.MOVE)
+        drop_target.connect("accept", lambda _, drop: self.is_own_drag(drop))
+        drop_target.connect("drop", self.on_drop)
+        self.column_view.add_controller(drop_target)
+
         self.add_css_class("devel")
 
         # Connect signals for sensitivity
-        self.selection_model.connect("notify::selected", self.update_sensitivity)
-        self.model.connect("items-changed", self.update_sensitivity)
-        GLib.idle_add(self.update_sensitivity)
-
-    def update_sensitivity(self, *args):
-        selected_index = self.selection_model.get_selected()
+        self._sensitivity_source = None
+        self.selection_model.connect("selection-changed", self.queue_sensitivity_update)
+        self.model.connect("items-changed", self.queue_sensitivity_update)
+        self.queue_sensitivity_update()
+
+    def queue_sensitivity_update(self, *args):
+        """Updates the buttons once the current burst of changes is over, however many signals it emitted"""
+        if self._sensitivity_source is None:
+            self._sensitivity_source = GLib.idle_add(self.update_sensitivity)
+
+    def update_sensitivity(self):
+        self._sensitivity_source = None
+        selected = self.selected_positions()
         n_items = self.model.get_n_items()
-        has_selection = selected_index != Gtk.INVALID_LIST_POSITION
+        has_selection = bool(selected)
 
         self.remove.set_sensitive(has_selection)
         self.edit.set_sensitive(has_selection)
         self.duplicate.set_sensitive(has_selection)
 
-        self.up.set_sensitive(has_selection and selected_index > 0)
-        self.down.set_sensitive(has_selection and selected_index < n_items - 1)
+        # Already at the top or at the bottom, all next to each other
+        at_top = selected == list(range(len(selected)))
+        at_bottom = selected == list(range(n_items - len(selected), n_items))
+        self.up.set_sensitive(has_selection and not at_top)
+        self.down.set_sensitive(has_selection and not at_bottom)
+        self.lookup_action("move-top").set_enabled(has_selection and not at_top)
+        self.lookup_action("move-bottom").set_enabled(has_selection and not at_bottom)
+        self.lookup_action("move-to").set_enabled(has_selection)
+        return GLib.SOURCE_REMOVE
+
+    def selected_positions(self) -> list[int]:
+        selection = self.selection_model.get_selection()
+        return [selection.get_nth(i) for i in range(selection.get_size())]
+
+    def select_positions(self, positions: list[int]):
+        selection = Gtk.Bitset.new_empty()
+        for position in positions:
+            selection.add(position)
+        self.selection_model.set_selection(selection, Gtk.Bitset.new_range(0, self.model.get_n_items()))
+
+    def move_selected(self, position: int):
+        """Moves the selected rows, next to each other, so that the first one lands at position"""
+        self.select_positions(self.model.move_rows(self.selected_positions(), position))
+
+    def move_to_top(self):
+        self.move_selected(0)
+
+    def move_to_bottom(self):
+        self.move_selected(self.model.get_n_items())
+
+    def row_at(self, y: float) -> tuple[int, bool] | None:
+        """Position of the row at y in the column view, and whether y is past its middle"""
+        nearest = None
+        for widget, item in self._row_widgets.items():
+            position = item.get_position()
+            if position == Gtk.INVALID_LIST_POSITION or not widget.get_mapped():
+                continue
+            ok, bounds = widget.compute_bounds(self.column_view)
+            if not ok:
+                continue
+            middle = bounds.get_y() + bounds.get_height() / 2
+            if nearest is None or abs(y - middle) < nearest[0]:
+                nearest = abs(y - middle), position, y > middle
+        return nearest and nearest[1:]
+
+    def on_drag_prepare(self, _: Gtk.DragSource, x: float, y: float) -> Gdk.ContentProvider | None:
+        row = self.row_at(y)
+        if row is None:
+            return None
+        position, _after = row
+        # Dragging a row that isn't selected drags that row alone
+        if not self.selection_model.is_selected(position):
+            self.selection_model.select_item(position, True)
+        positions = ",".join(map(str, self.selected_positions()))
+        return Gdk.ContentProvider.new_for_value(GObject.Value(GObject.TYPE_STRING, positions))
+
+    def is_own_drag(self, drop: Gdk.Drop | None) -> bool:
+        """Whether drop comes from rows dragged in this window: text dragged from other applications, or positions
+        of rows of another window, mean nothing here"""
+        drag = self.drag_source.get_drag()
+        return drop is not None and drag is not None and drop.get_drag() == drag
+
+    def on_drop(self, target: Gtk.DropTarget, value: str, x: float, y: float) -> bool:
+        row = self.row_at(y)
+        if row is None or not value or not self.is_own_drag(target.get_current_drop()):
+            return False
+        position, after = row
+        try:
+            positions = [int(p) for p in value.split(",")]
+        except ValueError:
+            return False
+        n_items = self.model.get_n_items()
+        if not all(0 <= p < n_items for p in positions):
+            return False
+        # Where the rows go among the others, which are the ones that stay in between
+        target = position + after
+        self.select_positions(self.model.move_rows(positions, target - sum(1 for p in positions if p < target)))
+        return True
+
+    def on_activate_move_to(self):
+        selected = self.selected_positions()
+        if not selected:
+            return
+        dialog = Gtk.MessageDialog(transient_for=self, modal=True, destroy_with_parent=True,
+                                   message_type=Gtk.MessageType.QUESTION, buttons=Gtk.ButtonsType.OK_CANCEL,
+                                   text=_("Move the selected entries to position:"))
+        dialog.set_title(_("Move entries"))
+        n_items = self.model.get_n_items()
+        spin = Gtk.SpinButton.new_with_range(1, max(1, n_items - len(selected) + 1), 1)
+        spin.set_value(selected[0] + 1)
+        spin.set_activates_default(True)
+        dialog.get_content_area().append(spin)
+        dialog.set_default_response(Gtk.ResponseType.OK)
+
+        def on_response(move_dialog, response):
+            if response == Gtk.ResponseType.OK:
+                self.move_selected(spin.get_value_as_int() - 1)
+            move_dialog.close()
+
+        dialog.connect('response', on_response)
+        dialog.show()
+
+    def set_loading(self, loading: bool):
+        self.loading = loading
+        self.loading_spinner.set_visible(loading)
+        self.loading_spinner.set_spinning(loading)
+        self.column_view.set_sensitive(not loading)
+        self.refresh_button.set_sensitive(not loading)
+        self.update_save_sensitivity()
+
+    def update_save_sensitivity(self):
+        # Saving needs both the entries and the ESP, which are probed concurrently. An NVRAM image only needs the
+        # ESP to create entries, and rebooting has nothing to do with it
+        can_save = not self.loading and (self.nvram_image is not None or bool(self.disk and self.part))
+        self.save_button.set_sensitive(can_save)
+        self.reboot_button.set_sensitive(can_save and self.nvram_image is None)
 
     def on_activate_about(self, action, param):
         logging.debug("on_activate_about")
-        about_builder = Gtk.Builder.new_from_resource("/ovh/elinvention/Efiboots/gtk/about.ui")
-        about_dialog: Gtk.AboutDialog = about_builder.get_object("about_dialog")
-        about_dialog.set_version(self.APP_VERSION)
-        about_dialog.set_transient_for(self)
-        about_dialog.present()
+        # Built on first use: nothing of it is needed to show the boot entries
+        if self.about_dialog is None:
+            about_builder = Gtk.Builder.new_from_resource("/ovh/elinvention/Efiboots/gtk/about.ui")
+            self.about_dialog = about_builder.get_object("about_dialog")
+            self.about_dialog.set_version(self.APP_VERSION)
+            self.about_dialog.set_transient_for(self)
+            self.about_dialog.set_hide_on_close(True)
+        self.about_dialog.present()
+
+    def on_realize_profile(self, window: Gtk.Window):
+        frame_clock = self.get_frame_clock()
+        self._after_paint_handler = frame_clock.connect('after-paint', self.on_after_paint_profile)
+
+    def on_after_paint_profile(self, frame_clock: Gdk.FrameClock):
+        if not self._first_paint_done:
+            self._first_paint_done = True
+            startup_profile.mark('first paint')
+        elif self._entries_shown:
+            startup_profile.mark('first paint with boot entries')
+            frame_clock.disconnect(self._after_paint_handler)
+            startup_profile.finish()
+
+    def on_entries_shown(self):
+        if not self._entries_shown:
+            self._entries_shown = True
+            if startup_profile.enabled:
+                # Make sure a frame follows even if the rows didn't change
+                self.queue_draw()
+            else:
+                startup_profile.finish()
 
-    def next_boot_handler(self, action: Gio.SimpleAction, state: str):
-        self.model.boot_next = state
+    def update_history_actions(self):
+        self.lookup_action("undo").set_enabled(bool(self.model.session.undo_stack))
+        self.lookup_action("redo").set_enabled(bool(self.model.session.redo_stack))
+
+    def show_boot_next(self, boot_next: str | None):
+        self.lookup_action("next_boot").set_state(GLib.Variant.new_string(boot_next or ""))
 
     def query_system(self, disk, part):
-        if not (disk and part):
-            def error_callback(esps):
-                many_esps_error_message = _("""
+        # Boot entries don't depend on the ESP: probe both concurrently, off the main loop
+        self.model.refresh()
+        if (disk and part) or self.nvram_image is not None:
+            # The ESP of the host has nothing to do with the entries of an NVRAM image
+            self.disk, self.part = disk, part
+            self.update_save_sensitivity()
+            return
+
+        def error_callback(esps):
+            many_esps_error_message = _("""
     This program detected more than one EFI System Partition on your system. You have to choose the right one.
     You can either mount your ESP on /boot/efi or pass the ESP block device via --disk and --part
     (e.g. --disk=/dev/sda --part=1).
 
     Choose wisely.
     """)
-                def on_response(*args):
-                    sys.exit(-1)
+            def on_response(*args):
+                sys.exit(-1)
+
+            def show_dialog():
                 error_dialog(self, many_esps_error_message + "\n" + _("Detected ESPs: ") + ', '.join(esps),
                              _("More than one EFI System Partition detected!"), on_response)
-
-            disk, part = auto_detect_esp(error_callback=error_callback)
-
-        if not (disk and part):
-            error_dialog(self, _("Could not find an EFI System Partition. Ensure your ESP is mounted on /efi, "
-                               "/boot/efi or /boot, that it has the correct partition type and vfat file system and that "
-                               "either findmnt or lsblk commands are installed (should be by default on most distros)."),
-                          _("Can't auto-detect ESP!"), lambda *_: sys.exit(-1))
-            return
-        self.disk, self.part = disk, part
-        self.model.refresh()
+                return GLib.SOURCE_REMOVE
+            # Called from the worker thread
+            GLib.idle_add(show_dialog)
+
+        def on_detected(result):
+            disk, part = result
+            if not (disk and part):
+                error_dialog(self, _("Could not find an EFI System Partition. Ensure your ESP is mounted on /efi, "
+                                   "/boot/efi or /boot, that it has the correct partition type and vfat file system and that "
+                                   "either findmnt or lsblk commands are installed (should be by default on most distros)."),
+                              _("Can't auto-detect ESP!"), lambda *_: sys.exit(-1))
+                return
+            self.disk, self.part = disk, part
+            self.update_save_sensitivity()
+
+        def on_error(e):
+            logging.error("ESP detection failed", exc_info=e)
+            on_detected((None, None))
+
+        def detect():
+            with startup_profile.timed('ESP probe'):
+                return auto_detect_esp(error_callback=error_callback)
+
+        run_in_thread(detect, on_detected, on_error)
     @Gtk.Template.Callback()
     def on_clicked_up(self, _: Gtk.Button):
-        index = self.selection_model.get_selected()
-        self.model.swap(index, max(index - 1, 0))
-        self.model.sort(self.model.sort_by_boot_order)
+        selected = self.selected_positions()
+        if selected:
+            self.move_selected(selected[0] - 1)
 
     @Gtk.Template.Callback()
     def on_clicked_down(self, _: Gtk.Button):
-        index = self.selection_model.get_selected()
-        self.model.swap(index, min(index + 1, len(self.model) - 1))
-        self.model.sort(self.model.sort_by_boot_order)
+        selected = self.selected_positions()
+        if selected:
+            # Rows apart from each other first close up, right below the first one
+            contiguous = selected == list(range(selected[0], selected[0] + len(selected)))
+            self.move_selected(selected[0] + 1 if contiguous else selected[0])
 
     @Gtk.Template.Callback()
     def on_clicked_add(self, __: Gtk.Button):
@@ -481,10 +1043,11 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback()
     def on_clicked_edit(self, __: Gtk.Button):
-        row: EfibootRowModel | None = self.selection_model.get_selected_item()
-        index = self.selection_model.get_selected()
-        if not row:
+        selected = self.selected_positions()
+        if not selected:
             return
+        index = selected[0]
+        row: EfibootRowModel = self.model.get_item(index)
 
         dialog = Gtk.MessageDialog(transient_for=self, modal=True,
                                    destroy_with_parent=True, message_type=Gtk.MessageType.QUESTION,
@@ -526,34 +1089,50 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback()
     def on_clicked_duplicate(self, __: Gtk.Button):
-        row: EfibootRowModel | None = self.selection_model.get_selected_item()
-        if row:
+        for position in self.selected_positions():
+            row: EfibootRowModel = self.model.get_item(position)
             self.model.add(_("Copy of ") + row.name, row.path, row.parameters)
 
     @Gtk.Template.Callback()
     def on_clicked_remove(self, button: Gtk.Button):
-        row = self.selection_model.get_selected_item()
-        index = self.selection_model.get_selected()
-        logging.debug(f"Removing {row} at {index}")
-        self.model.remove(index)
+        # From the bottom up, so that the positions left to remove stay valid
+        for index in reversed(self.selected_positions()):
+            logging.debug(f"Removing {self.model.get_item(index)} at {index}")
+            self.model.remove(index)
 
 
     @Gtk.Template.Callback()
     def on_clicked_save(self, button: Gtk.Button):
         if self.model.pending_changes():
-            script = self.model.to_script(self.disk, self.part, button.get_buildable_id() == "reboot_button")
+            plan = self.model.to_plan(self.disk, self.part, button.get_buildable_id() == "reboot_button")
+            script = plan.to_script()
 
-            def on_response(dialog, response):
-                if response == Gtk.ResponseType.YES:
-                    try:
-                        execute_script_as_root(script)
-                        self.model.refresh()
-                    except FileNotFoundError as e:
+            def on_done(_report: PlanReport | None):
+                self.set_loading(False)
+                self.model.refresh()
+
+            def on_error(e: Exception):
+                self.set_loading(False)
+                match e:
+                    case FileNotFoundError() if plan.nvram_image is None:
                         error_dialog(self, _("The pkexec command from PolKit is "
                                            "required to execute commands with elevated privileges.\n") +
                                            f"{e}", _("pkexec not found"), lambda d, r: d.close())
-                    except subprocess.CalledProcessError as e:
-                        error_dialog(self, f"{e}\n{e.stderr.decode()}", "Error", lambda d, r: d.close())
+                    case PlanError():
+                        error_dialog(self, str(e.report), _("Could not apply changes"), lambda d, r: d.close())
+                    case subprocess.CalledProcessError():
+                        error_dialog(self, f"{e}\n{e.stderr}", "Error", lambda d, r: d.close())
+                    case GLib.Error():
+                        error_dialog(self, e.message, "Error", lambda d, r: d.close())
+                    case _:
+                        # Opening an NVRAM image that isn't there anymore or isn't one
+                        error_dialog(self, str(e), _("Could not apply changes"), lambda d, r: d.close())
+
+            def on_response(dialog, response):
+                if response == Gtk.ResponseType.YES:
+                    # The authorization prompt can take as long as the user wants: keep the window responsive
+                    self.set_loading(True)
+                    run_in_thread(lambda: apply_plan(plan), on_done, on_error)
                 dialog.close()
 
             yes_no_dialog(self, _("Are you sure you want to continue?"),
@@ -575,7 +1154,7 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
                                            "required to execute commands with elevated privileges.")
                                            + f"\n{e}", _("pkexec not found"), lambda d, r: d.close())
                     except subprocess.CalledProcessError as e:
-                        error_dialog(self, f"{e}\n{e.stderr.decode()}", "Error", lambda d, r: d.close())
+                        error_dialog(self, f"{e}\n{e.stderr}", "Error", lambda d, r: d.close())
                 response_dialog.close()
 
             yes_no_dialog(self, _("Are you sure you want to reboot?"),
@@ -607,7 +1186,7 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback()
     def on_value_changed_timeout(self, spin: Gtk.SpinButton):
-        self.model.timeout = spin.get_value_as_int()
+        self.model.change_timeout(spin.get_value_as_int())
 
     # @Gtk.Template.Callback()
     # def on_toggled_active(self, check: Gtk.CheckButton, checked_row: EfibootRowModel):
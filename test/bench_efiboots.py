@@ -0,0 +1,345 @@
+"""
+Micro-benchmarks of Efiboots hot paths. Run from the repository root with:
+
+    PYTHONPATH=src python -m test.bench_efiboots
+
+Results are compared with the baseline in test/bench_baseline.json, if there is one: a benchmark slower than
+the baseline by more than the tolerance is reported as a regression and makes the run fail, and so does a
+benchmark missing from the baseline. Record a new baseline with --save after an intended change or a new
+benchmark, on the same machine that runs the comparisons, with PyGObject installed: the EfibootsListStore
+benchmarks are skipped without it.
+"""
+import argparse
+import json
+import logging
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from pathlib import Path
+from types import SimpleNamespace
+
+from efiboots import authenticode, devicepath, efivars, signatures, utils
+from efiboots.efibootmgr import Efibootmgr, EfibootmgrNvramImage, EfibootmgrV17, EfibootmgrV18
+from efiboots.loadercheck import LoaderChecker
+from efiboots.plan import build_plan, execute_plan
+from efiboots.session import Add, Edit, EditSession, Remove, SetOrder, Toggle
+
+from .fake_firmware import FakeFirmware, edit_session, save_cycle
+from .synthetic import (make_dbx, make_device_paths, make_efibootmgr_output, make_ovmf_vars, make_pe,
+                        make_sysfs_tree)
+
+BASELINE_PATH = Path(__file__).resolve().parent / 'bench_baseline.json'
+SIZES = (10, 100, 1000, 10000)
+
+results: dict[str, float] = {}
+
+
+def bench(name: str, func) -> float:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat=3, number=number)) / number
+    results[name] = seconds
+    print(f"{name:<60} {seconds * 1e6:12.1f} µs")
+    return seconds
+
+
+def bench_esp_detection():
+    with tempfile.TemporaryDirectory() as tmp:
+        # 50 disks with 12 partitions each, the ESP on the last disk
+        unmounted = make_sysfs_tree(Path(tmp, 'unmounted'), 50, 12, esps=((49, 1),))
+        mounted = make_sysfs_tree(Path(tmp, 'mounted'), 50, 12, mounts={'/boot/efi': (49, 1)})
+        bench("auto_detect_esp_with_sysfs, mounted, 600 partitions",
+              lambda: utils.auto_detect_esp_with_sysfs(**mounted))
+        bench("auto_detect_esp_with_sysfs, partition type scan, 600 partitions",
+              lambda: utils.auto_detect_esp_with_sysfs(**unmounted))
+        # 600 partitions and as many entries booting from them, resolved through the index built once
+        partitions = [utils.PartitionInfo(part, part * 2048, 2048, f'{disk:08x}-0000-0000-0000-{part:012x}', 'gpt')
+                      for disk in range(50) for part in range(1, 13)]
+        index = utils.PartitionIndex(str(Path(tmp, 'mounted', 'by-partuuid')),
+                                     str(Path(tmp, 'mounted', 'class', 'block')),
+                                     mounted['udev_data_path'], mounted['mountinfo_path'])
+        bench("PartitionIndex build, 600 partitions", lambda: (index.invalidate(), index.devices()))
+        bench("PartitionIndex resolve 600 entries", lambda: [index.resolve(p) for p in partitions])
+    # Lower bound of what each findmnt/lsblk fallback costs, before doing any work
+    bench("spawning a process (subprocess.run(['true']))", lambda: subprocess.run(['true'], check=True))
+
+
+def bench_parser(sizes=SIZES):
+    for entries in sizes:
+        for parser, unicode in ((EfibootmgrV17, False), (EfibootmgrV18, True)):
+            lines = make_efibootmgr_output(entries, unicode).splitlines()
+            bench(f"{parser.__name__}.parse, {entries} entries", lambda: parser.parse(lines))
+            # What decode_params gets: the text after the device path
+            params = [parser.line_regex.match(line).group(6) for line in lines if '\t' in line]
+            bench(f"{parser.__name__}.decode_params, {entries} entries",
+                  lambda: [parser.decode_params(p) for p in params])
+        optional_data = [efivars.encode_optional_data(entry.parameters) for entry in EfibootmgrV18.parse(
+            make_efibootmgr_output(entries, unicode=True).splitlines()).entries]
+        bench(f"efivars.decode_optional_data, {entries} entries",
+              lambda: [efivars.decode_optional_data(data) for data in optional_data])
+
+
+def bench_device_path(sizes=SIZES):
+    for entries in sizes:
+        paths = make_device_paths(entries)
+        bench(f"devicepath.decode_device_path, {entries} entries",
+              lambda: [devicepath.decode_device_path(path) for path in paths])
+        nodes = [devicepath.decode_device_path(path) for path in paths]
+        bench(f"devicepath.format_device_path, {entries} entries",
+              lambda: [devicepath.format_device_path(n) for n in nodes])
+
+
+def plan_arguments(parsed, rng: random.Random) -> dict:
+    """Change sets of an edit session touching about a tenth of the entries"""
+    nums = [entry.num for entry in parsed.entries]
+    touched = rng.sample(nums, max(1, len(nums) // 10))
+    boot_order = list(parsed.boot_order)
+    rng.shuffle(boot_order)
+    return dict(boot_remove=set(touched[:len(touched) // 4]),
+                boot_add={f'NEW{i}': (f'Added {i}', r'\EFI\new.efi', 'quiet') for i in range(3)},
+                edits={num: ('Edited', r'\EFI\edited.efi', 'rw quiet') for num in touched[len(touched) // 4:]},
+                boot_order=boot_order, boot_order_initial=parsed.boot_order,
+                boot_next=nums[-1], boot_next_initial=None,
+                boot_active=set(touched[::3]), boot_inactive=set(touched[1::3]),
+                timeout=3, timeout_initial=parsed.timeout)
+
+
+def bench_plan(sizes=SIZES):
+    rng = random.Random(0)
+    for entries in sizes:
+        parsed = EfibootmgrV18.parse(make_efibootmgr_output(entries, unicode=True).splitlines())
+        arguments = plan_arguments(parsed, rng)
+        bench(f"build_plan(...).to_script(), {entries} entries",
+              lambda: build_plan('/dev/nvme0n1', '1', **arguments).to_script())
+
+
+def bench_model(sizes=SIZES):
+    try:
+        from efiboots.window import EfibootRowModel, EfibootsListStore
+    except (ImportError, ValueError) as e:
+        print(f"EfibootsListStore benchmarks skipped: {e}")
+        return
+    rng = random.Random(0)
+    for entries in sizes:
+        parsed = EfibootmgrV18.parse(make_efibootmgr_output(entries, unicode=True).splitlines())
+        bench(f"EfibootRowModel construction, {entries} entries",
+              lambda: [EfibootRowModel(False, e.num, e.name, e.path, e.parameters, e.active, False)
+                       for e in parsed.entries])
+        rows = [EfibootRowModel(False, e.num, e.name, e.path, e.parameters, e.active, False) for e in parsed.entries]
+        # Only what to_plan reads of the window: the efivars backend builds native plans without running efibootmgr
+        store = EfibootsListStore(window=SimpleNamespace(backend='efivars', nvram_image=None))
+        # What populate does on the first refresh: a single splice of the sorted rows
+        bench(f"EfibootsListStore.splice of all rows, {entries} entries",
+              lambda: (store.splice(0, store.get_n_items(), rows)))
+        store.session = make_session(parsed, rng)
+        nums = [entry.num for entry in parsed.entries]
+        bench(f"EfibootsListStore.sort(sort_by_boot_order), {entries} entries",
+              lambda: store.sort(store.sort_by_boot_order))
+        lookups = rng.choices(nums, k=100)
+        bench(f"EfibootsListStore.index_num x100, {entries} entries",
+              lambda: [store.index_num(num) for num in lookups])
+        bench(f"EfibootsListStore.to_script, {entries} entries",
+              lambda: store.to_script('/dev/nvme0n1', '1', False))
+
+
+def bench_nvram_image(sizes=SIZES):
+    with tempfile.TemporaryDirectory() as tmp:
+        for entries in sizes:
+            # An OVMF variable store holds about a thousand entries at most
+            if entries > 1000:
+                continue
+            image = str(make_ovmf_vars(Path(tmp) / f'{entries}_VARS.fd', entries))
+            backend = EfibootmgrNvramImage(image)
+            bench(f"EfibootmgrNvramImage.read, {entries} entries", backend.read)
+            order = backend.read().boot_order
+            plans = [build_plan('', '', boot_remove=set(), boot_add={}, edits={}, boot_order=new,
+                                boot_order_initial=old, boot_next=None, boot_next_initial=None, boot_active=set(),
+                                boot_inactive=set(), timeout=None, timeout_initial=None, nvram_image=image)
+                     for old, new in ((order, order[::-1]), (order[::-1], order))]
+            # Reversing the boot order back and forth: rewritten in place each time
+            bench(f"execute_plan on an NVRAM image, {entries} entries",
+                  lambda: [execute_plan(plan) for plan in plans])
+
+
+def make_session(parsed, rng: random.Random) -> EditSession:
+    """Session of the edits of plan_arguments, as the window records them"""
+    session = EditSession()
+    session.reset(parsed.boot_order, parsed.boot_next, parsed.timeout,
+                  {e.num: ((e.name, e.path, e.parameters), e.active) for e in parsed.entries})
+    arguments = plan_arguments(parsed, rng)
+    for num, entry in arguments['edits'].items():
+        session.do(Edit(num, session.entry(num)[0], entry))
+    for num in arguments['boot_active'] | arguments['boot_inactive']:
+        session.do(Toggle(num, num in arguments['boot_active']))
+    session.do(SetOrder(tuple(session.boot_order), tuple(arguments['boot_order'])))
+    for num in arguments['boot_remove']:
+        session.do(Remove(num, *session.entry(num), 0, session.boot_order.rank(num)))
+    for label, loader, parameters in arguments['boot_add'].values():
+        session.do(Add(session.new_num(), (label, loader, parameters), True, 0))
+    return session
+
+
+def bench_loader_check(sizes=SIZES):
+    with tempfile.TemporaryDirectory() as tmp:
+        for entries in sizes:
+            if entries > 1000:
+                continue
+            esp = Path(tmp, str(entries))
+            loaders = []
+            for i in range(entries):
+                directory = esp / 'EFI' / f'Distro{i % 50}'
+                directory.mkdir(parents=True, exist_ok=True)
+                (directory / f'grub{i}.efi').write_bytes(b'MZ')
+                # Looked up the way firmware sees it, ignoring case
+                loaders.append(f'\\EFI\\DISTRO{i % 50}\\GRUB{i}.EFI')
+
+            def first_check():
+                checker = LoaderChecker()
+                return [checker.check(str(esp), loader) for loader in loaders]
+
+            bench(f"LoaderChecker first check, {entries} entries", first_check)
+            checker = LoaderChecker()
+            bench(f"LoaderChecker recheck unchanged, {entries} entries",
+                  lambda: [checker.check(str(esp), loader) for loader in loaders])
+
+
+def bench_authenticode(images: int = 8, size: int = 16 * 1024 * 1024):
+    with tempfile.TemporaryDirectory() as tmp:
+        # Like unified kernel images: a few small sections and a large one
+        paths = [str(make_pe(Path(tmp, f'uki{i}.efi'), [b'\x90' * 4096, bytes([i]) * size, b'osrel' * 100],
+                             certificates=b'\x30' * 2048)) for i in range(images)]
+        cache = str(Path(tmp, 'cache.json'))
+
+        def cold():
+            Path(cache).unlink(missing_ok=True)
+            return authenticode.AuthenticodeHasher(cache).digests(paths)
+
+        megabytes = images * size // (1024 * 1024)
+        bench(f"AuthenticodeHasher, {images} images, {megabytes} MB, cold", cold)
+        bench(f"AuthenticodeHasher, {images} images, {megabytes} MB, cached",
+              lambda: authenticode.AuthenticodeHasher(cache).digests(paths))
+
+
+def bench_dbx(hashes: int = 4000, lookups: int = 1000):
+    data, revoked = make_dbx(hashes)
+    db = signatures.SignatureDatabase()
+    dbx = signatures.SignatureDatabase.parse(data)
+    digests = revoked[::max(1, hashes // (lookups // 2))][:lookups // 2]
+    digests += [bytes([i % 256]) * 32 for i in range(lookups - len(digests))]
+    bench(f"SignatureDatabase.parse, dbx of {hashes} hashes", lambda: signatures.SignatureDatabase.parse(data))
+    bench(f"verdict, {lookups} digests against a dbx of {hashes} hashes",
+          lambda: [signatures.verdict(digest, db, dbx) for digest in digests])
+    with tempfile.TemporaryDirectory() as tmp:
+        Path(efivars.variable_path('dbx', signatures.EFI_IMAGE_SECURITY_DATABASE_GUID, tmp)).write_bytes(
+            bytes(4) + data)
+        databases = signatures.SignatureDatabases(tmp)
+        databases.get('dbx')
+        bench(f"SignatureDatabases.get, unchanged dbx of {hashes} hashes", lambda: databases.get('dbx'))
+
+
+def bench_session(sizes=SIZES):
+    rng = random.Random(0)
+    for entries in sizes:
+        parsed = EfibootmgrV18.parse(make_efibootmgr_output(entries, unicode=True).splitlines())
+        session = make_session(parsed, rng)
+        num = parsed.entries[0].num
+        entry = session.entry(num)[0]
+        edit = Edit(num, entry, (entry[0] + 'x', entry[1], entry[2]))
+
+        def keystroke():
+            # An edit, then whether there is something to save, as closing the window asks
+            session.do(edit)
+            session.undo()
+            return session.dirty
+        bench(f"EditSession edit, undo and dirty check, {entries} entries", keystroke)
+        rows = list(session.boot_order)
+
+        def move_to_top():
+            # Dragging the last row to the top, then undoing it
+            session.do(session.plan_move(rows, [len(rows) - 1], [0]))
+            session.undo()
+        bench(f"EditSession move last row to top and undo, {entries} entries", move_to_top)
+        bench(f"EditSession.plan_arguments, {entries} entries", session.plan_arguments)
+
+
+def bench_save_cycle(entries: int = 32, changes: int = 16, repeat: int = 3):
+    """Wall-clock time of Save and the following refresh against the fake efibootmgr, best of repeat sessions"""
+    for version in ('17', '18'):
+        for route in ('plan', 'script'):
+            best = {}
+            with FakeFirmware(entries, version) as firmware:
+                for _ in range(repeat):
+                    firmware.reset()
+                    parsed = Efibootmgr.get_instance('efibootmgr').read()
+                    _, timings = save_cycle(edit_session(parsed, changes, random.Random(0)), route)
+                    best = {phase: min(seconds, best.get(phase, seconds)) for phase, seconds in timings.items()}
+            for phase, seconds in best.items():
+                name = f"save cycle {phase}, efibootmgr {version}, {route}, {changes} changes"
+                results[name] = seconds
+                print(f"{name:<60} {seconds * 1e6:12.1f} µs")
+
+
+def compare(baseline: dict[str, float], tolerance: float) -> list[str]:
+    """Names of the benchmarks that regressed, or that aren't in the baseline and so aren't guarded at all"""
+    failures = []
+    print(f"\n{'compared with the baseline':<60} {'ratio':>12}")
+    for name, seconds in results.items():
+        if name not in baseline:
+            print(f"{name:<60} {'-':>12}  NOT IN BASELINE")
+            failures.append(name)
+            continue
+        ratio = seconds / baseline[name]
+        regressed = ratio > tolerance
+        print(f"{name:<60} {ratio:11.2f}x{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            failures.append(name)
+    not_run = sorted(baseline.keys() - results.keys())
+    if not_run:
+        print(f"\n{len(not_run)} benchmarks of the baseline did not run, like {not_run[0]!r}")
+    if any(name not in baseline for name in failures):
+        print("Record the benchmarks missing from the baseline with --save")
+    return failures
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Efiboots micro-benchmarks")
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH, help="baseline results file")
+    parser.add_argument('--save', action='store_true', help="record these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="slowdown ratio above which a benchmark counts as a regression")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="numbers of entries to benchmark")
+    parser.add_argument('--save-cycle', action='store_true',
+                        help="also time whole Save and refresh cycles against the fake efibootmgr of test/fake_bin")
+    args = parser.parse_args(argv)
+
+    # Windows entries can't be decoded by efibootmgr 17: don't time the warnings
+    logging.disable(logging.WARNING)
+    bench_esp_detection()
+    bench_parser(args.sizes)
+    bench_device_path(args.sizes)
+    bench_plan(args.sizes)
+    bench_nvram_image(args.sizes)
+    bench_loader_check(args.sizes)
+    bench_authenticode()
+    bench_dbx()
+    bench_session(args.sizes)
+    bench_model(args.sizes)
+    if args.save_cycle:
+        bench_save_cycle()
+
+    if args.save:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+    if args.baseline.exists():
+        return 1 if compare(json.loads(args.baseline.read_text()), args.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Fake firmware for end-to-end tests and benchmarks: NVRAM is a temporary directory laid out like efivarfs and
+the efibootmgr and pkexec stand-ins of test/fake_bin come first in PATH, so Save and refresh run the same
+subprocesses as on a real system, without touching its firmware.
+"""
+import os
+import random
+import tempfile
+import time
+
+from pathlib import Path
+
+from efiboots import efivars
+from efiboots.efibootmgr import Efibootmgr, ParsedEfibootmgr
+from efiboots.plan import ChangePlan, build_plan, execute_plan_as_root, execute_script_as_root
+from efiboots.utils import PartitionInfo
+
+FAKE_BIN = Path(__file__).resolve().parent / 'fake_bin'
+ESP = PartitionInfo(number=1, start=2048, size=1048576, part_uuid='fda4f976-b250-4569-be80-0449804ab7c2', scheme='gpt')
+
+
+def seed_nvram(efivars_path: str, entries: int) -> list[str]:
+    """Writes entries alternating Linux kernels with a command line and BBS legacy devices. Returns their nums."""
+    writer = efivars.EfivarsWriter(efivars_path)
+    bbs = efivars.make_device_path(efivars.make_device_path_node(5, 1, b'\x02\x00\x00\x00HD\x00'),
+                                   efivars.make_end_node())
+    nums = [efivars.format_boot_num(i) for i in range(entries)]
+    for i, num in enumerate(nums):
+        if i % 2:
+            option = efivars.make_load_option(efivars.LOAD_OPTION_ACTIVE, f'Hard Drive {i}', bbs)
+        else:
+            option = efivars.make_load_option(efivars.LOAD_OPTION_ACTIVE, f'Linux {i}',
+                                              efivars.make_esp_device_path(ESP, rf'\vmlinuz-linux-{i}'),
+                                              efivars.encode_optional_data(f'root=LABEL=root rw quiet initrd={i}'))
+        writer.write_load_option(num, option)
+    writer.set_boot_order(nums)
+    writer.write_variable('BootCurrent', bytes.fromhex('0000'))
+    writer.set_timeout(5)
+    return nums
+
+
+class FakeFirmware:
+    """Context manager seeding a fake NVRAM and pointing the stand-ins of PATH at it through FAKE_EFIVARS. Code
+    running in this process is given efivars_path explicitly."""
+
+    def __init__(self, entries: int = 8, version: str = '18'):
+        self.entries = entries
+        self.version = version
+        self._tmp = None
+        self._environ = None
+        self.efivars_path = None
+
+    def __enter__(self) -> 'FakeFirmware':
+        self._tmp = tempfile.TemporaryDirectory()
+        self.efivars_path = self._tmp.name
+        seed_nvram(self.efivars_path, self.entries)
+        self._environ = os.environ.copy()
+        os.environ['PATH'] = f"{FAKE_BIN}{os.pathsep}{os.environ.get('PATH', '')}"
+        os.environ['FAKE_EFIVARS'] = self.efivars_path
+        os.environ['FAKE_EFIBOOTMGR_VERSION'] = self.version
+        return self
+
+    def __exit__(self, *exc_info):
+        os.environ.clear()
+        os.environ.update(self._environ)
+        self._tmp.cleanup()
+
+    def reset(self):
+        for name in efivars.list_variables(efivars_path=self.efivars_path):
+            os.unlink(efivars.variable_path(name, efivars.EFI_GLOBAL_GUID, self.efivars_path))
+        seed_nvram(self.efivars_path, self.entries)
+
+
+def edit_session(parsed: ParsedEfibootmgr, changes: int, rng: random.Random) -> ChangePlan:
+    """What Save applies after the user made the given number of changes to the entries"""
+    nums = [entry.num for entry in parsed.entries]
+    entries = {entry.num: entry for entry in parsed.entries}
+    touched = rng.sample(nums, min(changes, len(nums)))
+    removed = set(touched[:len(touched) // 4])
+    edited = touched[len(touched) // 4:len(touched) // 2]
+    toggled = touched[len(touched) // 2:]
+    boot_order = [num for num in parsed.boot_order if num not in removed]
+    rng.shuffle(boot_order)
+    return build_plan(
+        '/dev/nvme0n1', '1', boot_remove=removed,
+        boot_add={f'NEW{i}': (f'Added {i}', rf'\EFI\added{i}.efi', 'quiet') for i in range(max(1, changes // 8))},
+        edits={num: (entries[num].name + ' (edited)', rf'\vmlinuz-edited-{num}', 'rw') for num in edited},
+        boot_order=boot_order, boot_order_initial=parsed.boot_order,
+        boot_next=boot_order[0] if boot_order else None, boot_next_initial=parsed.boot_next,
+        boot_active=set(), boot_inactive=set(toggled), timeout=parsed.timeout + 1, timeout_initial=parsed.timeout)
+
+
+def save_cycle(plan: ChangePlan, route: str = 'plan') -> tuple[ParsedEfibootmgr, dict[str, float]]:
+    """Applies the plan like Save does, through a single root process ('plan') or a pkexec'd shell script
+    ('script'), then refreshes like the main window does. Returns the refreshed entries and phase timings."""
+    timings = {}
+    start = time.perf_counter()
+    if route == 'script':
+        execute_script_as_root(plan.to_script())
+    else:
+        execute_plan_as_root(plan)
+    timings['apply'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parsed = Efibootmgr.get_instance('efibootmgr').read()
+    timings['refresh'] = time.perf_counter() - start
+    timings['total'] = timings['apply'] + timings['refresh']
+    return parsed, timings
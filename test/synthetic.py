@@ -0,0 +1,230 @@
+"""Builders of synthetic system state shared by tests and benchmarks"""
+import hashlib
+import struct
+import uuid
+
+from pathlib import Path
+
+ESP_TYPE = 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b'
+LINUX_TYPE = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+
+
+def make_sysfs_tree(root: Path, disks: int, parts_per_disk: int, esps: tuple[tuple[int, int], ...] = (),
+                    mounts: dict[str, tuple[int, int]] | None = None) -> dict[str, str]:
+    """Builds sysfs, /sys/dev/block, udev data, /dev/disk/by-partuuid and mountinfo for disks nvme0n1..nvmeNn1 with
+    the given partitions.
+
+    esps lists (disk, part) pairs that are vfat ESPs, mounts maps mount points to (disk, part) vfat mounts.
+    Returns the paths to pass to the detection functions.
+    """
+    devices = root / 'devices'
+    class_block = root / 'class' / 'block'
+    dev_block = root / 'dev' / 'block'
+    udev = root / 'udev'
+    by_partuuid = root / 'by-partuuid'
+    for path in (class_block, dev_block, udev, by_partuuid):
+        path.mkdir(parents=True)
+
+    mountinfo = ['22 1 0:21 / /proc rw,nosuid - proc proc rw',
+                 '23 1 259:2 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p2 rw']
+    mount_points = {pair: mount_point for mount_point, pair in (mounts or {}).items()}
+    for disk in range(disks):
+        disk_name = f'nvme{disk}n1'
+        disk_dir = devices / disk_name
+        (disk_dir / 'queue').mkdir(parents=True)
+        (disk_dir / 'queue' / 'logical_block_size').write_text('512\n')
+        (class_block / disk_name).symlink_to(disk_dir)
+        for part in range(1, parts_per_disk + 1):
+            part_name = f'{disk_name}p{part}'
+            part_dir = disk_dir / part_name
+            part_dir.mkdir()
+            dev = f'259:{disk * 256 + part}'
+            (part_dir / 'partition').write_text(f'{part}\n')
+            (part_dir / 'dev').write_text(f'{dev}\n')
+            (part_dir / 'uevent').write_text(f'MAJOR=259\nMINOR={disk * 256 + part}\nDEVNAME={part_name}\n'
+                                             f'DEVTYPE=partition\nPARTN={part}\n')
+            (part_dir / 'start').write_text(f'{part * 2048}\n')
+            (part_dir / 'size').write_text('2048\n')
+            (class_block / part_name).symlink_to(part_dir)
+            (dev_block / dev).symlink_to(part_dir)
+            (by_partuuid / f'{disk:08x}-0000-0000-0000-{part:012x}').symlink_to(f'../../{part_name}')
+            is_esp = (disk, part) in esps or (disk, part) in mount_points
+            (udev / f'b{dev}').write_text(
+                f'S:disk/by-partuuid/{disk:08x}-0000-0000-0000-{part:012x}\n'
+                f'E:ID_FS_TYPE={"vfat" if is_esp else "ext4"}\n'
+                f'E:ID_PART_ENTRY_SCHEME=gpt\n'
+                f'E:ID_PART_ENTRY_UUID={disk:08x}-0000-0000-0000-{part:012x}\n'
+                f'E:ID_PART_ENTRY_TYPE={ESP_TYPE if is_esp else LINUX_TYPE}\n')
+            if (disk, part) in mount_points:
+                mount_point = mount_points[(disk, part)].replace(' ', '\\040')
+                mountinfo.append(f'{40 + len(mountinfo)} 23 {dev} / {mount_point} rw,relatime shared:2 '
+                                 f'- vfat /dev/{part_name} rw,fmask=0077')
+    (root / 'mountinfo').write_text('\n'.join(mountinfo) + '\n')
+    return {'mountinfo_path': str(root / 'mountinfo'), 'sys_dev_block_path': str(dev_block),
+            'udev_data_path': str(udev)}
+
+
+def dotted(text: str) -> str:
+    """Optional data as efibootmgr 17 -v prints UCS-2 strings: each NUL byte shown as a dot"""
+    return ''.join(c + '.' for c in text)
+
+
+def make_efibootmgr_output(entries: int, unicode: bool = False) -> str:
+    """Output of `efibootmgr -v` (or `efibootmgr --unicode` when unicode is set) listing the given number of
+    entries, cycling through BBS, HD/File, PXE, WINDOWS and long kernel command line entries"""
+    lines = [f'BootCurrent: {1:04X}', 'Timeout: 5 seconds',
+             'BootOrder: ' + ','.join(f'{num:04X}' for num in reversed(range(entries)))]
+    hd = 'HD(1,GPT,fda4f976-b250-4569-be80-0449804ab7c2,0x800,0x40000)'
+    for num in range(entries):
+        active = '*' if num % 3 else ' '
+        match num % 5:
+            case 0:
+                lines.append(f'Boot{num:04X}{active} SATA{num} : Samsung SSD 850 PRO 25\tBBS(17,,0x0)')
+            case 1:
+                lines.append(f'Boot{num:04X}{active} rEFInd {num}\t{hd}/File(\\EFI\\refind\\refind_x64.efi)')
+            case 2:
+                lines.append(f'Boot{num:04X}{active} UEFI PXEv4 {num}\t'
+                             f'PciRoot(0x0)/Pci(0x1c,0x0)/MAC(00163e5e6c00,0)/IPv4(0.0.0.00.0.0.0,0,0)')
+            case 3:
+                bcd = 'BCDOBJECT={9dea862c-5cdd-4e70-acc1-f32b344d4795}'
+                lines.append(f'Boot{num:04X}{active} Windows Boot Manager {num}\t'
+                             f'{hd}/File(\\EFI\\Microsoft\\Boot\\bootmgfw.efi)'
+                             f'WINDOWS.........x...{bcd if unicode else dotted(bcd)}...o................')
+            case 4:
+                cmdline = (f'root=UUID={num:08x}-0000-4000-8000-000000000000 rw quiet splash '
+                           f'initrd=\\intel-ucode.img initrd=\\initramfs-linux-{num}.img zswap.enabled=0')
+                lines.append(f'Boot{num:04X}{active} Linux {num}\t{hd}/File(\\vmlinuz-linux)'
+                             f'{cmdline if unicode else dotted(cmdline)}')
+    return '\n'.join(lines) + '\n'
+
+
+def make_device_paths(entries: int) -> list[bytes]:
+    """Binary device paths of the given number of load options, cycling through ESP, PXE, HTTP boot, NVMe, USB,
+    SATA, VLAN, BBS and multi-instance paths"""
+    from efiboots import devicepath as dp
+    from efiboots import efivars
+
+    def node(device_type, subtype, *fields, fmt=''):
+        return efivars.make_device_path_node(device_type, subtype, struct.pack('<' + fmt, *fields))
+
+    pci_root = node(dp.ACPI_DEVICE_PATH, 0x01, 0x0a0341d0, 0, fmt='II')
+    pci = node(dp.HARDWARE_DEVICE_PATH, 0x01, 0, 0x1c, fmt='BB')
+    mac = node(dp.MESSAGING_DEVICE_PATH, 0x0b, bytes.fromhex('00163e5e6c00'), 1, fmt='32sB')
+    hd = efivars.make_hard_drive_node(1, 0x800, 0x40000, uuid.UUID('fda4f976-b250-4569-be80-0449804ab7c2'))
+    paths = []
+    for num in range(entries):
+        match num % 8:
+            case 0:
+                nodes = (hd, efivars.make_file_path_node(r'\EFI\refind\refind_x64.efi'))
+            case 1:
+                nodes = (pci_root, pci, mac, node(dp.MESSAGING_DEVICE_PATH, 0x0c, bytes(4), bytes([192, 168, 1, num % 256]),
+                                                  0, 0, 6, 0, bytes(4), bytes(4), fmt='4s4sHHHB4s4s'))
+            case 2:
+                nodes = (pci_root, pci, mac, node(dp.MESSAGING_DEVICE_PATH, 0x0d, bytes(16), bytes(16), 0, 0, 6, 1,
+                                                  64, bytes(16), fmt='16s16sHHHBB16s'),
+                         node(dp.MESSAGING_DEVICE_PATH, 0x18, b'http://boot.example.com/shim.efi', fmt='32s'))
+            case 3:
+                nodes = (pci_root, node(dp.HARDWARE_DEVICE_PATH, 0x01, 0, 0x1d, fmt='BB'),
+                         node(dp.MESSAGING_DEVICE_PATH, 0x17, 1, bytes(range(8)), fmt='I8s'),
+                         hd, efivars.make_file_path_node(r'\EFI\BOOT\BOOTX64.EFI'))
+            case 4:
+                nodes = (pci_root, node(dp.HARDWARE_DEVICE_PATH, 0x01, 0, 0x14, fmt='BB'),
+                         node(dp.MESSAGING_DEVICE_PATH, 0x05, 3, 0, fmt='BB'))
+            case 5:
+                nodes = (pci_root, node(dp.HARDWARE_DEVICE_PATH, 0x01, 2, 0x1f, fmt='BB'),
+                         node(dp.MESSAGING_DEVICE_PATH, 0x12, 0, 0xffff, 0, fmt='HHH'))
+            case 6:
+                nodes = (pci_root, pci, mac, node(dp.MESSAGING_DEVICE_PATH, 0x14, 100, fmt='H'))
+            case 7:
+                nodes = (node(dp.BBS_DEVICE_PATH, 0x01, 2, 0, b'SATA: Samsung SSD\0', fmt='HH18s'),
+                         node(dp.END_DEVICE_PATH, dp.END_INSTANCE_SUBTYPE),
+                         hd, efivars.make_file_path_node(r'\EFI\BOOT\BOOTX64.EFI'))
+        paths.append(efivars.make_device_path(*nodes))
+    return paths
+
+
+def make_ovmf_vars(path: Path, entries: int = 0, size: int = 0x84000, store_size: int = 0x40000) -> Path:
+    """Empty OVMF_VARS.fd laid out like edk2 builds it: a firmware volume with an authenticated variable store,
+    followed by the fault tolerant write areas, then entries boot entries with their BootOrder written to it"""
+    from efiboots import efivars, varstore
+
+    block_map = struct.pack('<4I', size // 0x1000, 0x1000, 0, 0)
+    header_length = varstore.FV_HEADER.size + len(block_map)
+    header = bytearray(varstore.FV_HEADER.pack(bytes(16), varstore.NV_DATA_FV_GUID.bytes_le, size,
+                                               varstore.FV_SIGNATURE, 0x4feff, header_length, 0, 0, 0, 2) + block_map)
+    # The 16 bit words of the header sum up to zero
+    struct.pack_into('<H', header, 50, -sum(struct.unpack(f'<{len(header) // 2}H', header)) & 0xffff)
+    store = varstore.STORE_HEADER.pack(varstore.AUTHENTICATED_VARIABLE_GUID.bytes_le, store_size - header_length,
+                                       varstore.STORE_FORMATTED, varstore.STORE_HEALTHY, 0, 0)
+    image = bytes(header) + store
+    path.write_bytes(image + b'\xff' * (size - len(image)))
+
+    with varstore.VariableStore(str(path), writable=True) as variables:
+        writer = varstore.VarstoreWriter(variables)
+        for num, device_path in enumerate(make_device_paths(entries)):
+            writer.write_load_option(f'{num:04X}', efivars.make_load_option(
+                efivars.LOAD_OPTION_ACTIVE, f'UEFI Misc Device {num}', device_path))
+        if entries:
+            writer.set_boot_order([f'{num:04X}' for num in range(entries)])
+    return path
+
+
+def make_pe(path: Path, sections: list[bytes], certificates: bytes = b'', trailer: bytes = b'',
+            pe32_plus: bool = True, checksum: int = 0x1234) -> Path:
+    """PE/COFF image with the given raw section data, laid out like a linker does at 0x200 file alignment, then
+    trailer, then certificates as the attribute certificate table"""
+    from efiboots import authenticode
+
+    def pad(data: bytes) -> bytes:
+        return data + bytes(-len(data) % 0x200)
+
+    magic = authenticode.PE32_PLUS_MAGIC if pe32_plus else authenticode.PE32_MAGIC
+    count_offset, directories = authenticode.DATA_DIRECTORIES[magic]
+    optional_size = directories + 16 * authenticode.DATA_DIRECTORY.size
+    pe_offset = 0x40
+    headers_size = len(pad(bytes(pe_offset + 4 + authenticode.COFF_HEADER.size + optional_size +
+                                 authenticode.SECTION_HEADER.size * len(sections))))
+    raw = [pad(section) for section in sections]
+    certificates_offset = headers_size + sum(map(len, raw)) + len(trailer)
+
+    optional = bytearray(optional_size)
+    struct.pack_into('<H', optional, 0, magic)
+    struct.pack_into('<I', optional, authenticode.SIZE_OF_HEADERS_OFFSET, headers_size)
+    struct.pack_into('<I', optional, authenticode.CHECKSUM_OFFSET, checksum)
+    struct.pack_into('<I', optional, count_offset, 16)
+    if certificates:
+        authenticode.DATA_DIRECTORY.pack_into(optional, directories + 8 * authenticode.SECURITY_DIRECTORY,
+                                              certificates_offset, len(certificates))
+    table = b''
+    pointer = headers_size
+    for i, data in enumerate(raw):
+        table += authenticode.SECTION_HEADER.pack(f'.sec{i}'.encode(), len(sections[i]), 0x1000 * (i + 1),
+                                                  len(data), pointer, 0, 0, 0, 0, 0x60000020)
+        pointer += len(data)
+    dos = bytearray(pe_offset)
+    dos[:2] = authenticode.DOS_SIGNATURE
+    struct.pack_into('<I', dos, 0x3c, pe_offset)
+    headers = bytes(dos) + authenticode.PE_SIGNATURE + authenticode.COFF_HEADER.pack(
+        0x8664, len(sections), 0, 0, 0, optional_size, 0x22) + bytes(optional) + table
+    path.write_bytes(pad(headers) + b''.join(raw) + trailer + certificates)
+    return path
+
+
+def make_signature_list(signature_type: uuid.UUID, signatures: list[bytes],
+                        owner: uuid.UUID = uuid.UUID('77fa9abd-0359-4d32-bd60-28f4e78f784b')) -> bytes:
+    """EFI_SIGNATURE_LIST of signatures of the same size, all owned by owner (Microsoft by default)"""
+    size = 16 + len(signatures[0])
+    return struct.pack('<16sIII', signature_type.bytes_le, 28 + size * len(signatures), 0, size) + \
+        b''.join(owner.bytes_le + signature for signature in signatures)
+
+
+def make_dbx(hashes: int, seed: int = 0) -> tuple[bytes, list[bytes]]:
+    """dbx like the ones UEFI revocation updates ship, with the given number of SHA-256 hashes split in lists of
+    up to 1000 hashes, plus a certificate. Returns the data and the hashes."""
+    from efiboots import signatures
+
+    revoked = [hashlib.sha256(f'{seed}:{i}'.encode()).digest() for i in range(hashes)]
+    data = b''.join(make_signature_list(signatures.EFI_CERT_SHA256_GUID, revoked[i:i + 1000])
+                    for i in range(0, hashes, 1000))
+    data += make_signature_list(signatures.EFI_CERT_X509_GUID, [b'\x30\x82\x01\x00' + bytes(256)])
+    return data, revoked
@@ -1,9 +1,37 @@
 import unittest
+import errno
+import fcntl
+import hashlib
+import importlib.util
+import json
 import logging
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
 
 from pathlib import Path
 
 import efiboots
+from efiboots import authenticode, cli, devicepath, efivars, loadercheck, signatures, varstore
+from efiboots.bootorder import BootOrder
+from efiboots.efibootmgr import Efibootmgr, EfibootmgrEfivars, EfibootmgrNvramImage, EfibootmgrV17, EfibootmgrV18, \
+    ParsedEfibootmgr, classify_dotted_params, parse_hard_drive
+from efiboots.host import HostHelper, HostHelperError
+from efiboots.loadercheck import LoaderCheck, LoaderChecker
+from efiboots.plan import ChangePlan, PlanStep, build_plan, execute_plan
+from efiboots.profile import StartupProfile
+from efiboots.session import Add, Edit, EditSession, Move, Remove, SetNext, SetTimeout, Toggle, place
+from efiboots.utils import PartitionInfo
+
+from .fake_firmware import FakeFirmware, edit_session, save_cycle
+from .synthetic import make_dbx, make_device_paths, make_efibootmgr_output, make_ovmf_vars, make_pe, \
+    make_signature_list, make_sysfs_tree
 
 logging.basicConfig(level=0)
 test_dir = Path(__file__).resolve().parent
@@ -25,6 +53,17 @@ class TestEfibootmgrDecode(unittest.TestCase):
         expected = 'BCDOBJECT={9dea862c-5cdd-4e70-acc1-f32b344d4795}'
         self.assertEqual(decoded, expected)
 
+    def test_classify(self):
+        self.assertEqual(classify_dotted_params('q.u.i.e.t.'), (efivars.OPTIONAL_DATA_UCS2, 'quiet'))
+        self.assertEqual(classify_dotted_params('VOL+.'), (efivars.OPTIONAL_DATA_TEXT, 'VOL+.'))
+        self.assertEqual(classify_dotted_params('WINDOWS...x.'), (efivars.OPTIONAL_DATA_BINARY, 'WINDOWS...x.'))
+        self.assertEqual(efivars.classify_optional_data('quiet'.encode('utf-16-le')),
+                         (efivars.OPTIONAL_DATA_UCS2, 'quiet'))
+        self.assertEqual(efivars.classify_optional_data('\u00e8 \u4e2d'.encode('utf-16-le') + b'\0\0'),
+                         (efivars.OPTIONAL_DATA_UCS2, '\u00e8 \u4e2d'))
+        self.assertEqual(efivars.classify_optional_data(b'PXE'), (efivars.OPTIONAL_DATA_TEXT, 'PXE'))
+        self.assertEqual(efivars.classify_optional_data(b'\x01\xff\x00'), (efivars.OPTIONAL_DATA_BINARY, ''))
+
 
 class TestParser(unittest.TestCase):
     def test_efibootmgr_entries_parsing(self):
@@ -59,3 +98,900 @@ class TestParser(unittest.TestCase):
         key, value = efiboots.parse_efibootmgr_line('BootOrder: 0001,0003,0005,0000,0002,0004')
         self.assertEqual(key, 'boot_order')
         self.assertListEqual(value, ['0001', '0003', '0005', '0000', '0002', '0004'])
+
+    def test_parse_matches_parse_line(self):
+        for input_file in sorted(test_dir.glob('*.test')):
+            for parser in (EfibootmgrV17, EfibootmgrV18):
+                with self.subTest(input_file=input_file.name, parser=parser.__name__):
+                    expected = {'entries': [], 'boot_order': [], 'boot_next': None, 'boot_current': None,
+                                'timeout': None}
+                    for line in input_file.read_text().splitlines():
+                        try:
+                            key, value = parser.parse_line(line)
+                        except ValueError:
+                            continue
+                        if key == 'entry':
+                            expected['entries'].append(value)
+                        else:
+                            expected[key] = value
+                    # A text stream is parsed like a list of lines
+                    with input_file.open() as stream:
+                        self.assertEqual(parser.parse(stream), ParsedEfibootmgr(**expected))
+
+    def test_parse_synthetic_output(self):
+        parsed = EfibootmgrV18.parse(make_efibootmgr_output(1000, unicode=True).splitlines())
+        self.assertEqual(len(parsed.entries), 1000)
+        self.assertEqual(parsed.boot_order[0], '03E7')
+        self.assertEqual(parsed.timeout, 5)
+        self.assertEqual(parsed.entries[4].parameters, EfibootmgrV17.parse(
+            make_efibootmgr_output(5).splitlines()).entries[4].parameters)
+
+
+def write_efivar(efivars_dir: Path, name: str, data: bytes, attributes: int = 7):
+    (efivars_dir / f'{name}-{efivars.EFI_GLOBAL_GUID}').write_bytes(struct.pack('<I', attributes) + data)
+
+
+def crafted_load_option(attributes: int, description: str, path: str, optional_data: bytes) -> bytes:
+    part_uuid = uuid.UUID('fda4f976-b250-4569-be80-0449804ab7c2')
+    hd = struct.pack('<BBHIQQ16sBB', 4, 1, 42, 1, 0x800, 0x40000, part_uuid.bytes_le, 2, 2)
+    encoded_path = (path + '\0').encode('utf-16-le')
+    file_path = struct.pack('<BBH', 4, 4, 4 + len(encoded_path)) + encoded_path
+    end = struct.pack('<BBH', 0x7f, 0xff, 4)
+    device_path = hd + file_path + end
+    return struct.pack('<IH', attributes, len(device_path)) + (description + '\0').encode('utf-16-le') + \
+        device_path + optional_data
+
+
+class TestEfivarsBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.efivars_dir = Path(self.tmp.name)
+        write_efivar(self.efivars_dir, 'BootCurrent', struct.pack('<H', 1))
+        write_efivar(self.efivars_dir, 'BootOrder', struct.pack('<3H', 1, 0x1A, 0))
+        write_efivar(self.efivars_dir, 'Timeout', struct.pack('<H', 3))
+        write_efivar(self.efivars_dir, 'Boot0001', crafted_load_option(1, 'rEFInd Boot Manager',
+                                                                       r'\EFI\refind\refind_x64.efi', b''))
+        write_efivar(self.efivars_dir, 'Boot001A', crafted_load_option(
+            0, 'Linux', r'\vmlinuz-linux', 'root=LABEL=root quiet'.encode('utf-16-le')))
+        write_efivar(self.efivars_dir, 'Boot0000', crafted_load_option(1, 'Binary', r'\EFI\x.efi', b'\x01\xff\x00'))
+        write_efivar(self.efivars_dir, 'BootOptionSupport', b'\x01\x00\x00\x00')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parse_efivars(self):
+        backend = EfibootmgrEfivars(str(self.efivars_dir))
+        parsed = backend.parse(backend.run())
+        self.assertListEqual(parsed.boot_order, ['0001', '001A', '0000'])
+        self.assertEqual(parsed.boot_current, '0001')
+        self.assertIsNone(parsed.boot_next)
+        self.assertEqual(parsed.timeout, 3)
+        self.assertListEqual([e.num for e in parsed.entries], ['0000', '0001', '001A'])
+        entries = {e.num: e for e in parsed.entries}
+        self.assertEqual(entries['0001'].name, 'rEFInd Boot Manager')
+        self.assertEqual(entries['0001'].path, r'\EFI\refind\refind_x64.efi')
+        self.assertTrue(entries['0001'].active)
+        self.assertFalse(entries['001A'].active)
+        self.assertEqual(entries['001A'].parameters, 'root=LABEL=root quiet')
+        self.assertEqual(entries['0000'].parameters, '')
+
+
+class TestEfivarsWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.efivars_dir = Path(self.tmp.name)
+        self.writer = efivars.EfivarsWriter(str(self.efivars_dir))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_load_option_round_trip(self):
+        partition = efiboots.utils.PartitionInfo(number=1, start=0x800, size=0x40000,
+                                                 part_uuid='fda4f976-b250-4569-be80-0449804ab7c2', scheme='gpt')
+        data = efivars.make_load_option(efivars.LOAD_OPTION_ACTIVE, 'rEFInd Boot Manager',
+                                        efivars.make_esp_device_path(partition, r'\EFI\refind\refind_x64.efi'),
+                                        efivars.encode_optional_data('quiet splash'))
+        self.assertEqual(data, crafted_load_option(1, 'rEFInd Boot Manager', r'\EFI\refind\refind_x64.efi',
+                                                   'quiet splash'.encode('utf-16-le')))
+        entry = EfibootmgrEfivars.parse_entry('0003', data)
+        self.assertEqual((entry.name, entry.path, entry.parameters, entry.active),
+                         ('rEFInd Boot Manager', r'\EFI\refind\refind_x64.efi', 'quiet splash', True))
+
+    def test_write_session(self):
+        self.writer.write_load_option('0000', crafted_load_option(1, 'A', r'\a.efi', b''))
+        self.writer.write_load_option('0002', crafted_load_option(1, 'B', r'\b.efi', b''))
+        self.assertEqual(self.writer.free_boot_num(), '0001')
+        self.assertEqual(self.writer.free_boot_num({'0001'}), '0003')
+        self.writer.set_boot_order(['0002', '0000'])
+        self.writer.set_boot_next('0002')
+        self.writer.set_timeout(5)
+        self.writer.set_active('0000', False)
+
+        backend = EfibootmgrEfivars(str(self.efivars_dir))
+        parsed = backend.parse(backend.run())
+        self.assertListEqual(parsed.boot_order, ['0002', '0000'])
+        self.assertEqual(parsed.boot_next, '0002')
+        self.assertEqual(parsed.timeout, 5)
+        self.assertListEqual([e.active for e in parsed.entries], [False, True])
+
+        self.writer.set_boot_next(None)
+        self.writer.delete_load_option('0002')
+        parsed = backend.parse(backend.run())
+        self.assertIsNone(parsed.boot_next)
+        self.assertListEqual([e.num for e in parsed.entries], ['0000'])
+
+
+class TestNvramImage(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.image = make_ovmf_vars(Path(self.tmp.name) / 'OVMF_VARS.fd', 4)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_and_write(self):
+        parsed = EfibootmgrNvramImage(str(self.image)).read()
+        self.assertListEqual(parsed.boot_order, ['0000', '0001', '0002', '0003'])
+        self.assertEqual(parsed.entries[0].path, r'\EFI\refind\refind_x64.efi')
+        with varstore.VariableStore(str(self.image), writable=True) as store:
+            writer = varstore.VarstoreWriter(store)
+            free = store.free_space
+            # Same size: rewritten in place
+            writer.set_boot_order(['0003', '0002', '0001', '0000'])
+            self.assertFalse(writer.write_variable('BootOrder', struct.pack('<4H', 3, 2, 1, 0)))
+            self.assertEqual(store.free_space, free)
+            # Another size: appended, the old copy deleted
+            writer.set_boot_order(['0001', '0000'])
+            writer.set_timeout(5)
+            writer.delete_load_option('0002')
+            self.assertLess(store.free_space, free)
+            # Rewriting a big variable over and over fills the store with deleted copies, until they are reclaimed
+            for i in range(100):
+                writer.write_variable('Filler', bytes([i]) * (4000 + i % 2))
+            self.assertGreater(store.free_space, 0)
+            self.assertEqual(writer.read_variable('Filler'), (bytes([99]) * 4001, efivars.DEFAULT_ATTRIBUTES))
+            self.assertRaises(OSError, writer.write_variable, 'Huge', bytes(0x40000))
+        parsed = EfibootmgrNvramImage(str(self.image)).read()
+        self.assertListEqual(parsed.boot_order, ['0001', '0000'])
+        self.assertEqual(parsed.timeout, 5)
+        self.assertListEqual([e.num for e in parsed.entries], ['0000', '0001', '0003'])
+        self.assertRaises(varstore.VariableStoreError, varstore.VariableStore, __file__)
+
+    def test_in_use(self):
+        with open(self.image, 'rb') as qemu:
+            # Like the shared lock QEMU takes on a byte of the images of a running virtual machine
+            fcntl.fcntl(qemu.fileno(), fcntl.F_OFD_SETLK, varstore.FLOCK.pack(fcntl.F_RDLCK, os.SEEK_SET, 100, 1, 0))
+            with self.assertRaises(OSError) as raised:
+                varstore.VariableStore(str(self.image), writable=True)
+            self.assertEqual(raised.exception.errno, errno.EBUSY)
+            with varstore.VariableStore(str(self.image)) as store:
+                self.assertIn('BootOrder', store.variables())
+        with varstore.VariableStore(str(self.image), writable=True):
+            # And the other way around, the virtual machine can't start while the image is being changed
+            self.assertRaises(OSError, varstore.VariableStore, str(self.image), writable=True)
+        varstore.VariableStore(str(self.image), writable=True).close()
+
+    def test_plan(self):
+        plan = build_plan('', '', boot_remove={'0001'}, boot_add={},
+                          edits={'0000': ('VM disk', r'\EFI\refind\refind_x64.efi', '')},
+                          boot_order=['0003', '0000'], boot_order_initial=['0000', '0001', '0002', '0003'],
+                          boot_next='0003', boot_next_initial=None, boot_active=set(), boot_inactive={'0002'},
+                          timeout=None, timeout_initial=None, reboot=True, nvram_image=str(self.image))
+        self.assertTrue(plan.native)
+        self.assertNotIn('reboot', [step.action for step in plan.steps])
+        self.assertTrue(execute_plan(plan).ok)
+        parsed = EfibootmgrNvramImage(str(self.image)).read()
+        self.assertListEqual(parsed.boot_order, ['0003', '0000'])
+        self.assertEqual(parsed.boot_next, '0003')
+        self.assertListEqual([(e.num, e.name, e.active) for e in parsed.entries],
+                             [('0000', 'VM disk', True), ('0002', 'UEFI Misc Device 2', False),
+                              ('0003', 'UEFI Misc Device 3', True)])
+
+
+class TestDevicePath(unittest.TestCase):
+    def test_format(self):
+        formatted = [devicepath.format_device_path(devicepath.decode_device_path(path))
+                     for path in make_device_paths(8)]
+        hd = 'HD(1,GPT,fda4f976-b250-4569-be80-0449804ab7c2,0x800,0x40000)'
+        self.assertListEqual(formatted, [
+            hd + r'/File(\EFI\refind\refind_x64.efi)',
+            'PciRoot(0x0)/Pci(0x1c,0x0)/MAC(00163e5e6c00,1)/IPv4(192.168.1.1,TCP,DHCP,0.0.0.0,0.0.0.0,0.0.0.0)',
+            'PciRoot(0x0)/Pci(0x1c,0x0)/MAC(00163e5e6c00,1)/IPv6(::,TCP,StatelessAutoConfigure,::,::,64)'
+            '/Uri(http://boot.example.com/shim.efi)',
+            'PciRoot(0x0)/Pci(0x1d,0x0)/NVMe(0x1,00-01-02-03-04-05-06-07)/' + hd + r'/File(\EFI\BOOT\BOOTX64.EFI)',
+            'PciRoot(0x0)/Pci(0x14,0x0)/USB(3,0)',
+            'PciRoot(0x0)/Pci(0x1f,0x2)/Sata(0,65535,0)',
+            'PciRoot(0x0)/Pci(0x1c,0x0)/MAC(00163e5e6c00,1)/Vlan(100)',
+            'BBS(HD,SATA: Samsung SSD,0x0),' + hd + r'/File(\EFI\BOOT\BOOTX64.EFI)',
+        ])
+
+    def test_nodes(self):
+        nodes = devicepath.decode_device_path(make_device_paths(8)[7])
+        self.assertEqual(nodes[0], devicepath.BbsNode(2, 0, 'SATA: Samsung SSD'))
+        self.assertIsInstance(nodes[1], devicepath.EndInstanceNode)
+        self.assertEqual(nodes[2].signature, uuid.UUID('fda4f976-b250-4569-be80-0449804ab7c2'))
+        self.assertEqual(devicepath.file_path(nodes), '')
+        self.assertListEqual([devicepath.file_path(instance) for instance in devicepath.split_instances(nodes)],
+                             ['', r'\EFI\BOOT\BOOTX64.EFI'])
+
+    def test_unknown_and_malformed(self):
+        path = efivars.make_device_path(efivars.make_device_path_node(0x03, 0x7e, b'\x01\x02'),
+                                        efivars.make_device_path_node(0x01, 0x01, b''))
+        self.assertListEqual(devicepath.decode_device_path(path),
+                             [devicepath.RawNode(3, 0x7e, b'\x01\x02'), devicepath.RawNode(1, 1, b'')])
+        # A length running past the end stops decoding instead of reading the next field
+        self.assertListEqual(devicepath.decode_device_path(path[:-4] + b'\x7f\xff\x40\x00'),
+                             devicepath.decode_device_path(path))
+        self.assertListEqual(devicepath.decode_device_path(b'\x04\x04\x02\x00'), [])
+
+    def test_load_option(self):
+        data = crafted_load_option(1, 'Linux', r'\vmlinuz-linux', b'quiet')
+        _, next_field = efivars.get_load_option_description(data)
+        nodes, end = efivars.get_load_option_device_path(data, next_field)
+        self.assertEqual(data[end:], b'quiet')
+        self.assertEqual(efivars.get_load_option_path(nodes), r'\vmlinuz-linux')
+
+
+class TestPartitionInfo(unittest.TestCase):
+    def test_get_partition_info(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sysfs = Path(tmp, 'sys')
+            udev = Path(tmp, 'udev')
+            part_dir = sysfs / 'nvme0n1' / 'nvme0n1p1'
+            (sysfs / 'nvme0n1' / 'queue').mkdir(parents=True)
+            part_dir.mkdir()
+            udev.mkdir()
+            (sysfs / 'nvme0n1' / 'queue' / 'logical_block_size').write_text('4096\n')
+            (part_dir / 'partition').write_text('1\n')
+            (part_dir / 'start').write_text('2048\n')
+            (part_dir / 'size').write_text('1048576\n')
+            (part_dir / 'dev').write_text('259:1\n')
+            (udev / 'b259:1').write_text('E:ID_PART_ENTRY_SCHEME=gpt\n'
+                                         'E:ID_PART_ENTRY_UUID=FDA4F976-B250-4569-BE80-0449804AB7C2\n')
+            info = efiboots.utils.get_partition_info('/dev/nvme0n1', '1', str(sysfs), str(udev))
+            self.assertEqual(info, efiboots.utils.PartitionInfo(1, 256, 131072,
+                                                                'fda4f976-b250-4569-be80-0449804ab7c2', 'gpt'))
+
+
+class TestChangePlan(unittest.TestCase):
+    def test_build_plan(self):
+        plan = build_plan('/dev/sda', '1', boot_remove={'0003'}, boot_add={'NEW0': ("It's new", r'\new.efi', '')},
+                          edits={'0001': ('rEFInd', r'\EFI\refind\refind_x64.efi', 'a b')},
+                          boot_order=['0001', '0000'], boot_order_initial=['0000', '0001', '0003'],
+                          boot_next=None, boot_next_initial='0000', boot_active=set(), boot_inactive={'0000'},
+                          timeout=3, timeout_initial=3, reboot=True)
+        self.assertListEqual([step.action for step in plan.steps],
+                             ['delete', 'create', 'edit', 'boot_order', 'delete_boot_next', 'inactive', 'reboot'])
+        self.assertListEqual(plan.steps[1].argv('/dev/sda', '1'),
+                             ['efibootmgr', '--disk', '/dev/sda', '--part', '1', '--create', '--label', "It's new",
+                              '--loader', r'\new.efi', '--unicode', ''])
+        self.assertIn("--label 'It'\"'\"'s new'", plan.to_script())
+        self.assertSetEqual(plan.variables(), {'Boot0003', 'Boot0001', 'Boot0000', 'BootOrder', 'BootNext'})
+        self.assertEqual(ChangePlan.from_json(plan.to_json()), plan)
+
+    def test_execute_rolls_back(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            write_efivar(Path(tmp), 'Boot0000', crafted_load_option(1, 'A', r'\a.efi', b''))
+            write_efivar(Path(tmp), 'BootOrder', struct.pack('<H', 0))
+            plan = ChangePlan('/dev/sda', '1', [PlanStep('timeout', timeout=4), PlanStep('inactive', num='0000'),
+                                                PlanStep('edit', num='0009', label='X', loader='', parameters='')],
+                              native=True)
+            report = execute_plan(plan, efivars_path=tmp)
+            self.assertFalse(report.ok)
+            self.assertTrue(report.rolled_back)
+            self.assertListEqual([s.ok for s in report.steps], [True, True, False])
+            self.assertIsNone(efivars.get_timeout(tmp))
+            data, _ = efivars.get_variable_data('Boot0000', efivars_path=tmp)
+            self.assertTrue(EfibootmgrEfivars.parse_entry('0000', data).active)
+
+            plan.steps.pop()
+            report = execute_plan(plan, efivars_path=tmp)
+            self.assertTrue(report.ok)
+            self.assertEqual(efivars.get_timeout(tmp), 4)
+
+    def test_out_of_range(self):
+        arguments = dict(boot_remove=set(), boot_add={}, edits={}, boot_order=['0000'], boot_order_initial=['0000'],
+                         boot_next=None, boot_next_initial=None, boot_active=set(), boot_inactive=set(),
+                         timeout=70000, timeout_initial=3)
+        with self.assertRaises(ValueError):
+            build_plan('/dev/sda', '1', **arguments)
+        with self.assertRaises(ValueError):
+            build_plan('/dev/sda', '1', **(arguments | dict(timeout=3, boot_order=['0000', '10000'])))
+        with tempfile.TemporaryDirectory() as tmp:
+            write_efivar(Path(tmp), 'BootOrder', struct.pack('<H', 0))
+            # Plans that skipped validation still roll back
+            plan = ChangePlan('/dev/sda', '1', [PlanStep('boot_order', boot_order=['0001', '0000']),
+                                                PlanStep('timeout', timeout=70000)], native=True)
+            report = execute_plan(plan, efivars_path=tmp)
+            self.assertFalse(report.ok)
+            self.assertTrue(report.rolled_back)
+            self.assertEqual(efivars.get_boot_order(tmp), ['0000'])
+
+            plan = ChangePlan('/dev/sda', '1', [PlanStep('timeout', timeout=4), PlanStep('bogus')], native=True)
+            with self.assertRaises(ValueError):
+                plan.validate()
+            report = execute_plan(plan, efivars_path=tmp)
+            self.assertTrue(report.rolled_back)
+            self.assertListEqual([s.ok for s in report.steps], [True, False])
+            self.assertIsNone(efivars.get_timeout(tmp))
+        with self.assertRaises(ValueError):
+            PlanStep('create', label='A', loader=r'\a.efi').validate()
+
+    def test_edit_keeps_binary_optional_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            write_efivar(Path(tmp), 'Boot0000', crafted_load_option(1, 'A', r'\a.efi', b'\x01\xff\x00'))
+            plan = ChangePlan('/dev/sda', '1', [PlanStep('edit', num='0000', label='B', loader=r'\a.efi',
+                                                         parameters='')], native=True)
+            self.assertTrue(execute_plan(plan, efivars_path=tmp).ok)
+            data, _ = efivars.get_variable_data('Boot0000', efivars_path=tmp)
+            self.assertEqual(data, crafted_load_option(1, 'B', r'\a.efi', b'\x01\xff\x00'))
+
+    def test_minimal_writes(self):
+        initial = {'0000': ('A', r'\a.efi', 'quiet'), '0001': ('B', r'\b.efi', '')}
+        plan = build_plan('/dev/sda', '1', boot_remove=set(), boot_add={},
+                          edits={'0000': ('A', r'\a.efi', 'quiet'), '0001': ('C', r'\b.efi', '')},
+                          boot_order=['0000', '0001'], boot_order_initial=['0000', '0001'], boot_next=None,
+                          boot_next_initial=None, boot_active=set(), boot_inactive=set(), timeout=None,
+                          timeout_initial=None, native=True, entries_initial=initial)
+        self.assertListEqual(plan.steps, [PlanStep('edit', num='0001', label='C', loader=r'\b.efi', parameters='',
+                                                   fields=['label'])])
+        with tempfile.TemporaryDirectory() as tmp:
+            # ASCII optional data would come back as UCS-2 if the entry was rebuilt from the parameters
+            write_efivar(Path(tmp), 'Boot0001', crafted_load_option(1, 'B', r'\b.efi', b'ascii'))
+            write_efivar(Path(tmp), 'Timeout', struct.pack('<H', 3))
+            self.assertTrue(execute_plan(plan, efivars_path=tmp).ok)
+            data, _ = efivars.get_variable_data('Boot0001', efivars_path=tmp)
+            self.assertEqual(data, crafted_load_option(1, 'C', r'\b.efi', b'ascii'))
+            writer = efivars.EfivarsWriter(tmp)
+            self.assertFalse(writer.write_variable('Timeout', struct.pack('<H', 3)))
+            self.assertTrue(writer.write_variable('Timeout', struct.pack('<H', 4)))
+
+
+class TestFakeFirmware(unittest.TestCase):
+    def test_save_cycle(self):
+        for version, route in (('17', 'script'), ('18', 'plan')):
+            with self.subTest(version=version, route=route), FakeFirmware(8, version):
+                parsed = Efibootmgr.get_instance('efibootmgr').read()
+                self.assertEqual(len(parsed.entries), 8)
+                self.assertEqual(parsed.entries[0].parameters, 'root=LABEL=root rw quiet initrd=0')
+                plan = edit_session(parsed, 6, random.Random(0))
+                removed = {step.num for step in plan.steps if step.action == 'delete'}
+                order = next(step.boot_order for step in plan.steps if step.action == 'boot_order')
+
+                after, timings = save_cycle(plan, route)
+                self.assertEqual(after.boot_order, order)
+                self.assertEqual(after.boot_next, order[0])
+                self.assertEqual(after.timeout, 6)
+                # efibootmgr --create reuses the lowest free number, possibly a deleted one
+                names = {entry.num: entry.name for entry in after.entries}
+                self.assertTrue(all(names.get(num, 'Added').startswith('Added') for num in removed))
+                self.assertIn('Added 0', names.values())
+                self.assertGreater(timings['total'], 0)
+
+
+class TestCli(unittest.TestCase):
+    # Generous for a cold start on a loaded CI runner: the GUI takes several times as long just to import Gtk
+    STARTUP_BUDGET = 0.5
+
+    def run_cli(self, *args: str) -> subprocess.CompletedProcess:
+        return subprocess.run([sys.executable, '-m', 'efiboots.cli', *args], capture_output=True, text=True,
+                              env=os.environ | {'PYTHONPATH': str(test_dir.parent / 'src')})
+
+    def test_commands(self):
+        with FakeFirmware(4, '18') as firmware:
+            fake = '--efivars', firmware.efivars_path
+            listed = json.loads(self.run_cli(*fake, 'list').stdout)
+            self.assertEqual(listed['boot_order'], ['0000', '0001', '0002', '0003'])
+            self.assertTrue(listed['entries'][0]['current'])
+            result = self.run_cli(*fake, '-d', '/dev/sda', '-p', '1', 'set-order', '3,2', '1', '0')
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertTrue(json.loads(result.stdout)['ok'])
+            result = self.run_cli(*fake, '-d', '/dev/sda', '-p', '1', '-b', 'efibootmgr', 'remove', '1')
+            self.assertEqual(result.returncode, 0, result.stderr)
+            lines = self.run_cli(*fake, '--format', 'ndjson', 'list').stdout.splitlines()
+            self.assertEqual([(e['num'], e['order']) for e in map(json.loads, lines)],
+                             [('0000', 2), ('0002', 1), ('0003', 0)])
+            result = self.run_cli(*fake, 'show', '9')
+            self.assertEqual(result.returncode, 1)
+            self.assertIn('Boot0009 does not exist', result.stderr)
+
+    def test_nvram_image(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            image = str(make_ovmf_vars(Path(tmp) / 'OVMF_VARS.fd', 3))
+            result = self.run_cli('--nvram-image', image, 'set-order', '2,0')
+            self.assertEqual(result.returncode, 0, result.stderr)
+            listed = json.loads(self.run_cli('--nvram-image', image, 'list').stdout)
+            self.assertEqual(listed['boot_order'], ['0002', '0000'])
+            result = self.run_cli('--nvram-image', image, 'add', '-L', 'x', '-l', r'\x.efi')
+            self.assertIn('--disk and --part', result.stderr)
+
+    def test_arguments(self):
+        for seconds in ('-1', '65536', 'x'):
+            result = self.run_cli('timeout', seconds)
+            self.assertEqual(result.returncode, 2)
+            self.assertIn('invalid timeout', result.stderr)
+        self.assertEqual(cli.command_of(['-d', '/dev/sda', '--part=1', 'timeout', '3']), 'timeout')
+        self.assertEqual(cli.command_of(['-nd', 'show', 'list']), 'list')
+        # Option values that happen to be command names run the GUI
+        self.assertIsNone(cli.command_of(['-i', 'list']))
+        self.assertIsNone(cli.command_of(['--disk', 'show', '--log-level', 'debug']))
+        self.assertIsNone(cli.command_of(['--profile-startup']))
+
+    def test_startup_budget(self):
+        code = "import sys; from efiboots import cli; cli.main(['--efivars', sys.argv[1], 'list']); " \
+               "sys.exit('gi' in sys.modules)"
+        with FakeFirmware(32) as firmware:
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                result = subprocess.run([sys.executable, '-c', code, firmware.efivars_path], capture_output=True,
+                                        text=True, env=os.environ | {'PYTHONPATH': str(test_dir.parent / 'src')})
+                timings.append(time.perf_counter() - start)
+                self.assertEqual(result.returncode, 0, "gi was imported" if result.returncode == 1 else result.stderr)
+        self.assertLess(min(timings), self.STARTUP_BUDGET)
+
+    def test_no_gi(self):
+        # Modules that work without a display, and so must not load GTK
+        code = "import sys; from efiboots import authenticode, cli, host, loadercheck, plan, profile, session, " \
+               "signatures, varstore; sys.exit('gi' in sys.modules)"
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                env=os.environ | {'PYTHONPATH': str(test_dir.parent / 'src')})
+        self.assertEqual(result.returncode, 0, "gi was imported" if result.returncode == 1 else result.stderr)
+
+
+class TestStartupProfile(unittest.TestCase):
+    def test_phases(self):
+        profile = StartupProfile()
+        profile.mark('imports')
+        with profile.timed('ESP probe'):
+            pass
+        profile.finish()
+        profile.mark('after the report')
+        self.assertListEqual([phase for phase, _, _ in profile.phases], ['imports', 'ESP probe'])
+        self.assertTrue(all(seconds >= 0 and at >= seconds for _, seconds, at in profile.phases))
+        self.assertIn('ESP probe', profile.report())
+
+
+class TestBootOrder(unittest.TestCase):
+    def assertConsistent(self, order: BootOrder):
+        self.assertListEqual([order.rank(num) for num in order], list(range(len(order))))
+
+    def test_edits(self):
+        order = BootOrder(['0001', '0003', '0005', '0000'])
+        self.assertEqual(order, ['0001', '0003', '0005', '0000'])
+        self.assertEqual(order.index('0005'), 2)
+        self.assertIsNone(order.rank('0009'))
+        self.assertRaises(ValueError, order.index, '0009')
+        order.move('0000', 0)
+        self.assertEqual(order, ['0000', '0001', '0003', '0005'])
+        self.assertConsistent(order)
+        order.move('0001', 3)
+        self.assertEqual(order, ['0000', '0003', '0005', '0001'])
+        self.assertConsistent(order)
+        order.swap(0, 1)
+        order.remove('0005')
+        order.insert(1, '000A')
+        order.append('000B')
+        order.discard('0009')
+        self.assertEqual(order, ['0003', '000A', '0000', '0001', '000B'])
+        self.assertNotIn('0005', order)
+        self.assertConsistent(order)
+        order.replace(1, 3, ['0001', '000C', '0000', '000A'])
+        self.assertEqual(order, ['0003', '0001', '000C', '0000', '000A', '000B'])
+        self.assertConsistent(order)
+
+
+class TestEditSession(unittest.TestCase):
+    def setUp(self):
+        self.session = EditSession()
+        self.session.reset(['0001', '0002', '0000'], None, 3,
+                           {'0000': (('A', r'\a.efi', ''), True), '0001': (('B', r'\b.efi', 'quiet'), True),
+                            '0002': (('C', r'\c.efi', ''), False)})
+
+    def test_undo_redo(self):
+        session = self.session
+        move = session.plan_move(['0001', '0002', '0000'], [2], [0])
+        self.assertEqual(move, Move((2,), (0,), 0, ('0001', '0002', '0000'), ('0000', '0001', '0002')))
+        session.do(move)
+        session.do(Edit('0001', ('B', r'\b.efi', 'quiet'), ('B2', r'\b.efi', 'quiet')))
+        session.do(Toggle('0002', True))
+        session.do(Remove('0000', ('A', r'\a.efi', ''), True, 0, 0))
+        session.do(SetTimeout(3, 5))
+        self.assertTrue(session.dirty)
+        self.assertEqual(session.boot_order, ['0001', '0002'])
+        while session.undo():
+            pass
+        self.assertFalse(session.dirty)
+        self.assertEqual(session.boot_order, ['0001', '0002', '0000'])
+        self.assertEqual(session.entry('0001'), (('B', r'\b.efi', 'quiet'), True))
+        self.assertEqual(session.redo(), move)
+        self.assertEqual(session.boot_order, ['0000', '0001', '0002'])
+        self.assertTrue(session.dirty)
+        session.do(session.plan_move(['0000', '0001', '0002'], [0], [2]))
+        self.assertFalse(session.dirty)
+        self.assertIsNone(session.redo())
+
+    def test_move_rows(self):
+        session = self.session
+        session.reset(['0001', '0002', '0000', '0003'], None, 3,
+                      {num: (('A', r'\a.efi', ''), True) for num in ('0000', '0001', '0002', '0003', '0004')})
+        # Rows show the boot order, then 0004 which isn't part of it, then a new entry
+        num = session.new_num()
+        session.do(Add(num, ('D', r'\d.efi', ''), True, 5))
+        rows = ['0001', '0002', '0000', '0003', '0004', num]
+        # The last two entries to the top, keeping their order: 0004 joins the boot order
+        move = session.plan_move(rows[1:], [3, 4], [1, 2], start=1)
+        self.assertEqual(move, Move((3, 4), (1, 2), 1, ('0002', '0000', '0003'), ('0003', '0004', '0002', '0000')))
+        session.do(move)
+        rows = place(rows, move.positions, move.new_positions)
+        self.assertListEqual(rows, ['0001', '0003', '0004', '0002', '0000', num])
+        self.assertEqual(session.boot_order, ['0001', '0003', '0004', '0002', '0000'])
+        # Scattered rows, new entry included, to the bottom
+        move = session.plan_move(rows, [0, 2, 5], [3, 4, 5])
+        session.do(move)
+        self.assertListEqual(place(rows, move.positions, move.new_positions),
+                             ['0003', '0002', '0000', '0001', '0004', num])
+        self.assertEqual(session.boot_order, ['0003', '0002', '0000', '0001', '0004'])
+        session.undo()
+        session.undo()
+        self.assertEqual(session.boot_order, ['0001', '0002', '0000', '0003'])
+        self.assertListEqual([op.num for op in session.compact()], [num])
+
+    def test_compact(self):
+        session = self.session
+        num = session.new_num()
+        session.do(Add(num, ('D', r'\d.efi', ''), True, 3))
+        session.do(Edit(num, ('D', r'\d.efi', ''), ('D2', r'\d.efi', 'rw')))
+        session.do(Toggle('0002', True))
+        session.do(Toggle('0002', False))
+        session.do(Edit('0000', ('A', r'\a.efi', ''), ('A', r'\a.efi', 'rw')))
+        session.do(Edit('0000', ('A', r'\a.efi', 'rw'), ('A', r'\a.efi', '')))
+        session.do(session.plan_move(['0001', '0002'], [0], [1]))
+        session.do(session.plan_move(['0002', '0001'], [1], [0]))
+        session.do(SetNext(None, '0002'))
+        self.assertListEqual(session.compact(), [Add(num, ('D2', r'\d.efi', 'rw'), True, 3), SetNext(None, '0002')])
+        arguments = session.plan_arguments()
+        self.assertEqual(arguments['boot_add'], {num: ('D2', r'\d.efi', 'rw')})
+        self.assertEqual(arguments['boot_next'], '0002')
+        self.assertEqual(arguments['boot_order'], arguments['boot_order_initial'])
+        plan = build_plan('/dev/sda', '1', **arguments)
+        self.assertListEqual([step.action for step in plan.steps], ['create', 'boot_next'])
+
+    def test_rebase(self):
+        session = self.session
+        session.do(Edit('0001', ('B', r'\b.efi', 'quiet'), ('B', r'\b.efi', 'rw')))
+        session.do(Toggle('0002', True))
+        session.do(Edit('0000', ('A', r'\a.efi', ''), ('A2', r'\a.efi', '')))
+        # Someone else renamed 0001, enabled 0002 and deleted 0000
+        session.rebase(['0002', '0001'], None, 3, {'0001': (('B3', r'\b.efi', 'quiet'), True),
+                                                 '0002': (('C', r'\c.efi', ''), True)})
+        self.assertEqual(session.entry('0001'), (('B3', r'\b.efi', 'rw'), True))
+        self.assertEqual(session.boot_order, ['0002', '0001'])
+        self.assertListEqual(session.compact(), [Edit('0001', ('B3', r'\b.efi', 'quiet'), ('B3', r'\b.efi', 'rw'))])
+        self.assertTrue(session.dirty)
+        self.assertListEqual(session.undo_stack, [])
+
+    def test_undo_after_rebase(self):
+        session = self.session
+        session.do(Edit('0001', ('B', r'\b.efi', 'quiet'), ('B', r'\b.efi', 'rw')))
+        session.rebase(['0001', '0002'], None, 3, {'0000': (('A', r'\a.efi', ''), True),
+                                                 '0001': (('B3', r'\b.efi', 'quiet'), True),
+                                                 '0002': (('C', r'\c.efi', ''), False)})
+        # Undoing the edit would bring back the label it was made against, reverting the rename made elsewhere
+        self.assertIsNone(session.undo())
+        self.assertEqual(session.entry('0001'), (('B3', r'\b.efi', 'rw'), True))
+        self.assertListEqual(session.compact(), [Edit('0001', ('B3', r'\b.efi', 'quiet'), ('B3', r'\b.efi', 'rw'))])
+        # The edit is undone by hand: nothing left to save, and nothing reported either
+        session.do(Edit('0001', ('B3', r'\b.efi', 'rw'), ('B3', r'\b.efi', 'quiet')))
+        self.assertFalse(session.dirty)
+        self.assertListEqual(session.compact(), [])
+
+
+class TestAutoDetectEsp(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_mounted(self):
+        paths = make_sysfs_tree(self.root, 3, 4, esps=((0, 1),), mounts={'/boot/efi': (2, 3), '/mnt/my esp': (1, 1)})
+        self.assertTupleEqual(efiboots.utils.auto_detect_esp_with_sysfs(**paths), ('/dev/nvme2n1', '3'))
+        mounts = efiboots.utils.parse_mountinfo(paths['mountinfo_path'])
+        self.assertEqual(mounts['/mnt/my esp'], ('259:257', '/dev/nvme1n1p1', 'vfat'))
+
+    def test_partition_type(self):
+        paths = make_sysfs_tree(self.root, 3, 4, esps=((1, 2),))
+        self.assertTupleEqual(efiboots.utils.auto_detect_esp_with_sysfs(**paths), ('/dev/nvme1n1', '2'))
+
+    def test_many_esps(self):
+        paths = make_sysfs_tree(self.root, 3, 4, esps=((1, 2), (2, 1)))
+        many = []
+        self.assertIsNone(efiboots.utils.auto_detect_esp_with_sysfs(many.append, **paths))
+        self.assertListEqual(many, [['/dev/nvme1n1p2', '/dev/nvme2n1p1']])
+
+    def test_unreadable_udev_data(self):
+        paths = make_sysfs_tree(self.root, 3, 4, esps=((1, 2),))
+        # Can't be read, like a file only root may read when not running as root
+        Path(paths['udev_data_path'], 'b259:999').mkdir()
+        self.assertTupleEqual(efiboots.utils.auto_detect_esp_with_sysfs(**paths), ('/dev/nvme1n1', '2'))
+        self.assertDictEqual(efiboots.utils.read_udev_properties('259:999', paths['udev_data_path']), {})
+
+
+
+class TestPartitionIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        paths = make_sysfs_tree(self.root, 3, 4, mounts={'/boot/efi': (2, 1)})
+        self.index = efiboots.utils.PartitionIndex(str(self.root / 'by-partuuid'), str(self.root / 'class' / 'block'),
+                                                   paths['udev_data_path'], paths['mountinfo_path'])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def partition(disk: int, part: int) -> PartitionInfo:
+        return PartitionInfo(part, part * 2048, 2048, f'{disk:08x}-0000-0000-0000-{part:012x}', 'gpt')
+
+    def check(self):
+        BlockDevice = efiboots.utils.BlockDevice
+        self.assertEqual(self.index.resolve(self.partition(1, 3)),
+                         BlockDevice('/dev/nvme1n1p3', '/dev/nvme1n1', 3, None))
+        self.assertEqual(self.index.resolve(self.partition(2, 1)),
+                         BlockDevice('/dev/nvme2n1p1', '/dev/nvme2n1', 1, '/boot/efi'))
+        self.assertIsNone(self.index.resolve(self.partition(5, 1)))
+        self.assertIsNone(self.index.resolve(None))
+
+    def test_resolve(self):
+        self.check()
+        # Built once, until invalidated
+        devices = self.index.devices()
+        self.assertEqual(len(devices), 12)
+        shutil.rmtree(self.root / 'by-partuuid')
+        self.assertIs(self.index.devices(), devices)
+        self.index.invalidate()
+        self.assertIsNot(self.index.devices(), devices)
+
+    def test_without_by_partuuid_links(self):
+        shutil.rmtree(self.root / 'by-partuuid')
+        self.check()
+
+    def test_entry_partitions(self):
+        gpt = 'fda4f976-b250-4569-be80-0449804ab7c2'
+        line = rf'Boot0001* rEFInd	HD(1,GPT,{gpt.upper()},0x800,0x40000)/File(\EFI\refind\refind_x64.efi)'
+        expected = PartitionInfo(1, 0x800, 0x40000, gpt, 'gpt')
+        self.assertEqual(EfibootmgrV18.parse_line(line)[1].partition, expected)
+        mbr = PartitionInfo(2, 0x800, 0x100000, '9b2c1d5e-02', 'dos')
+        self.assertEqual(parse_hard_drive('HD(2,MBR,0x9b2c1d5e,0x800,0x100000)'), mbr)
+        self.assertIsNone(EfibootmgrV18.parse_line('Boot0000* SATA1\tBBS(17,,0x0)')[1].partition)
+        # Both backends agree, for GPT and MBR partitions
+        for partition in (expected, mbr):
+            device_path = efivars.make_esp_device_path(partition, r'\x.efi')
+            data = efivars.make_load_option(efivars.LOAD_OPTION_ACTIVE, 'x', device_path)
+            self.assertEqual(EfibootmgrEfivars.parse_entry('0001', data).partition, partition)
+
+
+class TestLoaderCheck(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.esp = self.tmp.name
+        os.makedirs(os.path.join(self.esp, 'EFI', 'Boot'))
+        self.loader = os.path.join(self.esp, 'EFI', 'Boot', 'bootx64.efi')
+        Path(self.loader).write_bytes(b'MZ' * 100)
+        self.checker = LoaderChecker()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_check(self):
+        found = self.checker.check(self.esp, r'\EFI\BOOT\BOOTX64.EFI')
+        self.assertEqual(found, LoaderCheck(loadercheck.LOADER_FOUND, self.loader, 200))
+        # Unchanged files are not looked up again
+        self.assertIs(self.checker.check(self.esp, r'\EFI\BOOT\BOOTX64.EFI'), found)
+        self.assertEqual(self.checker.check(self.esp, r'\\EFI\\boot\\bootx64.efi'), found)
+        Path(self.loader).write_bytes(b'')
+        os.utime(self.loader, ns=(0, 0))
+        self.assertEqual(self.checker.check(self.esp, r'\EFI\BOOT\BOOTX64.EFI').status, loadercheck.LOADER_EMPTY)
+        os.unlink(self.loader)
+        self.assertEqual(self.checker.check(self.esp, r'\EFI\BOOT\BOOTX64.EFI').status, loadercheck.LOADER_MISSING)
+
+    def test_missing(self):
+        self.assertEqual(self.checker.check(self.esp, r'\EFI\arch\grubx64.efi').status, loadercheck.LOADER_MISSING)
+        os.makedirs(os.path.join(self.esp, 'EFI', 'Arch'))
+        Path(self.esp, 'EFI', 'Arch', 'GRUBX64.EFI').write_bytes(b'MZ')
+        self.assertEqual(self.checker.check(self.esp, r'\EFI\arch\grubx64.efi').status, loadercheck.LOADER_FOUND)
+        self.assertEqual(self.checker.check(None, r'\EFI\arch\grubx64.efi').status, loadercheck.LOADER_UNMOUNTED)
+        self.assertIsNone(self.checker.check(self.esp, ''))
+
+
+class TestAuthenticode(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def expected(path: Path) -> bytes:
+        """The whole image but the checksum, the certificate table entry and the certificates, which is what
+        Authenticode hashes when the sections follow each other"""
+        image = path.read_bytes()
+        optional = 0x40 + 24
+        magic, = struct.unpack_from('<H', image, optional)
+        count_offset, directories = authenticode.DATA_DIRECTORIES[magic]
+        checksum = optional + authenticode.CHECKSUM_OFFSET
+        security = optional + directories + 8 * authenticode.SECURITY_DIRECTORY
+        _, certificates_size = struct.unpack_from('<II', image, security)
+        return hashlib.sha256(image[:checksum] + image[checksum + 4:security] +
+                              image[security + 8:len(image) - certificates_size]).digest()
+
+    def test_digest(self):
+        sections = [b'\x90' * 3000, b'', b'data' * 100]
+        for pe32_plus in (True, False):
+            unsigned = make_pe(self.root / 'unsigned.efi', sections, trailer=b'extra', pe32_plus=pe32_plus)
+            digest = authenticode.authenticode_digest(str(unsigned))
+            self.assertEqual(digest, authenticode.PeDigest(self.expected(unsigned), False))
+            # Neither the checksum nor the signatures are part of the digest
+            signed = make_pe(self.root / 'signed.efi', sections, certificates=b'\x30' * 64, trailer=b'extra',
+                             pe32_plus=pe32_plus, checksum=0xbeef)
+            self.assertEqual(authenticode.authenticode_digest(str(signed)), authenticode.PeDigest(digest.sha256, True))
+            changed = make_pe(self.root / 'changed.efi', [b'\x91' * 3000, b'', b'data' * 100], trailer=b'extra',
+                              pe32_plus=pe32_plus)
+            self.assertNotEqual(authenticode.authenticode_digest(str(changed)).sha256, digest.sha256)
+
+    def test_not_pe(self):
+        for data in (b'', b'MZ' + bytes(100), b'#!/bin/sh\n'):
+            Path(self.root, 'x.efi').write_bytes(data)
+            with self.assertRaises(authenticode.PeError):
+                authenticode.authenticode_digest(str(self.root / 'x.efi'))
+
+    def test_cache(self):
+        cache = str(self.root / 'cache' / 'authenticode.json')
+        images = [str(make_pe(self.root / f'{i}.efi', [bytes([i]) * 1000])) for i in range(3)]
+        Path(self.root, 'text.efi').write_text('not an image')
+        paths = images + [str(self.root / 'text.efi'), str(self.root / 'gone.efi')]
+        digests = authenticode.AuthenticodeHasher(cache).digests(paths)
+        self.assertEqual([digests[path] for path in images],
+                         [authenticode.authenticode_digest(path) for path in images])
+        self.assertIsInstance(digests[paths[3]], authenticode.PeError)
+        self.assertIsInstance(digests[paths[4]], FileNotFoundError)
+        # Repeat runs read digests from the cache, as long as the files don't change
+        stored = json.loads(Path(cache).read_text())
+        key = authenticode.cache_key(os.stat(images[0]))
+        stored['digests'][key] = ['00' * 32, True]
+        Path(cache).write_text(json.dumps(stored))
+        hasher = authenticode.AuthenticodeHasher(cache)
+        self.assertEqual(hasher.digests(images[:1])[images[0]], authenticode.PeDigest(bytes(32), True))
+        make_pe(Path(images[0]), [b'\xff' * 2000])
+        self.assertEqual(hasher.digests(images[:1])[images[0]], authenticode.authenticode_digest(images[0]))
+
+
+class TestSignatures(unittest.TestCase):
+    def test_parse(self):
+        dbx, revoked = make_dbx(1500)
+        allowed = hashlib.sha256(b'shim').digest()
+        db = make_signature_list(signatures.EFI_CERT_SHA256_GUID, [allowed, revoked[0]]) + \
+            make_signature_list(signatures.EFI_CERT_SHA1_GUID, [bytes(20)] * 3)
+        dbx, db = signatures.SignatureDatabase.parse(dbx), signatures.SignatureDatabase.parse(db)
+        self.assertEqual(len(dbx.sha256), 1500)
+        self.assertEqual([bytes(certificate[:2]) for certificate in dbx.certificates], [b'\x30\x82'])
+        self.assertEqual(db.others, {signatures.EFI_CERT_SHA1_GUID: 3})
+        self.assertEqual(len(db), 5)
+        self.assertEqual(signatures.verdict(allowed, db, dbx), signatures.VERDICT_ALLOWED)
+        # dbx wins over db
+        self.assertEqual(signatures.verdict(revoked[0], db, dbx), signatures.VERDICT_REVOKED)
+        self.assertEqual(signatures.verdict(revoked[-1], db, dbx), signatures.VERDICT_REVOKED)
+        self.assertEqual(signatures.verdict(bytes(32), db, dbx), signatures.VERDICT_UNKNOWN)
+
+    def test_malformed(self):
+        data = make_signature_list(signatures.EFI_CERT_SHA256_GUID, [bytes(32)] * 2)
+        for malformed in (data[:-1], data + b'\0' * 4, data[:24] + struct.pack('<I', 47) + data[28:]):
+            with self.assertRaises(signatures.SignatureListError):
+                signatures.SignatureDatabase.parse(malformed)
+
+    def test_reread_on_change(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = efivars.variable_path('dbx', signatures.EFI_IMAGE_SECURITY_DATABASE_GUID, tmp)
+            databases = signatures.SignatureDatabases(tmp)
+            self.assertEqual(len(databases.get('dbx')), 0)
+            data, revoked = make_dbx(10)
+            Path(path).write_bytes(struct.pack('<I', 0x27) + data)
+            dbx = databases.get('dbx')
+            self.assertIs(databases.get('dbx'), dbx)
+            self.assertEqual(databases.verdict(revoked[3]), signatures.VERDICT_REVOKED)
+            # Revocation updates append to dbx
+            more, revoked = make_dbx(20, seed=1)
+            with open(path, 'ab') as f:
+                f.write(more)
+            self.assertIsNot(databases.get('dbx'), dbx)
+            self.assertEqual(databases.verdict(revoked[15]), signatures.VERDICT_REVOKED)
+
+
+class TestHostHelper(unittest.TestCase):
+    """Runs the Flatpak host helper as a plain subprocess"""
+
+    def setUp(self):
+        self.helper = HostHelper(prefix=())
+
+    def tearDown(self):
+        self.helper.close()
+
+    def test_batch(self):
+        results = self.helper.run_batch([(['echo', 'a b'], None), (['sh', '-c', 'echo error >&2; exit 3'], None),
+                                         (['cat'], 'héllo\n' * 10000), (['true'], 'not read'), (['exit', '4'], None),
+                                         (['pwd'], None)])
+        self.assertListEqual([(r.returncode, r.stdout[:7], r.stderr) for r in results[:5]],
+                             [(0, 'a b\n', ''), (3, '', 'error\n'), (0, 'héllo\nh', ''), (0, '', ''), (4, '', '')])
+        self.assertEqual(len(results[2].stdout), 60000)
+        self.assertEqual(results[5].stdout.rstrip('\n'), os.getcwd())
+        # Output that isn't UTF-8 doesn't make the helper look lost
+        self.assertEqual(self.helper.run(['printf', r'\377']).stdout, '\ufffd')
+        process = self.helper._process
+        self.assertEqual(self.helper.run(['printf', '%s', 'a\nb']).stdout, 'a\nb')
+        self.assertIs(self.helper._process, process)
+
+    def test_lost_helper(self):
+        self.helper.run(['true'])
+        self.helper._process.kill()
+        self.helper._process.wait()
+        # Restarted when it's found dead before sending a request
+        self.assertEqual(self.helper.run(['echo', 'again']).stdout, 'again\n')
+        # Lost after it was sent the command, which may have run: not run again
+        self.helper._process.stdout.close()
+        with self.assertRaises(HostHelperError) as raised:
+            self.helper.run(['echo', 'twice'])
+        self.assertTrue(raised.exception.sent)
+        self.assertFalse(self.helper.broken)
+        # Gone before it could read the command: spawned instead
+        self.helper._process = subprocess.Popen(['sh', '-c', 'exec 0<&-; echo closed; sleep 30'],
+                                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.helper._process.stdout.readline()
+        result = self.helper.run(['echo', 'spawned'])
+        self.assertTrue(self.helper.broken)
+        self.assertEqual(result.stdout, 'spawned\n')
+
+
+@unittest.skipUnless(importlib.util.find_spec('gi') and shutil.which('dbus-daemon'), "needs PyGObject and dbus-daemon")
+class TestHelper(unittest.TestCase):
+    """Runs the helper on a private session bus, standing in for the system bus"""
+
+    def setUp(self):
+        from gi.repository import Gio
+        self.tmp = tempfile.TemporaryDirectory()
+        write_efivar(Path(self.tmp.name), 'Boot0000', crafted_load_option(1, 'A', r'\a.efi', b''))
+        self.bus = Gio.TestDBus.new(Gio.TestDBusFlags.NONE)
+        self.bus.up()
+        self.helper = subprocess.Popen([sys.executable, '-m', 'efiboots.helper', '--session',
+                                        '--efivars', self.tmp.name, '--idle-timeout', '5'],
+                                       env={**os.environ, 'DBUS_SESSION_BUS_ADDRESS': self.bus.get_bus_address(),
+                                            'PYTHONPATH': str(test_dir.parent / 'src')})
+
+    def tearDown(self):
+        self.helper.terminate()
+        self.helper.wait()
+        self.bus.down()
+        self.tmp.cleanup()
+
+    def test_typed_methods(self):
+        from gi.repository import Gio, GLib
+        from efiboots.helper import HelperClient
+        client = HelperClient(Gio.BusType.SESSION)
+        for _ in range(50):
+            if client.proxy.get_name_owner():
+                break
+            GLib.usleep(100000)
+            client = HelperClient(Gio.BusType.SESSION)
+        client.set_boot_order(['0000'])
+        client.set_boot_next('0000')
+        client.set_timeout(7)
+        client.set_active('0000', False)
+        self.assertEqual(efivars.get_boot_order(self.tmp.name), ['0000'])
+        self.assertEqual(efivars.get_boot_next(self.tmp.name), '0000')
+        self.assertEqual(efivars.get_timeout(self.tmp.name), 7)
+        client.delete_entry('0000')
+        self.assertListEqual(efivars.get_boot_order(self.tmp.name), [])
+        with self.assertRaises(GLib.Error):
+            client.set_active('0000', True)